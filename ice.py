@@ -30,11 +30,11 @@ import ConfigParser
 from flask import Markup
 from flask import render_template, render_template_string
 from flask import url_for, redirect, flash
-from flask import request, session, g
+from flask import request, session, g, Response
 from flask.ext import login as l
 
 from urllib2 import Request, urlopen, URLError
-import os, sys, optparse, re
+import os, sys, optparse, re, urllib
 import json, psycopg2 as pgdb
 
 ## Parse command line options. ##
@@ -128,15 +128,32 @@ login_manager = l.LoginManager()
 login_manager.init_app(app)
 login_manager.anonymous_user = seaice.user.AnonymousUser
 
-  ## Prescore terms ##
-  # This will be used to check for consistency errors in live scoring
-  # and isn't needed until I implement O(1) scoring. 
+  ## Consistency sweeper ##
+  # Scores are maintained incrementally as votes are cast. Check a sample
+  # of them against scores computed the hard way now and then. 
 
-#print "ice: checking term score consistnency (dev)" TODO
-#for term in db_con.getAllTerms():
-#  if not db_con.checkTermConsistency(term['id']):
-#    print "warning: corrected inconsistent consensus score for term %d" % term['id']
-#  db_con.commit()
+app.consistencySweeper = seaice.background.ConsistencySweeper(app.dbPool)
+app.consistencySweeper.start()
+
+  ## Persistent ID worker ##
+  # Binds and purges of persistent IDs are queued by term edits and 
+  # carried out here, outside of requests. 
+
+app.pidOutboxWorker = seaice.background.PidOutboxWorker(app.dbPool, prod_mode)
+app.pidOutboxWorker.start()
+
+  ## ARK reservoir ##
+  # New terms take persistent IDs minted ahead of time in bulk. 
+
+app.arkReservoirRefiller = seaice.background.ArkReservoirRefiller(app.dbPool, prod_mode)
+app.arkReservoirRefiller.start()
+
+  ## HTML renderer ##
+  # Terms and comments are stored with their rendered HTML. Render it for 
+  # imported rows and for rows that reference a term that has changed. 
+
+app.htmlRenderer = seaice.background.HtmlRenderer(app.dbPool)
+app.htmlRenderer.start()
 
 
 
@@ -148,7 +165,15 @@ print "ice: setup complete."
 def load_user(id):
   return app.SeaIceUsers.get(int(id))
 
-  ## Request wrappers (may have use for these later) ##
+  ## Request wrappers ##
+
+def getDB():
+  """ Check out a DB connector for the rest of the request, or return the 
+      one already checked out. It's released by teardown_request(), even 
+      if the request raises an exception. """
+  if getattr(g, 'db', None) is None:
+    g.db = app.dbPool.getScoped(owner="%s %s" % (request.method, request.path))
+  return g.db
 
 @app.before_request
 def before_request():
@@ -156,7 +181,10 @@ def before_request():
 
 @app.teardown_request
 def teardown_request(exception):
-  pass
+  db = getattr(g, 'db', None)
+  if db is not None:
+    g.db = None
+    db.release()
 
 
 ## HTTP request handlers ##
@@ -168,18 +196,27 @@ def pageNotFound(e):
                                               headline = "404",
                                               content = "The page you requested doesn't exist."), 404
 
+@app.errorhandler(seaice.PoolTimeoutError)
+def poolTimeout(e):
+    print >>sys.stderr, "error: %s" % e
+    return render_template('basic_page.html', user_name = l.current_user.name, 
+                                              title = "Oops! - 503",
+                                              headline = "503",
+                                              content = "The server is too busy right now. Please try again."), 503
+
 # home page
 @app.route("/")
 def index():
   if l.current_user.id:
-    g.db = app.dbPool.getScoped()
+    g.db = getDB()
       # TODO Store these values in class User in order to prevent
       # these queries every time the homepage is accessed.  
     my = seaice.pretty.printTermsAsLinks(g.db,
              g.db.getTermsByUser(l.current_user.id))
     star = seaice.pretty.printTermsAsLinks(g.db,
              g.db.getTermsByTracking(l.current_user.id))
-    notify = l.current_user.getNotificationsAsHTML(g.db)
+    notify = l.current_user.getNotificationsAsHTML(g.db,
+               request.args.get('notif_offset', 0, type=int))
     return render_template("index.html", user_name = l.current_user.name,
                    my = Markup(my.decode('utf-8')) if my else None,
                    star = Markup(star.decode('utf-8')) if star else None, 
@@ -245,7 +282,7 @@ def authorized(resp):
       return 'l'
   g_user = json.load(res)
   
-  g.db = app.dbPool.getScoped()
+  g.db = getDB()
   user = g.db.getUserByAuth('google', g_user['id'])
   if not user: 		# not seen this person before, so create user
     g_user['authority'] = 'google'
@@ -257,7 +294,8 @@ def authorized(resp):
     g.db.insertUser(g_user)
     g.db.commit()
     user = g.db.getUserByAuth('google', g_user['auth_id'])
-    app.SeaIceUsers[user['id']] = seaice.user.User(user['id'], user['first_name'])
+    app.SeaIceUsers[user['id']] = seaice.user.User(user['id'], user['first_name'],
+                                                   app.notificationStore)
     l.login_user(app.SeaIceUsers.get(user['id']))
     return render_template("account.html", user_name = l.current_user.name,
                                            email = g_user['email'],
@@ -291,20 +329,18 @@ def unauthorized():
 @app.route("/account", methods = ['POST', 'GET'])
 @l.login_required
 def settings():
-  g.db = app.dbPool.dequeue()
+  g.db = getDB()
   if request.method == "POST": 
     g.db.updateUser(l.current_user.id, 
                    request.form['first_name'],
                    request.form['last_name'],
                    True if request.form.get('enotify') else False)
     g.db.commit()
-    app.dbPool.enqueue(g.db)
     l.current_user.name = request.form['first_name']
     return getUser(str(l.current_user.id))
   
   # method was GET
   user = g.db.getUser(l.current_user.id)
-  app.dbPool.enqueue(g.db)
   return render_template("account.html", user_name = l.current_user.name,
        email = user['email'].decode('utf-8'),
        last_name_edit = user['last_name'].decode('utf-8'),
@@ -318,7 +354,7 @@ def settings():
 @app.route("/user=<int:user_id>")
 def getUser(user_id = None): 
  
-  g.db = app.dbPool.getScoped()
+  g.db = getDB()
   try:
     user = g.db.getUser(int(user_id))
     if user:
@@ -346,12 +382,12 @@ def getUser(user_id = None):
       headline = "User", 
       content = Markup("User <strong>#%s</strong> not found!" % user_id))
 
-@app.route("/user=<int:user_id>/notif=<int:notif_index>/remove", methods=['GET'])
+@app.route("/user=<int:user_id>/notif=<int:notif_id>/remove", methods=['GET'])
 @l.login_required
-def remNotification(user_id, notif_index):
+def remNotification(user_id, notif_id):
   try:
     assert user_id == l.current_user.id
-    app.SeaIceUsers[user_id].remove(notif_index, app.dbPool.getScoped())
+    app.SeaIceUsers[user_id].remove(notif_id, getDB())
     return redirect("/")
 
   except AssertionError:
@@ -373,20 +409,24 @@ def remNotification(user_id, notif_index):
 def getTerm(term_concept_id = None, message = ""):
 # NOTE: this getTerm is called with concept_id, the other getTerm with id
   
-    g.db = app.dbPool.getScoped()
-    term = g.db.getTermByConceptId(term_concept_id)
-    if not term:
+    g.db = getDB()
+    # The viewer-independent parts of the page are usually cached, so 
+    # only the viewer's vote and star are looked up. 
+    page = g.db.getTermPage(term_concept_id)
+    if not page:
       return render_template("basic_page.html",
                user_name = l.current_user.name, 
                title = "Term not found",
                headline = "Term", 
                content = Markup("Term <strong>#%s</strong> not found!" \
 	           % term_concept_id))
+    term = page['term']
 
-    result = seaice.pretty.printTermAsHTML(g.db, term, l.current_user.id)
+    result = seaice.pretty.printTermAsHTML(g.db, term, l.current_user.id,
+                                           rendered = page['rendered_term'])
     result = message + "<hr>" + result + "<hr>"
-    result += seaice.pretty.printCommentsAsHTML(g.db, g.db.getCommentHistory(term['id']),
-                                               l.current_user.id)
+    result += seaice.pretty.printCommentsAsHTML(g.db, page['comments'], l.current_user.id,
+                                                rendered = page['rendered_comments'])
     if l.current_user.id:
       result += """ 
       <form action="/term={0}/comment" method="post">
@@ -415,11 +455,35 @@ def getTerm(term_concept_id = None, message = ""):
                             headline = "Term", 
                             content = Markup(result.decode('utf-8')))
 
+#: Number of terms on a page of a /browse listing. 
+BROWSE_PAGE_SIZE = 100
+
 @app.route("/browse")
 @app.route("/browse/<listing>")
 def browse(listing = None):
-  g.db = app.dbPool.getScoped()
-  terms = g.db.getAllTerms(sortBy="term_string")
+  if listing not in seaice.termOrderings:
+    return redirect("/browse/recent")
+
+  # Pages are addressed by a keyset cursor, the ID of the term just 
+  # after (or before) the page. 
+  after = request.args.get('after', type=int)
+  before = request.args.get('before', type=int)
+
+  g.db = getDB()
+  # If the cursor term has been removed, start over from the first page. 
+  if (after or before) and g.db.getTermString(after or before) is None: 
+    after = before = None
+  # Ask for one extra term to find out whether there is another page. 
+  terms = list(g.db.getAllTerms(order=listing, limit=BROWSE_PAGE_SIZE + 1,
+                                after=after, before=before))
+  more = len(terms) > BROWSE_PAGE_SIZE
+  if before:
+    terms = terms[1:] if more else terms
+    (has_prev, has_next) = (more, True)
+  else:
+    terms = terms[:BROWSE_PAGE_SIZE]
+    (has_prev, has_next) = (after is not None, more)
+
   letter = '~'
   result = "<h5>{0} | {1} | {2} | {3} | {4}</h5><hr>".format(
      '<a href="/browse/score">high score</a>' if listing != "score" else 'high score',
@@ -430,25 +494,7 @@ def browse(listing = None):
     )
   # xxx alpha ordering of tags is wrong (because they start '#{g: ')
  
-  if listing == "recent": # Most recently added listing 
-    result += seaice.pretty.printTermsAsBriefHTML(g.db, 
-      sorted(terms, key=lambda term: term['modified'], reverse=True),
-      l.current_user.id)
-  
-  elif listing == "score": # Highest consensus
-    terms = sorted(terms, key=lambda term: term['consensus'], reverse=True)
-    result += seaice.pretty.printTermsAsBriefHTML(g.db, 
-      sorted(terms, key=lambda term: term['up'] - term['down'], reverse=True), l.current_user.id)
-
-  elif listing == "volatile": # Least stable (Frequent updates, commenting, and voting)
-    terms = sorted(terms, key=lambda term: term['t_stable'] or term['t_last'], reverse=True)
-    result += seaice.pretty.printTermsAsBriefHTML(g.db, terms, l.current_user.id)
-
-  elif listing == "stable": # Most stable, highest consensus
-    terms = sorted(terms, key=lambda term: term['t_stable'] or term['t_last'])
-    result += seaice.pretty.printTermsAsBriefHTML(g.db, terms, l.current_user.id)
-    
-  elif listing == "alphabetical": # Alphabetical listing 
+  if listing == "alphabetical": # Alphabetical listing 
     result += "<table>"
     for term in terms: 
       # skip if term is empty
@@ -463,14 +509,22 @@ def browse(listing = None):
         result += "</td></tr><tr><td width=20% align=center valign=top><h4>{0}</h4></td><td width=80%>".format(letter)
       result += "<p><a %s</a>" % seaice.pretty.innerAnchor(
         g.db, term['term_string'], term['concept_id'], term['definition'],
-	tagAsTerm=True)
-      result += " <i>contributed by %s</i></p>" % g.db.getUserNameById(term['owner_id'])
+	tagAsTerm=True, definition_text=term.get('definition_text'))
+      result += " <i>contributed by %s</i></p>" % seaice.pretty.getOwnerName(g.db, term)
     result += "</table>"
     # yyy temporary proof that this code is running
     print >>sys.stderr, "note: end alpha listing" 
 
-  else:
-    return redirect("/browse/recent")
+  else: # recent, score, volatile (least stable), or stable (most stable)
+    result += seaice.pretty.printTermsAsBriefHTML(g.db, terms, l.current_user.id)
+
+  pages = []
+  if has_prev and terms:
+    pages.append('<a href="/browse/%s?before=%d">&laquo; previous</a>' % (listing, terms[0]['id']))
+  if has_next and terms:
+    pages.append('<a href="/browse/%s?after=%d">next &raquo;</a>' % (listing, terms[-1]['id']))
+  if pages:
+    result += "<hr><h5>%s</h5>" % ' | '.join(pages)
 
   return render_template("browse.html", user_name = l.current_user.name, 
                                         title = "Browse", 
@@ -482,24 +536,53 @@ hash2uniquerifier_regex = re.compile('(?<!#)#(\w[\w.-]+)')
 # xxx is " the problem (use ' below)?
 #token_ref_regex = re.compile("(?<!#\{g: )([#&]+)([\w.-]+)")
 
+#: Number of terms on a page of search results. 
+SEARCH_PAGE_SIZE = 50
+
+def printSearchPages(url, offset, total):
+  """ Format the links to the neighbouring pages of search results. 
+
+  :param url: URL of the results, to which the offset is appended. 
+  :type url: str
+  :param offset: Number of results before the page shown. 
+  :type offset: int
+  :param total: Total number of results. 
+  :type total: int
+  """
+  pages = []
+  if offset > 0:
+    pages.append('<a href="%soffset=%d">&laquo; previous</a>' % (
+      url, max(0, offset - SEARCH_PAGE_SIZE)))
+  if offset + SEARCH_PAGE_SIZE < total:
+    pages.append('<a href="%soffset=%d">next &raquo;</a>' % (
+      url, offset + SEARCH_PAGE_SIZE))
+  result = "<hr><h5>Results %d to %d of %d" % (
+    offset + 1, min(offset + SEARCH_PAGE_SIZE, total), total)
+  if pages:
+    result += " | " + ' | '.join(pages)
+  return result + "</h5>"
+
 @app.route("/search", methods = ['POST', 'GET'])
 def returnQuery():
-  g.db = app.dbPool.getScoped()
-  if request.method == "POST": 
+  g.db = getDB()
+  # The first page is requested by the search form; the others by links. 
+  term_string = request.values.get('term_string')
+  if term_string: 
     # XXX whoa -- this use of term_string variable name (in all html forms)
     #     is totally different from term_string as used in the database!
     search_words = hash2uniquerifier_regex.sub(
-        seaice.pretty.ixuniq + '\\1',
-        request.form['term_string'])
-    terms = g.db.search(search_words)
-    #terms = g.db.search(request.form['term_string'])
-    if len(terms) == 0: 
+        seaice.pretty.ixuniq + '\\1', term_string)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    (terms, total) = g.db.searchPage(search_words, SEARCH_PAGE_SIZE, offset)
+    if total == 0: 
       return render_template("search.html", user_name = l.current_user.name, 
-        term_string = request.form['term_string'])
+        term_string = term_string)
     else:
       result = seaice.pretty.printTermsAsBriefHTML(g.db, terms, l.current_user.id)
+      result += printSearchPages("/search?%s&" % urllib.urlencode(
+        { 'term_string' : term_string.encode('utf-8') }), offset, total)
       return render_template("search.html", user_name = l.current_user.name, 
-        term_string = request.form['term_string'],
+        term_string = term_string,
 	result = Markup(result.decode('utf-8')))
 
   else: # GET
@@ -510,17 +593,45 @@ def returnQuery():
 # when user clicks on community tag (searches for all terms bearing the tag)
 @app.route("/tag/<tag>")
 def getTag(tag = None): 
-  g.db = app.dbPool.getScoped()
-  terms = g.db.search(seaice.pretty.ixuniq + tag)
-  if len(terms) == 0: 
+  g.db = getDB()
+  offset = max(0, request.args.get('offset', 0, type=int))
+  (terms, total) = g.db.searchPage(seaice.pretty.ixuniq + tag, SEARCH_PAGE_SIZE, 
+                                   offset, prefix=False)
+  if total == 0: 
     return render_template("tag.html", user_name = l.current_user.name, 
                                           term_string = tag)
   else:
     result = seaice.pretty.printTermsAsBriefHTML(g.db, terms, l.current_user.id)
+    result += printSearchPages("/tag/%s?" % urllib.quote(tag.encode('utf-8')), 
+                               offset, total)
     return render_template("tag.html", user_name = l.current_user.name, 
       term_string = tag, result = Markup(result.decode('utf-8')))
 
 
+#: Maximum number of suggestions a /suggest request can ask for. 
+SUGGEST_MAX = 50
+
+# Suggest terms for a partial term string *q*, for search-as-you-type. 
+# Returns a JSON list of up to *n* objects with the keys 'term_string' 
+# and 'concept_id'. 
+@app.route("/suggest")
+def suggest(): 
+  q = request.args.get('q', '')
+  n = min(max(1, request.args.get('n', seaice.SUGGEST_LIMIT, type=int)), SUGGEST_MAX)
+  g.db = getDB()
+  terms = g.db.suggestTerms(q, n) if q else []
+  return Response(json.dumps(terms), mimetype="application/json")
+
+
+# Counters of the in-process caches of this server process, as JSON. 
+@app.route("/stats")
+def getStats(): 
+  return Response(json.dumps({ 
+      'user_names' : seaice.userNameCache.stats(), 
+      'term_pages' : seaice.termPageCache.stats(),
+      'searches' : seaice.searchCache.stats() }), mimetype="application/json")
+
+
   ## Propose, edit, or remove a term ##
 
 @app.route("/contribute", methods = ['POST', 'GET'])
@@ -528,15 +639,19 @@ def getTag(tag = None):
 def addTerm(): 
 
   if request.method == "POST": 
-    g.db = app.dbPool.dequeue()
+    g.db = getDB()
     # xxx add check for non-empty term_string before consuming new 'id'
     # xxx add check for temporary, test term_string and then only consume
     #     a test 'id'
+    # Resolve the references of the whole form in one query. 
+    (term_string, definition, examples) = seaice.pretty.refs_norm_all(g.db,
+      [ request.form['term_string'], request.form['definition'], 
+        request.form['examples'] ])
     term = {
       #'term_string' : request.form['term_string'],
-      'term_string' : seaice.pretty.refs_norm(g.db, request.form['term_string']),
-      'definition' : seaice.pretty.refs_norm(g.db, request.form['definition']),
-      'examples' : seaice.pretty.refs_norm(g.db, request.form['examples']),
+      'term_string' : term_string,
+      'definition' : definition,
+      'examples' : examples,
       'owner_id' : l.current_user.id,
       'id' : app.termIdPool.ConsumeId() }
 
@@ -554,7 +669,6 @@ def addTerm():
       g.db.updateTerm(term['id'], term, None, prod_mode)
 
     g.db.commit()
-    app.dbPool.enqueue(g.db)
     return getTerm(concept_id,
         message = "Your term has been added to the metadictionary!")
   
@@ -568,7 +682,7 @@ def addTerm():
 def editTerm(term_concept_id = None): 
 
   try: 
-    g.db = app.dbPool.dequeue()
+    g.db = getDB()
     term = g.db.getTermByConceptId(term_concept_id)
     #user = g.db.getUser(l.current_user.id)
     # yyy not checking if term was found?
@@ -577,11 +691,14 @@ def editTerm(term_concept_id = None):
     if request.method == "POST":
 
       assert request.form.get('examples') != None
+      (term_string, definition, examples) = seaice.pretty.refs_norm_all(g.db,
+        [ request.form['term_string'], request.form['definition'], 
+          request.form['examples'] ])
       updatedTerm = {
         #'term_string' : request.form['term_string'],
-        'term_string' : seaice.pretty.refs_norm(g.db, request.form['term_string']),
-        'definition' : seaice.pretty.refs_norm(g.db, request.form['definition']),
-        'examples' : seaice.pretty.refs_norm(g.db, request.form['examples']),
+        'term_string' : term_string,
+        'definition' : definition,
+        'examples' : examples,
         'owner_id' : l.current_user.id } 
 
       g.db.updateTerm(term['id'], updatedTerm, term['persistent_id'], prod_mode)
@@ -594,13 +711,11 @@ def editTerm(term_concept_id = None):
         app.SeaIceUsers[user_id].notify(notify_update, g.db)        
       
       g.db.commit()
-      app.dbPool.enqueue(g.db)
 
       return getTerm(term_concept_id,
 	message = "Your term has been updated in the metadictionary.")
   
     else:		# GET 
-      app.dbPool.enqueue(g.db)
       if term: 
         return render_template("contribute.html",
 	  user_name = l.current_user.name, 
@@ -633,7 +748,7 @@ def editTerm(term_concept_id = None):
 def remTerm(term_id):
 
   try:
-    g.db = app.dbPool.getScoped()
+    g.db = getDB()
     term = g.db.getTerm(int(request.form['id']))
     assert term and term['owner_id'] == l.current_user.id
     assert term['class'] == 'vernacular'
@@ -677,7 +792,7 @@ def addComment(term_id):
     assert l.current_user.id
 
     term_id = int(term_id)
-    g.db = app.dbPool.getScoped()
+    g.db = getDB()
     comment = { 'comment_string' : seaice.pretty.refs_norm(g.db, request.form['comment_string']),
                 'term_id' : term_id,
                 'owner_id' : l.current_user.id,
@@ -707,7 +822,7 @@ def addComment(term_id):
 def editComment(comment_id = None): 
 
   try: 
-    g.db = app.dbPool.dequeue()
+    g.db = getDB()
     comment = g.db.getComment(int(comment_id))
     assert l.current_user.id and comment['owner_id'] == l.current_user.id
     
@@ -717,10 +832,8 @@ def editComment(comment_id = None):
 
       g.db.updateComment(int(comment_id), updatedComment)
       g.db.commit()
-      app.dbPool.enqueue(g.db)
       return getTerm(g.db.getTermConceptId(comment['term_id']), message = "Your comment has been updated.")
     else: # GET 
-      app.dbPool.enqueue(g.db)
       if comment: 
         form = """ 
         <form action="/comment={0}/edit" method="post">
@@ -754,7 +867,7 @@ def editComment(comment_id = None):
 def remComment(comment_id):
   
   try:
-    g.db = app.dbPool.getScoped()
+    g.db = getDB()
     comment = g.db.getComment(int(request.form['id']))
     assert comment and comment['owner_id'] == l.current_user.id
 
@@ -775,7 +888,7 @@ def remComment(comment_id):
 @app.route("/term=<int:term_id>/vote", methods=['POST'])
 @l.login_required
 def voteOnTerm(term_id):
-  g.db = app.dbPool.getScoped()
+  g.db = getDB()
   p_vote = g.db.getVote(l.current_user.id, term_id) 
   if request.form['action'] == 'up':
     if p_vote == 1:
@@ -796,7 +909,7 @@ def voteOnTerm(term_id):
 @app.route("/term=<int:term_id>/track", methods=['POST'])
 @l.login_required
 def trackTerm(term_id): 
-  g.db = app.dbPool.getScoped()
+  g.db = getDB()
   if request.form['action'] == "star":
     g.db.trackTerm(l.current_user.id, term_id)
   else:
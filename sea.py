@@ -25,7 +25,7 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import os, sys, optparse
+import os, sys, optparse, time
 import json, psycopg2 as pqdb
 import seaice
 import ConfigParser
@@ -80,6 +80,12 @@ parser.add_option("--export", dest="export_table",
                   help="Export dictionary as JSON-formatted FILE.",
                   metavar="TABLE")
 
+parser.add_option("--json-lines", action="store_true", dest="json_lines", default=False,
+                  help="On export, write one JSON object per line instead of a JSON array.")
+
+parser.add_option("--drain-pid-outbox", action="store_true", dest="drain_pid_outbox", default=False,
+                  help="Carry out the pending persistent ID binds and purges (normally done by ice).")
+
 parser.add_option("-f", "--file", dest="file_name", 
                   help="File from which to import, or file to which to export.",
                   metavar="FILE")
@@ -98,6 +104,21 @@ parser.add_option("--score-terms", action="store_true", dest="score", default=Fa
 parser.add_option("--classify-terms", action="store_true", dest="classify", default=False,
                   help="Classify stable terms in the dictionary. This will modify the term's class.")
 
+parser.add_option("--classify-scheduler", action="store_true", dest="classify_scheduler", default=False,
+                  help="Run until interrupted, periodically classifying the terms that have become stable " + 
+                       "since the last run.")
+
+parser.add_option("--interval", dest="interval", type="int", metavar="SECONDS", default=300,
+                  help="Time between runs of the classification scheduler (defaults to 300).")
+
+parser.add_option("--batch-size", dest="batch_size", type="int", metavar="INT", 
+                  default=seaice.CLASSIFY_BATCH,
+                  help="Number of terms classified per transaction by the classification scheduler " + 
+                       "(defaults to %d)." % seaice.CLASSIFY_BATCH)
+
+parser.add_option("--check-score-parity", action="store_true", dest="check_score_parity", default=False,
+                  help="Check that batch scoring (--score-terms) agrees with scoring each term by itself.")
+
 parser.add_option("--set-reputation", dest="reputation",
                   help="Set user's reputation (to a positive integer).",
                   metavar="INT")
@@ -112,6 +133,26 @@ parser.add_option("--drop-db", action="store_true", dest="drop_tables", default=
 parser.add_option("--init-db", action="store_true", dest="create_tables", default=False,
                   help="Create new tables if they don't exist.")
 
+parser.add_option("--migrate", action="store_true", dest="migrate", default=False,
+                  help="Apply pending schema migrations (e.g. new indexes) and record the schema version. " + 
+                       "Needs PostgreSQL 9.6 or later.")
+
+parser.add_option("--check-indexes", action="store_true", dest="check_indexes", default=False,
+                  help="EXPLAIN the hot queries and report whether each uses its index.")
+
+parser.add_option("--check-scoped-writes", action="store_true", dest="check_scoped_writes", default=False,
+                  help="Comment and vote on a synthetic term through a pooled connector, as requests do, and " + 
+                       "report the steps that fail. The data is removed again; use a development database.")
+
+parser.add_option("--bench-reputation", action="store_true", dest="bench_reputation", default=False,
+                  help="Time reputation updates for users with 10, 1k, and 100k votes. Synthetic users and " + 
+                       "terms are created and removed again; use a development database.")
+
+parser.add_option("--bench-refs-norm", action="store_true", dest="bench_refs_norm", default=False,
+                  help="Time normalizing the references of synthetic term forms with 3, 30, and 300 " + 
+                       "references, compared with the former normalizer, and count the references " + 
+                       "it normalizes differently (tokens inside curly references are no longer promoted).")
+
 parser.add_option("-j", "--json", action="store_true", dest="json", default=False,
                   help="Format terminal output as a JSON structure.")
 
@@ -174,7 +215,7 @@ try:
       rebind=options.rebind, remint=options.remint)
 
   if options.export_table:
-    sea.Export(options.export_table, options.file_name)
+    sea.Export(options.export_table, options.file_name, lines=options.json_lines)
   
   if options.drop_tables:
     if not options.quiet:
@@ -186,6 +227,49 @@ try:
         
   if options.create_tables:
     sea.createSchema()
+
+  if options.migrate:
+    applied = sea.migrate()
+    for (version, description, sql) in seaice.migrations:
+      if version in applied:
+        print "applied migration %d: %s" % (version, description)
+    print "schema version: %d" % sea.getSchemaVersion()
+
+  if options.check_indexes:
+    ok = True
+    for (index, used, plan) in sea.checkIndexes():
+      print "%-32s%s" % (index, 'ok' if used else 'NOT USED')
+      if not used:
+        ok = False
+        print plan
+    if not ok:
+      sys.exit(1)
+  
+  if options.check_scoped_writes:
+    if options.config_file == "heroku": 
+      pool = seaice.SeaIceConnectorPool(1, min_count=0)
+    else: 
+      pool = seaice.SeaIceConnectorPool(1, config.get(options.db_role, 'user'),
+                                           config.get(options.db_role, 'password'),
+                                           config.get(options.db_role, 'dbname'), 
+                                        min_count=0)
+    failed = seaice.benchmark.checkScopedWrites(pool)
+    for (step, e) in failed:
+      print "%-24s%s" % (step, e)
+    if failed:
+      sys.exit(1)
+    print "scoped writes ok"
+
+  if options.bench_reputation:
+    print "%-10s%-12s%-12s" % ('Votes', 'Seconds', 'Terms/s')
+    for (votes, T) in seaice.benchmark.benchmarkReputation(sea):
+      print "%-10d%-12.4f%-12.0f" % (votes, T, votes / T if T else 0)
+
+  if options.bench_refs_norm:
+    print "%-8s%-12s%-10s%-12s%-10s%-6s" % ('Refs', 'Before (s)', 'Queries', 
+                                            'After (s)', 'Queries', 'Differ')
+    for (refs, T_old, q_old, T_new, q_new, differ) in seaice.benchmark.benchmarkRefsNorm(sea):
+      print "%-8d%-12.4f%-10d%-12.4f%-10d%-6d" % (refs, T_old, q_old, T_new, q_new, differ)
   
   if options.dump: 
     if options.json:
@@ -195,26 +279,47 @@ try:
 
   header = True
   if options.score: 
+    scores = sea.scoreAllTerms()
+    sea.commit()
     for term in sea.getAllTerms():
-      (U, V) = sea.preScore(term['id'])
-      s = sea.postScore(term['id'], U, V)
+      (u, d, U_sum, D_sum, s) = scores[term['id']]
       if header: 
         print "%-8s%-20s%-8s%-8s%-8s" % ('Id', 'Term', 'Up', 'Down', 'Score')
         header = False
       print "%-8d%-20s%-8d%-8d%-8.2f" % (term['id'], 
                                    term['term_string'], 
-                                   term['up'],
-                                   term['down'], 
+                                   u,
+                                   d, 
                                    (100 * s))
   
   header = True
   if options.classify:
+    classes = sea.classifyTerms()
+    sea.commit()
     for (term, id) in map(lambda term: (term['term_string'], term['id']), sea.getAllTerms()):
       if header: 
         print "%-8s%-20s%-8s" % ('Id', 'Term', 'Class')
         header = False
-      print "%-8s%-20s%-8s" % (id, term, sea.classifyTerm(id))
-      sea.commit()
+      print "%-8s%-20s%-8s" % (id, term, classes[id])
+
+  if options.drain_pid_outbox:
+    while True:
+      (done, failed) = sea.processPidOps(prod_mode)
+      if done + failed == 0:
+        break
+      print "sea: %d persistent ID operations done, %d failed" % (done, failed)
+    stats = sea.getPidOutboxStats()
+    if stats['pending']:
+      print "sea: %d operations pending (%d retrying), oldest from %s" % (
+        stats['pending'], stats['retrying'], stats['oldest'])
+
+  if options.check_score_parity:
+    mismatched = sea.checkScoreParity()
+    for id in mismatched:
+      print "term %d: batch score differs from per-term score" % id
+    if mismatched:
+      sys.exit(1)
+    print "scores agree"
   
   if options.search_term:
     terms = sea.search(options.search_term)
@@ -227,6 +332,15 @@ try:
   ## Commit database mutations. ##
   sea.commit()
 
+  ## Scheduler mode; runs until interrupted. ##
+  if options.classify_scheduler:
+    while True:
+      count = sea.classifyDueTerms(options.batch_size)
+      if count:
+        print "sea: classified %d terms" % count
+        sys.stdout.flush()
+      time.sleep(options.interval)
+
 except pqdb.DatabaseError, e:
   print 'error: %s' % e    
   sys.exit(1)
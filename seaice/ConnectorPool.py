@@ -29,16 +29,41 @@
 
 from SeaIceConnector import *
 from threading import Condition
+from collections import deque
+import time
+
+#: Default number of connectors opened when the pool is created. 
+MIN_CONNECTIONS = 2
+
+#: Default time (in seconds) to wait for a connector before giving up. 
+DEQUEUE_TIMEOUT = 30
+
+#: Default time (in seconds) after which a connector is closed and reopened. 
+MAX_LIFETIME = 3600
+
+#: A connector that has been idle for longer than this (in seconds) is 
+#: checked with a trivial query before it's handed out. 
+PING_INTERVAL = 30
+
+#: A connector held for longer than this (in seconds) is reported as a 
+#: possible leak, along with the name of whoever checked it out. 
+LEAK_THRESHOLD = 10
+
+class PoolTimeoutError (Exception): 
+  """ Raised by :func:`ConnectorPool.dequeue` if no connector becomes 
+      available in time. """
+  pass
 
 class ScopedSeaIceConnector (SeaIceConnector): 
   """
     A SeaIce DB Connector which is released to the pool from whence it 
-    came when it goes out of scope. This type of connector is produced by 
+    came by :func:`release`, at the end of a ``with`` block, or, failing 
+    that, when it goes out of scope. This type of connector is produced by 
     :func:`seaice.ConnectorPool.SeaIceConnectorPool.getScoped`
     and should not be used directly. 
 
     :param pool: The pool from which this connector originates. 
-                 When the destructor is called, the connection is enqueued 
+                 When the connector is released, the connection is enqueued 
                  into the pool.
 
     :type pool: seaice.ConnectorPool.SeaIceConnectorPool
@@ -48,54 +73,251 @@ class ScopedSeaIceConnector (SeaIceConnector):
 
   def __init__(self, pool, db_con):
     self.con = db_con.con
+    self._resetDirtyState()
     self.db_con = db_con
     self.pool = pool
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.release()
+    return False
+
+  def release(self):
+    """ Return the connection to the pool. It's safe to call this more 
+        than once; the connector can't be used afterwards. 
+    """
+    if self.db_con is not None:
+      db_con, self.db_con = self.db_con, None
+      self.con = None
+      self.pool.enqueue(db_con)
+
   def __del__(self):
-    self.pool.enqueue(self.db_con)
+    self.release()
 
 
 class ConnectorPool:
-  """ A thread-safe connection pool. 
+  """ A thread-safe FIFO connection pool. 
+
+    Connectors are opened lazily, up to *count* of them, and handed out in 
+    the order they were released. Before a connector is handed out, it's 
+    reopened if it has been closed, has outlived *max_lifetime*, or doesn't 
+    answer a trivial query after being idle for a while. Connectors are 
+    returned to the pool with no transaction open. 
 
-  TODO: Make this an actual queue, not a stack. Nomenclature is important
-  sometimes. 
+  :param Connector: Class of the connectors. 
+  :param count: Maximum size of the pool. 
+  :type count: int
+  :param min_count: Number of connectors to open up front. 
+  :type min_count: int
+  :param timeout: Time (in seconds) :func:`dequeue` waits for a connector. 
+  :type timeout: float
+  :param max_lifetime: Time (in seconds) after which a connector is reopened. 
+  :type max_lifetime: float
   """
   
-  def __init__(self, Connector, count=20, user=None, password=None, db=None):
-    self.pool = [ Connector(user, password, db) for _ in range(count) ]
+  def __init__(self, Connector, count=20, user=None, password=None, db=None,
+                     min_count=MIN_CONNECTIONS, timeout=DEQUEUE_TIMEOUT, 
+                     max_lifetime=MAX_LIFETIME):
+    self.Connector = Connector
+    self.args = (user, password, db)
+    self.count = count
+    self.timeout = timeout
+    self.max_lifetime = max_lifetime
+
+    self.pool = deque() #: Idle connectors, least recently released first. 
+    self.size = 0       #: Number of open connectors, idle or in use. 
+    self.held = {}      #: Connectors in use, by id(). 
     self.C_pool = Condition()
-      
-  def dequeue(self):
-    """ Get connector. 
+
+    #: Counters, see :func:`stats`. 
+    self.in_use = 0
+    self.checkouts = 0
+    self.timeouts = 0
+    self.reconnects = 0
+    self.T_wait = 0.0
+    self.T_wait_max = 0.0
+    self.T_checkout = 0.0
+    self.T_checkout_max = 0.0
+
+    for _ in range(min(min_count, count)):
+      self.pool.append(self.connect())
+      self.size += 1
+
+  def connect(self): 
+    """ Open a new connector. 
     
     :rtype: seaice.SeaIceConnector.SeaIceConnector
     """
+    db_con = self.Connector(*self.args)
+    db_con.T_created = db_con.T_released = time.time()
+    return db_con
+
+  def isAlive(self, db_con): 
+    """ Check that a connector may be handed out. 
+
+    :rtype: bool
+    """
+    T_now = time.time()
+    if db_con.con.closed or T_now - db_con.T_created > self.max_lifetime: 
+      return False
+    if T_now - db_con.T_released > PING_INTERVAL:
+      try:
+        cur = db_con.con.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        db_con.con.rollback()
+      except pgdb.Error:
+        return False
+    return True
+      
+  def dequeue(self, timeout=None, owner=None):
+    """ Get connector. Wait at most *timeout* seconds (the pool's default 
+        if not given) for one to be released. 
+
+    :param owner: Name of whoever checks the connector out, e.g. the route. 
+                  It's used to report connectors held for too long. 
+    :type owner: str
+    :rtype: seaice.SeaIceConnector.SeaIceConnector
+    :raises PoolTimeoutError: if no connector is available in time. 
+    """
+    if timeout is None:
+      timeout = self.timeout
+    T_start = time.time()
+    db_con = None
+    self.C_pool.acquire()
+    try:
+      while True:
+        if len(self.pool) > 0: 
+          db_con = self.pool.popleft()
+          break
+        if self.size < self.count: # Grow the pool. 
+          self.size += 1
+          break
+        T_remaining = T_start + timeout - time.time()
+        if T_remaining <= 0: 
+          self.timeouts += 1
+          self.logLeaks()
+          raise PoolTimeoutError(
+            "no DB connector available after %.1f seconds (%d of %d in use)" % (
+              timeout, self.in_use, self.count))
+        self.C_pool.wait(T_remaining)
+      self.in_use += 1
+    finally:
+      self.C_pool.release()
+
+    try:
+      if db_con is None:
+        db_con = self.connect()
+      elif not self.isAlive(db_con):
+        db_con.con.close()
+        db_con = self.connect()
+        self.reconnects += 1
+    except:
+      # Give up the slot so that another thread can try. 
+      self.C_pool.acquire()
+      self.size -= 1
+      self.in_use -= 1
+      self.C_pool.notify()
+      self.C_pool.release()
+      raise
+
+    T_now = time.time()
+    db_con.T_checkout = T_now
+    db_con.owner = owner
     self.C_pool.acquire()
-    while len(self.pool) == 0: 
-      self.C_pool.wait()
-    db_con = self.pool.pop()
+    self.held[id(db_con)] = db_con
+    self.checkouts += 1
+    self.T_wait += T_now - T_start
+    self.T_wait_max = max(self.T_wait_max, T_now - T_start)
     self.C_pool.release()
     return db_con
 
   def enqueue(self, db_con): 
-    """ Release connector.
+    """ Release connector. An open transaction is rolled back. If this 
+        fails, the connector is closed and will be replaced as needed.
 
     :param db_con: The connector. 
     :type db_con: seaice.SeaIceConnector.SeaIceConnector
     """
+    try: 
+      if not db_con.con.closed and db_con.con.get_transaction_status() != \
+          pgdb.extensions.TRANSACTION_STATUS_IDLE:
+        db_con.con.rollback()
+    except pgdb.Error:
+      db_con.con.close()
+
+    T_now = time.time()
+    db_con.T_released = T_now
+    if T_now - db_con.T_checkout > LEAK_THRESHOLD: 
+      print >>sys.stderr, "warning: DB connector held for %.1f seconds by %s" % (
+        T_now - db_con.T_checkout, db_con.owner)
     self.C_pool.acquire()
-    self.pool.append(db_con)
+    del self.held[id(db_con)]
+    if db_con.con.closed:
+      self.size -= 1
+    else:
+      self.pool.append(db_con)
+    self.in_use -= 1
+    self.T_checkout += T_now - db_con.T_checkout
+    self.T_checkout_max = max(self.T_checkout_max, T_now - db_con.T_checkout)
     self.C_pool.notify()
     self.C_pool.release()
 
+  def getLeaks(self, threshold=LEAK_THRESHOLD): 
+    """ Return the connectors held for longer than *threshold* seconds. 
+    
+    :returns: Tuples (owner, seconds held), longest held first. 
+    :rtype: list
+    """
+    T_now = time.time()
+    self.C_pool.acquire()
+    held = self.held.values()
+    self.C_pool.release()
+    return sorted([ (db_con.owner, T_now - db_con.T_checkout) for db_con in held
+                      if T_now - db_con.T_checkout > threshold ], 
+                  key=lambda leak: leak[1], reverse=True)
+
+  def logLeaks(self): 
+    """ Print the connectors held for too long to standard error. Called 
+        when the pool is exhausted. 
+    """
+    for (owner, T_held) in self.getLeaks():
+      print >>sys.stderr, "warning: DB connector held for %.1f seconds by %s" % (
+        T_held, owner)
+
+  def stats(self): 
+    """ Return the pool's counters. Times are in seconds. 
+
+    :returns: Keys 'size', 'idle', 'in_use', 'max_size', 'checkouts', 
+              'timeouts', 'reconnects', 'wait_total', 'wait_max', 
+              'checkout_total', and 'checkout_max'. 
+    :rtype: dict
+    """
+    self.C_pool.acquire()
+    try:
+      return { 'size' : self.size, 
+               'idle' : len(self.pool), 
+               'in_use' : self.in_use, 
+               'max_size' : self.count,
+               'checkouts' : self.checkouts, 
+               'timeouts' : self.timeouts, 
+               'reconnects' : self.reconnects, 
+               'wait_total' : self.T_wait, 
+               'wait_max' : self.T_wait_max, 
+               'checkout_total' : self.T_checkout, 
+               'checkout_max' : self.T_checkout_max }
+    finally:
+      self.C_pool.release()
+
 
 class SeaIceConnectorPool (ConnectorPool):
   """ 
     A thread-safe connection pool which can produce scoped SeaIce 
     connectors.
 
-    :param count: Size of the pool.
+    :param count: Maximum size of the pool.
     :type count: int
     :param user: Name of DB role (see :class:`seaice.SeaIceConnector.SeaIceConnector` for 
                  default behavior).
@@ -104,16 +326,29 @@ class SeaIceConnectorPool (ConnectorPool):
     :type password: str
     :param db: Name of database. 
     :type db: str
+    :param min_count: Number of connectors to open up front. 
+    :type min_count: int
+    :param timeout: Time (in seconds) to wait for a connector. 
+    :type timeout: float
+    :param max_lifetime: Time (in seconds) after which a connector is reopened. 
+    :type max_lifetime: float
   """
   
-  def __init__(self, count=20, user=None, password=None, db=None):
-    ConnectorPool.__init__(self, SeaIceConnector, count, user, password, db)
+  def __init__(self, count=20, user=None, password=None, db=None,
+                     min_count=MIN_CONNECTIONS, timeout=DEQUEUE_TIMEOUT, 
+                     max_lifetime=MAX_LIFETIME):
+    ConnectorPool.__init__(self, SeaIceConnector, count, user, password, db,
+                           min_count, timeout, max_lifetime)
 
-  def getScoped(self):
-    """ Return a scoped connector from the pool.
-
-    :rtype: seaice.SeaIceConnector.SeaIceConnector
-    """
-    return ScopedSeaIceConnector(self, self.dequeue())
+  def getScoped(self, owner=None):
+    """ Return a scoped connector from the pool. It can be used in a 
+        ``with`` statement to release it deterministically:: 
 
+          with pool.getScoped() as db_con: 
+            ...
 
+    :param owner: Name of whoever checks the connector out. 
+    :type owner: str
+    :rtype: seaice.ConnectorPool.ScopedSeaIceConnector
+    """
+    return ScopedSeaIceConnector(self, self.dequeue(owner=owner))
@@ -25,45 +25,111 @@
 
 from SeaIceConnector import *
 from threading import Lock
+import bisect
+
+#: Number of IDs reserved from a table's sequence at a time. 
+RESERVE_BLOCK = 32
 
 class IdPool:
   """ 
     A thread-safe object for producing and consuming table row IDs within 
     a particluar context, i.e. ``SI.Terms``, ``SI.Users``, and ``SI.Comments``. 
-    When initialized, an instance queries the table for all assigned IDs in 
-    ascending order. Continuous regions of unassigned IDs are found and added 
-    to the pool. The highest assigned ID is noticed so that when the pool is 
-    empty, the producer function returns the next highest avaialble.
+    Free IDs are kept as a sorted list of disjoint ranges ``[lo, hi]``, so a 
+    sparse table costs one entry per gap rather than one per free ID. 
+
+    By default, an instance asks the database for the gaps between the 
+    assigned IDs when it's initialized. These are added to the pool. The 
+    highest assigned ID is noticed so that when the pool is empty, the 
+    producer function returns the next highest avaialble. Since each process 
+    has its own pool, two processes may hand out the same ID. 
 
-    **TODO** This could be made more space-efficient by combining contiguous 
-    free IDs into ranges.
+    If *dbPool* is given, the pool instead reserves blocks of IDs from the 
+    table's sequence as they are needed. ``nextval()`` never returns a value 
+    twice, so any number of processes can allocate IDs without collisions. 
+    Rows inserted with explicit IDs that don't come from the sequence are 
+    skipped; ``sea.py --import`` moves the sequence past them (see 
+    :func:`seaice.SeaIceConnector.SeaIceConnector.syncIdSequence`). The 
+    blocks are reserved with a connector of the pool's own, opened when 
+    it's first needed, so that a request holding a pooled connector never 
+    waits for another one. 
 
   :param db_con: Connection to the SeaIce database.
   :type db_con: seaice.SeaIceConnector.SeaIceConnector
   :param table: Name of the table for which a pool will be created. The table
                 should have a column of surrogate ID scalled "id". 
   :type table: str
+  :param dbPool: Pool whose database IDs are reserved from. 
+  :type dbPool: seaice.ConnectorPool.SeaIceConnectorPool
+  :param block: Number of IDs to reserve at a time. 
+  :type block: int
 
   """
   
-  def __init__(self, db_con, table): 
+  def __init__(self, db_con, table, dbPool=None, block=RESERVE_BLOCK): 
     assert table in ['Users', 'Terms', 'Comments']
     
     self.L_pool = Lock()
+    self.table = table
+    self.dbPool = dbPool
+    self.block = block
+    self.pool = [] #: Free IDs as sorted, disjoint ranges [lo, hi]. 
+    self.next = None
+    self.db_con = None #: Connector for reserving IDs, see :func:`reserve`. 
+
+    if dbPool: 
+      return
 
     cur = db_con.con.cursor()
-    cur.execute("select id from SI.%s order by id" % table)
-    
-    self.pool = []
-    prev = 1000  
-    for row in map(lambda x : x[0], cur.fetchall()):
-      if row > prev + 1:
-        self.pool += range(prev + 1, row)
-      prev = row 
-   
-    self.next = prev + 1
+    cur.execute("""SELECT prev + 1, id - 1 
+                     FROM (SELECT id, coalesce(lag(id) OVER (ORDER BY id), 1000) AS prev
+                             FROM SI.%s WHERE id > 1000) AS ids
+                    WHERE id > prev + 1 
+                    ORDER BY id""" % table)
+    self.pool = map(list, cur.fetchall())
+    cur.execute("SELECT coalesce(max(id), 1000) FROM SI.%s" % table)
+    self.next = cur.fetchone()[0] + 1
 
-    print "Table %s pool:" % table, (self.pool, self.next)
+  def reserve(self): 
+    """ Reserve a block of IDs from the table's sequence and add the ones 
+        that aren't assigned yet to the pool. The caller must hold the lock. 
+    """
+    if self.db_con is None or self.db_con.con.closed: 
+      self.db_con = self.dbPool.connect()
+    try:
+      cur = self.db_con.con.cursor()
+      ids = []
+      while not ids: 
+        cur.execute("SELECT nextval(%s) FROM generate_series(1, %s)", 
+                    ('SI.%s_id_seq' % self.table, self.block))
+        ids = map(lambda row: row[0], cur.fetchall())
+        cur.execute("SELECT id FROM SI.%s WHERE id = ANY(%%s)" % self.table, (ids,))
+        used = set(map(lambda row: row[0], cur.fetchall()))
+        ids = filter(lambda id: id not in used, ids)
+      self.db_con.con.commit()
+    except pgdb.Error: 
+      self.db_con.con.close() # Reopened on the next call. 
+      raise
+    for id in ids: 
+      self.add(id)
+
+  def add(self, id): 
+    """ Add an ID to the ranges of free IDs. The caller must hold the lock. """
+    i = bisect.bisect_left(self.pool, [id]) # First range with lo >= id. 
+    if i > 0 and self.pool[i-1][1] >= id: 
+      return # Already free. 
+    if i < len(self.pool) and self.pool[i][0] == id: 
+      return 
+    below = i > 0 and self.pool[i-1][1] == id - 1
+    above = i < len(self.pool) and self.pool[i][0] == id + 1
+    if below and above: 
+      self.pool[i-1][1] = self.pool[i][1]
+      del self.pool[i]
+    elif below: 
+      self.pool[i-1][1] = id
+    elif above: 
+      self.pool[i][0] = id
+    else: 
+      self.pool.insert(i, [id, id])
      
   def ConsumeId(self): 
     """ Consume the next available ID. 
@@ -71,13 +137,21 @@ class IdPool:
     :rtype: int
     """
     self.L_pool.acquire()
-    if len(self.pool) > 0: 
-      ret = self.pool.pop()
-    else:
-      ret = self.next
-      self.next += 1
-    self.L_pool.release()
-    return ret
+    try:
+      if len(self.pool) == 0 and self.dbPool:
+        self.reserve()
+      if len(self.pool) > 0: 
+        ret = self.pool[-1][1]
+        if self.pool[-1][0] == ret:
+          self.pool.pop()
+        else:
+          self.pool[-1][1] -= 1
+      else:
+        ret = self.next
+        self.next += 1
+      return ret
+    finally:
+      self.L_pool.release()
 
   def GetNextId(self): 
     """ Get the next ID without consuming it (look ahead). 
@@ -85,12 +159,16 @@ class IdPool:
     :rtype: int
     """
     self.L_pool.acquire()
-    if len(self.pool) > 0: 
-      ret = self.pool[-1]
-    else:
-      ret = self.next
-    self.L_pool.release()
-    return ret
+    try:
+      if len(self.pool) == 0 and self.dbPool:
+        self.reserve()
+      if len(self.pool) > 0: 
+        ret = self.pool[-1][1]
+      else:
+        ret = self.next
+      return ret
+    finally:
+      self.L_pool.release()
 
   def ReleaseId(self, id): 
     """ Release and ID back into the pool (produce) 
@@ -98,9 +176,9 @@ class IdPool:
     :param id: Surrogate ID.
     :type id: int
     """
+    if id is None:
+      return
     self.L_pool.acquire()
-    if id < self.next: 
-      self.pool.append(id)
+    if self.dbPool or id < self.next: 
+      self.add(id)
     self.L_pool.release()
-      
-
@@ -26,7 +26,7 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import os, sys, re
+import os, sys, re, datetime
 import configparser, urlparse
 import json, psycopg2 as pgdb
 import psycopg2.extras  
@@ -34,6 +34,7 @@ import pretty
 import auth
 import notify
 import eggnog
+import cache
 
 """
   Some constants for stability calculation. 
@@ -133,8 +134,496 @@ def calculateStability(S, p_S, T_now, T_last, T_stable):
   return T_stable
 
 
+def isClassifiable(T_now, T_stable, T_last, T_modified): 
+  """ Check if a term has been stable, and unmodified, for long enough 
+      to be classified (see :data:`stabilityInterval`). 
+
+     :param T_now: Current time.
+     :type T_now: datetime.datetime
+     :param T_stable: Time since term stabilized.
+     :type T_stable: datetime.datetime or None
+     :param T_last: Time of last consensus score calculation. 
+     :type T_last: datetime.datetime
+     :param T_modified: Time the term was last modified. 
+     :type T_modified: datetime.datetime
+     :rtype: bool
+  """
+  return bool(((T_stable and ((T_now - T_stable).seconds / float(stabilityFactor)) >= stabilityInterval) \
+        or ((T_now - T_last).seconds / float(stabilityFactor)) >= stabilityInterval) \
+        and ((T_now - T_modified).seconds / float(stabilityFactor)) >= stabilityInterval)
+
+
+def calculateClass(S, votes, users): 
+  """ Classify a term that is classifiable (see :func:`isClassifiable`). 
+
+     :param S: Consensus score. 
+     :type S: float
+     :param votes: Number of up and down votes on the term. 
+     :type votes: int
+     :param users: Number of users. 
+     :type users: int
+     :returns: 'canonical', 'vernacular', or 'deprecated'.
+     :rtype: str
+  """
+  if float(votes) / users < getBracket(users):
+    return "vernacular"
+  elif S > stabilityConsensusIntervalHigh:
+    return "canonical"
+  elif S < stabilityConsensusIntervalLow: 
+    return "deprecated"
+  else: 
+    return "vernacular"
+
+
+def formatValues(cur, template, rows): 
+  """ Format rows as the body of a ``VALUES`` list, e.g. for a bulk 
+      ``UPDATE ... FROM (VALUES ...)``. 
+
+  :param cur: Cursor used to quote the values. 
+  :param template: Row template, e.g. ``(%s, %s)``. 
+  :type template: str
+  :param rows: Rows. 
+  :type rows: tuple list
+  :rtype: str
+  """
+  return ",".join(cur.mogrify(template, row) for row in rows)
+
+
+def readJSONRows(fd, chunk=65536): 
+  """ Read table rows from a file written by :func:`SeaIceConnector.Export`, 
+      either a JSON array or JSON Lines, one row at a time. The file is 
+      read *chunk* bytes at a time, so memory use doesn't depend on its size. 
+
+  :param fd: File to read. 
+  :type fd: file
+  :param chunk: Number of bytes read at a time. 
+  :type chunk: int
+  :rtype: dict iterator
+  """
+  decoder = json.JSONDecoder()
+  buf = fd.read(chunk)
+  pos = len(buf) - len(buf.lstrip())
+  while pos == len(buf): 
+    more = fd.read(chunk)
+    if not more: 
+      return
+    buf += more
+    pos = len(buf) - len(buf.lstrip())
+
+  if buf[pos] != '[': # JSON Lines
+    for line in (buf + fd.readline()).splitlines(): 
+      if line.strip(): 
+        yield json.loads(line)
+    for line in fd: 
+      if line.strip(): 
+        yield json.loads(line)
+    return
+
+  pos += 1
+  eof = False
+  while True: 
+    while pos < len(buf) and buf[pos] in ' \t\r\n,': 
+      pos += 1
+    if pos < len(buf) and buf[pos] == ']': 
+      return
+    try: 
+      if pos == len(buf): 
+        raise ValueError("no more data")
+      (row, end) = decoder.raw_decode(buf, pos)
+    except ValueError: 
+      if eof: 
+        raise
+      more = fd.read(chunk)
+      eof = not more
+      buf = buf[pos:] + more
+      pos = 0
+      continue
+    yield row
+    buf = buf[end:]
+    pos = 0
+
+
 orderOfClass = { 'deprecated' : 2, 'vernacular' : 1, 'canonical' : 0 }
 
+#: Factor by which the relevance of a search hit is scaled for each class 
+#: (see :func:`SeaIceConnector.searchPage`). 
+searchClassWeights = { 'canonical' : 1.5, 'vernacular' : 1.0, 'deprecated' : 0.5 }
+
+#: Ranking of search hits: the text relevance of the hit, scaled by the 
+#: term's consensus and class. 
+searchScore = """ts_rank_cd(t.tsv, query, 32 /* rank(rank+1) */) * (1 + t.consensus) * 
+                 CASE t.class %s ELSE 1 END""" % ' '.join(
+  [ "WHEN '%s' THEN %s" % (c, w) for (c, w) in sorted(searchClassWeights.items()) ])
+
+#: Words of a search query. Everything else, including the operators 
+#: of ``to_tsquery()``, is ignored. 
+search_word_regex = re.compile('\w+', re.UNICODE)
+
+def getSearchQuery(string, prefix=True): 
+  """ Make a text search query (see ``to_tsquery()``) matching the terms 
+      which contain every word of *string*, or (if *prefix* is set) a word 
+      that it's a prefix of. 
+
+  :param string: Search query as typed by the user. 
+  :type string: str or unicode
+  :param prefix: Whether to match words as prefixes. 
+  :type prefix: bool
+  :returns: The query, or None if *string* contains no words. 
+  :rtype: unicode or None
+  """
+  if isinstance(string, str): 
+    string = string.decode('utf-8')
+  words = search_word_regex.findall(string)
+  if not words: 
+    return None
+  return u' & '.join([ u"'%s'%s" % (word, ':*' if prefix else '') for word in words ])
+
+def escapeLike(string): 
+  """ Escape the wildcards of a ``LIKE`` pattern, so that *string* matches 
+      only itself. 
+
+  :type string: str
+  :rtype: str
+  """
+  return string.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+#: Named orderings for listings of terms (see :func:`SeaIceConnector.getAllTerms`). 
+#: Each is a list of sort expressions over ``SI.Terms`` and a direction. The 
+#: term ID is appended as a tie breaker, so that the ordering is total as 
+#: required for keyset pagination. 
+termOrderings = {
+  'recent' :       (['modified'], 'DESC'), 
+  'score' :        (['up - down', 'consensus'], 'DESC'),
+  'volatile' :     (['coalesce(T_stable, T_last)'], 'DESC'),
+  'stable' :       (['coalesce(T_stable, T_last)'], 'ASC'),
+  'alphabetical' : (['term_string'], 'ASC')
+}
+
+#: Oldest PostgreSQL server the migrations run on (9.6, for ``ADD COLUMN 
+#: IF NOT EXISTS``), in the format of ``server_version_num``. 
+MIN_SERVER_VERSION = 90600
+
+#: Schema migrations, applied in order by :func:`SeaIceConnector.migrate`. 
+#: Each is a tuple (version, description, SQL). The version of a database 
+#: is recorded in ``SI.Version``. Append new migrations to the end of the 
+#: list; never change one that has been released. 
+migrations = [
+
+  (1, "Indexes for hot lookups", """
+    CREATE INDEX IF NOT EXISTS terms_owner_id_idx 
+        ON SI.Terms (owner_id);
+    CREATE INDEX IF NOT EXISTS comments_term_id_created_idx 
+        ON SI.Comments (term_id, created);
+    CREATE INDEX IF NOT EXISTS tracking_term_id_idx 
+        ON SI.Tracking (term_id);
+    CREATE INDEX IF NOT EXISTS notify_user_id_idx 
+        ON SI_Notify.Notify (user_id);
+    CREATE INDEX IF NOT EXISTS terms_tsv_idx 
+        ON SI.Terms USING GIN (tsv);
+    CREATE INDEX IF NOT EXISTS terms_term_string_pattern_idx 
+        ON SI.Terms (term_string text_pattern_ops);"""),
+
+  (2, "Indexes for browse listings (see termOrderings)", """
+    CREATE INDEX IF NOT EXISTS terms_modified_idx 
+        ON SI.Terms (modified, id);
+    CREATE INDEX IF NOT EXISTS terms_score_idx 
+        ON SI.Terms ((up - down), consensus, id);
+    CREATE INDEX IF NOT EXISTS terms_stability_idx 
+        ON SI.Terms ((coalesce(T_stable, T_last)), id);
+    CREATE INDEX IF NOT EXISTS terms_term_string_idx 
+        ON SI.Terms (term_string, id);"""),
+
+  (3, "Primary key for notifications", """
+    ALTER TABLE SI_Notify.Notify ADD COLUMN IF NOT EXISTS id SERIAL PRIMARY KEY;
+    CREATE INDEX IF NOT EXISTS notify_user_id_t_idx 
+        ON SI_Notify.Notify (user_id, T, id);"""),
+
+  (4, "Counters maintained by triggers (number of users)", """
+    CREATE TABLE IF NOT EXISTS SI.Counters
+      (
+        name   TEXT PRIMARY KEY NOT NULL, 
+        value  BIGINT DEFAULT 0 NOT NULL
+      );
+    LOCK TABLE SI.Users IN SHARE ROW EXCLUSIVE MODE;
+    INSERT INTO SI.Counters (name, value) 
+      SELECT 'users', count(*) FROM SI.Users
+      ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;
+    CREATE OR REPLACE FUNCTION SI.count_users() RETURNS TRIGGER 
+      language plpgsql
+      as
+       $$
+        begin
+          if TG_OP = 'INSERT' then
+            update SI.Counters set value = value + 1 where name = 'users';
+          else
+            update SI.Counters set value = value - 1 where name = 'users';
+          end if;
+          return null;
+        end;
+       $$;
+    DROP TRIGGER IF EXISTS user_count ON SI.Users;
+    CREATE TRIGGER user_count
+      after insert or delete on SI.Users
+      for each row
+       execute procedure SI.count_users();"""),
+
+  (5, "Server-side scoring functions (see calculateConsensus, calculateStability)", """
+    CREATE OR REPLACE FUNCTION SI.consensus(u INTEGER, d INTEGER, t BIGINT, 
+                                            U_sum FLOAT, D_sum FLOAT) 
+      RETURNS FLOAT 
+      language sql immutable
+      as
+       $$
+        select case when u + d = 0 then 0 
+                    else (u + case when U_sum + D_sum > 0 
+                                   then U_sum / (U_sum + D_sum) 
+                                   else 0 end * (t - u - d)) / t end;
+       $$;
+    CREATE OR REPLACE FUNCTION SI.stability(S FLOAT, p_S FLOAT, 
+                                            T_now TIMESTAMP WITH TIME ZONE, 
+                                            T_last TIMESTAMP WITH TIME ZONE, 
+                                            T_stable TIMESTAMP WITH TIME ZONE, 
+                                            factor FLOAT, error FLOAT)
+      RETURNS TIMESTAMP WITH TIME ZONE
+      language plpgsql immutable
+      as
+       $$
+        declare
+          -- Whole seconds modulo one day, like datetime.timedelta.seconds. 
+          dt BIGINT := ((floor(extract(epoch from T_now - T_last))::BIGINT 
+                           % 86400) + 86400) % 86400;
+          delta_S FLOAT := 'Infinity';
+        begin
+          if dt > 0 then
+            delta_S := abs((S - p_S) * factor / dt);
+          end if;
+          if delta_S < error and T_stable is null then
+            return T_now;
+          elsif delta_S > error then
+            return null;
+          end if;
+          return T_stable;
+        end;
+       $$;"""),
+
+  (6, "Index for terms due for classification, and scheduler state", """
+    CREATE INDEX IF NOT EXISTS terms_classify_due_idx 
+        ON SI.Terms ((greatest(coalesce(T_stable, T_last), modified)), id);
+    CREATE TABLE IF NOT EXISTS SI.Schedule
+      (
+        name      TEXT PRIMARY KEY NOT NULL, 
+        last_run  TIMESTAMP WITH TIME ZONE
+      );"""),
+
+  (7, "Outbox of pending persistent ID operations", """
+    CREATE TABLE IF NOT EXISTS SI.PidOutbox
+      (
+        id            SERIAL PRIMARY KEY NOT NULL, 
+        op            TEXT NOT NULL CHECK (op IN ('bind', 'purge')), 
+        ark           TEXT NOT NULL, 
+        term_id       INTEGER, 
+        attempts      INTEGER DEFAULT 0 NOT NULL, 
+        next_attempt  TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL, 
+        last_error    TEXT, 
+        created       TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL
+      );
+    CREATE INDEX IF NOT EXISTS pid_outbox_next_attempt_idx 
+        ON SI.PidOutbox (next_attempt, id);"""),
+
+  (8, "Reservoir of pre-minted ARK identifiers", """
+    CREATE TABLE IF NOT EXISTS SI.ArkReservoir
+      (
+        ark      TEXT PRIMARY KEY NOT NULL, 
+        prod     BOOLEAN NOT NULL, 
+        created  TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL
+      );
+    CREATE INDEX IF NOT EXISTS ark_reservoir_prod_created_idx 
+        ON SI.ArkReservoir (prod, created);"""),
+
+  (9, "Trigram index for term suggestions (see suggestTerms)", """
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS terms_term_string_trgm_idx 
+        ON SI.Terms USING GIN (term_string gin_trgm_ops);"""),
+
+  (10, "Rendered text of terms and comments (see renderTerms)", """
+    ALTER TABLE SI.Terms 
+      ADD COLUMN IF NOT EXISTS term_string_text TEXT,
+      ADD COLUMN IF NOT EXISTS definition_text TEXT,
+      ADD COLUMN IF NOT EXISTS examples_text TEXT,
+      ADD COLUMN IF NOT EXISTS definition_html TEXT,
+      ADD COLUMN IF NOT EXISTS examples_html TEXT,
+      ADD COLUMN IF NOT EXISTS ref_ids TEXT[] DEFAULT '{}' NOT NULL;
+    ALTER TABLE SI.Comments 
+      ADD COLUMN IF NOT EXISTS comment_html TEXT,
+      ADD COLUMN IF NOT EXISTS ref_ids TEXT[] DEFAULT '{}' NOT NULL;
+    CREATE INDEX IF NOT EXISTS terms_ref_ids_idx 
+        ON SI.Terms USING GIN (ref_ids);
+    CREATE INDEX IF NOT EXISTS comments_ref_ids_idx 
+        ON SI.Comments USING GIN (ref_ids);
+    CREATE INDEX IF NOT EXISTS terms_unrendered_idx 
+        ON SI.Terms (id) WHERE definition_html IS NULL;
+    CREATE INDEX IF NOT EXISTS comments_unrendered_idx 
+        ON SI.Comments (id) WHERE comment_html IS NULL;
+
+    -- Storing the rendered text mustn't touch the modification time or 
+    -- the text search vector. 
+    DROP TRIGGER IF EXISTS comment_update ON SI.Comments;
+    CREATE TRIGGER comment_update
+      before update of comment_string on SI.Comments
+      for each row
+       execute procedure SI.upd_timestamp();
+    DROP TRIGGER IF EXISTS tsv_update ON SI.Terms;
+    CREATE TRIGGER tsv_update 
+      before insert or update of term_string, definition, examples on SI.Terms
+      for each row execute procedure
+        tsvector_update_trigger(tsv, 'pg_catalog.english', term_string, definition, examples);"""),
+
+  (11, "ID sequences past explicitly assigned IDs (see syncIdSequence)", """
+    SELECT setval('SI.Users_id_seq', greatest(max(id), (SELECT last_value FROM SI.Users_id_seq))) 
+      FROM SI.Users;
+    SELECT setval('SI.Terms_id_seq', greatest(max(id), (SELECT last_value FROM SI.Terms_id_seq))) 
+      FROM SI.Terms;
+    SELECT setval('SI.Comments_id_seq', greatest(max(id), (SELECT last_value FROM SI.Comments_id_seq))) 
+      FROM SI.Comments;"""),
+
+  (12, "Reset the user counter when SI.Users is truncated", """
+    CREATE OR REPLACE FUNCTION SI.reset_user_count() RETURNS TRIGGER 
+      language plpgsql
+      as
+       $$
+        begin
+          update SI.Counters set value = 0 where name = 'users';
+          return null;
+        end;
+       $$;
+    DROP TRIGGER IF EXISTS user_count_truncate ON SI.Users;
+    CREATE TRIGGER user_count_truncate
+      after truncate on SI.Users
+      for each statement
+       execute procedure SI.reset_user_count();
+    LOCK TABLE SI.Users IN SHARE ROW EXCLUSIVE MODE;
+    UPDATE SI.Counters SET value = (SELECT count(*) FROM SI.Users) 
+     WHERE name = 'users';""")
+
+]
+
+#: Hot queries and the index each is expected to use. See 
+#: :func:`SeaIceConnector.checkIndexes`. 
+hotQueries = [
+  ('terms_owner_id_idx', 
+   "SELECT id FROM SI.Terms WHERE owner_id = %s", (0,)), 
+  ('comments_term_id_created_idx', 
+   "SELECT id FROM SI.Comments WHERE term_id = %s ORDER BY created", (0,)),
+  ('tracking_term_id_idx', 
+   "SELECT user_id FROM SI.Tracking WHERE term_id = %s", (0,)), 
+  ('notify_user_id_idx', 
+   "SELECT class FROM SI_Notify.Notify WHERE user_id = %s", (0,)), 
+  ('terms_tsv_idx', 
+   "SELECT id FROM SI.Terms WHERE to_tsquery('english', %s) @@ tsv", ('metadata',)),
+  ('terms_term_string_pattern_idx', 
+   "SELECT id FROM SI.Terms WHERE term_string LIKE %s || '%%'", ('meta',)),
+  ('terms_modified_idx', 
+   "SELECT id FROM SI.Terms ORDER BY modified DESC, id DESC LIMIT 100", ()),
+  ('terms_score_idx', 
+   "SELECT id FROM SI.Terms ORDER BY up - down DESC, consensus DESC, id DESC LIMIT 100", ()),
+  ('terms_stability_idx', 
+   "SELECT id FROM SI.Terms ORDER BY coalesce(T_stable, T_last), id LIMIT 100", ()),
+  ('terms_term_string_trgm_idx', 
+   "SELECT id FROM SI.Terms WHERE term_string ILIKE %s", ('%meta%',)),
+  ('terms_ref_ids_idx', 
+   "SELECT id FROM SI.Terms WHERE ref_ids @> ARRAY[%s]", ('h1',)),
+  ('comments_ref_ids_idx', 
+   "SELECT id FROM SI.Comments WHERE ref_ids @> ARRAY[%s]", ('h1',)),
+  ('terms_unrendered_idx', 
+   "SELECT id FROM SI.Terms WHERE definition_html IS NULL ORDER BY id LIMIT 100", ()),
+  ('comments_unrendered_idx', 
+   "SELECT id FROM SI.Comments WHERE comment_html IS NULL ORDER BY id LIMIT 100", ()),
+  ('terms_term_string_idx', 
+   "SELECT id FROM SI.Terms ORDER BY term_string, id LIMIT 100", ()),
+  ('terms_classify_due_idx', 
+   """SELECT id FROM SI.Terms WHERE greatest(coalesce(T_stable, T_last), modified) > now() 
+       ORDER BY greatest(coalesce(T_stable, T_last), modified), id LIMIT 100""", ()),
+]
+
+#: Maximum number of user names kept in :data:`userNameCache`. 
+USER_NAME_CACHE_SIZE = 4096
+
+#: Process-wide cache of user names (User ID --> (first, last)) shared by 
+#: all connectors. See :func:`SeaIceConnector.getUserNameById`. 
+userNameCache = cache.LRUCache(USER_NAME_CACHE_SIZE)
+
+#: Maximum number of term pages kept in :data:`termPageCache`. 
+TERM_PAGE_CACHE_SIZE = 1024
+
+#: Time (in seconds) after which a cached term page is rendered again. 
+#: Changes made by this process are seen right away; this bounds how long 
+#: those made by others (e.g. the classification scheduler) are not. 
+TERM_PAGE_CACHE_TTL = 60
+
+#: Process-wide cache of the viewer-independent parts of term pages 
+#: (Concept ID --> page), shared by all connectors. A page depends on the 
+#: terms it references. See :func:`SeaIceConnector.getTermPage`. 
+termPageCache = cache.FragmentCache(TERM_PAGE_CACHE_SIZE, TERM_PAGE_CACHE_TTL)
+
+#: Maximum number of queries kept in :data:`searchCache`. 
+SEARCH_CACHE_SIZE = 256
+
+#: Time (in seconds) after which cached search results are recomputed, 
+#: see :data:`TERM_PAGE_CACHE_TTL`. 
+SEARCH_CACHE_TTL = 60
+
+#: Number of the best results of a query that are cached. Pages past 
+#: them are searched for every time. 
+SEARCH_CACHE_RESULTS = 500
+
+#: Process-wide cache of search results (text search query --> ranked term 
+#: IDs and the total number of results), shared by all connectors. Any 
+#: change to a term's text or votes starts a new generation. See 
+#: :func:`SeaIceConnector.searchPage`. 
+searchCache = cache.GenerationCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+#: Default number of terms classified per transaction by 
+#: :func:`SeaIceConnector.classifyDueTerms`. 
+CLASSIFY_BATCH = 500
+
+#: Default number of terms (and of comments) rendered per transaction by 
+#: :func:`SeaIceConnector.renderStale`. 
+RENDER_BATCH = 200
+
+#: Default number of suggestions returned by :func:`SeaIceConnector.suggestTerms`. 
+SUGGEST_LIMIT = 10
+
+#: Number of rows fetched from the server at a time by 
+#: :func:`SeaIceConnector.Export`. 
+EXPORT_ITERSIZE = 1000
+
+#: Number of rows inserted per statement (and per transaction) by 
+#: :func:`SeaIceConnector.Import`. 
+IMPORT_BATCH = 1000
+
+#: Time (in seconds) for which :func:`SeaIceConnector.claimPidOps` hides 
+#: the operations it hands out from other workers. 
+PID_LEASE = 300
+
+#: Time (in seconds) for which :func:`SeaIceConnector.claimArkRefill` keeps 
+#: other processes from refilling the ARK reservoir. 
+ARK_REFILL_LEASE = 300
+
+#: Default number of persistent ID operations carried out at a time by 
+#: :func:`SeaIceConnector.processPidOps`. 
+PID_BATCH = 500
+
+#: Delay (in seconds) before the first retry of a failed persistent ID 
+#: operation. It doubles with every attempt, up to :data:`PID_BACKOFF_MAX`. 
+PID_BACKOFF = 30
+
+#: Maximum delay (in seconds) between retries of a persistent ID operation. 
+PID_BACKOFF_MAX = 6 * 3600
+
+#: Consensus scores that differ by less than this are considered equal by 
+#: :func:`SeaIceConnector.checkTermConsistency`. 
+CONSISTENCY_TOLERANCE = 1e-6
+
 concept_id_regex = re.compile('/([a-zA-Z0-9]+)$')
 
 
@@ -178,12 +667,36 @@ class SeaIceConnector:
         
       self.con = pgdb.connect(database=db, user=user, password=password)
 
+    self._resetDirtyState()
+
 #    cur = self.con.cursor()
 #    cur.execute("SELECT version(); BEGIN")
   
   def __del__(self):
     self.con.close()
 
+  def _resetDirtyState(self): 
+    """ Forget what was changed in the open transaction. Called by the 
+        constructor and by :func:`commit`; connectors that don't call the 
+        constructor (see :class:`seaice.ConnectorPool.ScopedSeaIceConnector`) 
+        must call it themselves. 
+    """
+    #: IDs of users whose names were changed in the open transaction. 
+    #: Their cache entries are invalidated again on commit, in case another
+    #: connector cached the old name in the meantime. 
+    self.dirtyUserIds = set()
+
+    #: Concept IDs of terms whose pages were changed in the open transaction. 
+    #: Like :data:`dirtyUserIds`, they're invalidated again on commit. 
+    self.dirtyConceptIds = set()
+
+    #: Whether a user's name was changed in the open transaction, which 
+    #: invalidates every term page. 
+    self.dirtyTermPages = False
+
+    #: Whether terms were changed in the open transaction, which 
+    #: invalidates the cached search results. 
+    self.dirtySearches = False
 
   def createSchema(self):
     """ 
@@ -341,6 +854,71 @@ class SeaIceConnector:
           tsvector_update_trigger(tsv, 'pg_catalog.english', term_string, definition, examples);"""
     )
 
+    #: Bring the new schema up to date. 
+    self.migrate()
+
+  def getSchemaVersion(self): 
+    """ Get the version of the schema, i.e. the last migration applied. 
+
+    :rtype: int
+    """
+    cur = self.con.cursor()
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS SI.Version
+        (
+          version      INTEGER PRIMARY KEY NOT NULL, 
+          description  TEXT NOT NULL, 
+          applied      TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL
+        );
+      SELECT coalesce(max(version), 0) FROM SI.Version;""")
+    return cur.fetchone()[0]
+
+  def migrate(self): 
+    """ Apply the schema migrations that haven't been applied yet (see 
+        :data:`migrations`) and record the new schema version. Each migration 
+        is committed by itself. 
+
+    :returns: Versions that were applied. 
+    :rtype: int list
+    """
+    version = self.getSchemaVersion()
+    applied = []
+    if self.con.server_version < MIN_SERVER_VERSION and version < migrations[-1][0]:
+      print >>sys.stderr, "error (migrate): PostgreSQL %d.%d is too old; 9.6 or later is required" % (
+        self.con.server_version / 10000, self.con.server_version / 100 % 100)
+      return applied
+    cur = self.con.cursor()
+    for (v, description, sql) in migrations:
+      if v <= version:
+        continue
+      cur.execute(sql)
+      cur.execute("INSERT INTO SI.Version (version, description) VALUES (%s, %s)", 
+                  (v, description))
+      self.commit()
+      applied.append(v)
+    return applied
+
+  def checkIndexes(self): 
+    """ Check that each of the :data:`hotQueries` is able to use its index 
+        by looking for the index in the output of ``EXPLAIN``. Sequential 
+        scans are disabled for the check, since the planner prefers them on 
+        small tables. The open transaction is rolled back afterwards. 
+
+    :returns: Tuples (index, used, plan), one per query. 
+    :rtype: list
+    """
+    cur = self.con.cursor()
+    results = []
+    try:
+      cur.execute("SET LOCAL enable_seqscan = off")
+      for (index, sql, args) in hotQueries: 
+        cur.execute("EXPLAIN " + sql, args)
+        plan = '\n'.join(map(lambda row: row[0], cur.fetchall()))
+        results.append((index, index in plan, plan))
+    finally:
+      self.con.rollback()
+    return results
+
   def dropSchema(self): 
     """ Drop ``SI`` and ``SI_Notify`` schemas. """
     cur = self.con.cursor()
@@ -354,7 +932,145 @@ class SeaIceConnector:
         save changes. It should be called freuqently in a mult-threaded 
         environment. 
     """
-    return self.con.commit()
+    res = self.con.commit()
+    for id in self.dirtyUserIds:
+      userNameCache.invalidate(id)
+    for concept_id in self.dirtyConceptIds:
+      termPageCache.invalidate(concept_id)
+    if self.dirtyTermPages: 
+      termPageCache.clear()
+    if self.dirtySearches: 
+      searchCache.bump()
+    self._resetDirtyState()
+    return res
+
+  def invalidateTermPage(self, concept_id): 
+    """ Drop a term's page from :data:`termPageCache`, along with the pages 
+        that reference the term. This is done again on commit. 
+
+    :param concept_id: Concept ID. 
+    :type concept_id: str
+    """
+    if concept_id: 
+      termPageCache.invalidate(concept_id)
+      self.dirtyConceptIds.add(concept_id)
+
+  def invalidateSearches(self): 
+    """ Drop the results in :data:`searchCache`, after a term's text or 
+        votes were changed. This is done again on commit. 
+    """
+    searchCache.bump()
+    self.dirtySearches = True
+
+  def renderTerms(self, ids): 
+    """ Store the rendered text of terms: the term string, definition and 
+        examples as plain text (see :func:`seaice.pretty.processRefsAsText`) 
+        and the definition and examples as HTML (see 
+        :func:`seaice.pretty.processTagsAsHTML`), along with the concept 
+        IDs they reference. The references are resolved in one query. 
+
+    :param ids: Term IDs. 
+    :type ids: int iterable
+    :returns: Number of terms rendered. 
+    :rtype: int
+    """
+    ids = list(set(ids))
+    if not ids: 
+      return 0
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("""SELECT id, term_string, definition, examples 
+                     FROM SI.Terms WHERE id = ANY(%s)""", (ids,))
+    rows = cur.fetchall()
+    if not rows: 
+      return 0
+    refs = pretty.resolveRefs(self, *[ row[col] for row in rows 
+                                         for col in ('definition', 'examples') ])
+    values = []
+    for row in rows: 
+      values.append((row['id'], 
+                     pretty.processRefsAsText(row['term_string']), 
+                     pretty.processRefsAsText(row['definition']), 
+                     pretty.processRefsAsText(row['examples']), 
+                     pretty.processTagsAsHTML(self, row['definition'], refs=refs), 
+                     pretty.processTagsAsHTML(self, row['examples'], refs=refs), 
+                     list(pretty.getRefIds(row['definition'], row['examples']))))
+    cur.execute("""UPDATE SI.Terms AS t 
+                      SET term_string_text = v.term_string_text, 
+                          definition_text = v.definition_text, 
+                          examples_text = v.examples_text, 
+                          definition_html = v.definition_html, 
+                          examples_html = v.examples_html, 
+                          ref_ids = v.ref_ids
+                     FROM (VALUES %s) AS v (id, term_string_text, definition_text, 
+                                            examples_text, definition_html, 
+                                            examples_html, ref_ids)
+                    WHERE t.id = v.id""" % formatValues(cur, 
+                      "(%s, %s, %s, %s, %s, %s, %s::TEXT[])", values))
+    return len(values)
+
+  def renderComments(self, ids): 
+    """ Store the rendered HTML of comments, see :func:`renderTerms`. 
+
+    :param ids: Comment IDs. 
+    :type ids: int iterable
+    :returns: Number of comments rendered. 
+    :rtype: int
+    """
+    ids = list(set(ids))
+    if not ids: 
+      return 0
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("SELECT id, comment_string FROM SI.Comments WHERE id = ANY(%s)", (ids,))
+    rows = cur.fetchall()
+    if not rows: 
+      return 0
+    refs = pretty.resolveRefs(self, *[ row['comment_string'] for row in rows ])
+    values = [ (row['id'], 
+                pretty.processTagsAsHTML(self, row['comment_string'], refs=refs), 
+                list(pretty.getRefIds(row['comment_string']))) for row in rows ]
+    cur.execute("""UPDATE SI.Comments AS c 
+                      SET comment_html = v.comment_html, ref_ids = v.ref_ids
+                     FROM (VALUES %s) AS v (id, comment_html, ref_ids)
+                    WHERE c.id = v.id""" % formatValues(cur, 
+                      "(%s, %s, %s::TEXT[])", values))
+    return len(values)
+
+  def invalidateRendered(self, concept_id): 
+    """ Mark the HTML of terms and comments that reference a term as stale, 
+        after the term was added, changed or removed: the HTML of a 
+        reference includes the term's definition. They're rendered again 
+        by :func:`renderStale`. 
+
+    :param concept_id: Concept ID. 
+    :type concept_id: str
+    """
+    if concept_id: 
+      cur = self.con.cursor()
+      cur.execute("""UPDATE SI.Terms SET definition_html = NULL, examples_html = NULL 
+                      WHERE ref_ids @> ARRAY[%s]""", (concept_id,))
+      cur.execute("""UPDATE SI.Comments SET comment_html = NULL 
+                      WHERE ref_ids @> ARRAY[%s]""", (concept_id,))
+
+  def renderStale(self, limit=RENDER_BATCH): 
+    """ Render terms and comments whose HTML is missing, either because they 
+        were imported (see :func:`insertTermBatch`) or because a term they 
+        reference changed (see :func:`invalidateRendered`). Rows locked by 
+        another transaction are skipped; they're rendered on a later call. 
+        Doesn't commit. 
+
+    :param limit: Maximum number of terms, and of comments. 
+    :type limit: int
+    :returns: Number of terms and comments rendered. 
+    :rtype: int
+    """
+    cur = self.con.cursor()
+    cur.execute("""SELECT id FROM SI.Terms WHERE definition_html IS NULL 
+                    ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED""", (limit,))
+    term_ids = [ row[0] for row in cur.fetchall() ]
+    cur.execute("""SELECT id FROM SI.Comments WHERE comment_html IS NULL 
+                    ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED""", (limit,))
+    comment_ids = [ row[0] for row in cur.fetchall() ]
+    return self.renderTerms(term_ids) + self.renderComments(comment_ids)
 
   def getTime(self):
     """ Get *T_now* timestamp according to database. This is important when
@@ -434,14 +1150,7 @@ class SeaIceConnector:
 
       # create persistent ID for term if need be
       if not persistent_id or remint:
-        persistent_id = eggnog.create_persistent_id(prod_mode)
-
-      if rebind:
-        eggnog.bind_persistent_id(prod_mode,
-          eggnog.pid2ark(persistent_id),		# removes URL hostname
-          pretty.processRefsAsText(defTerm['term_string']),
-	  pretty.processRefsAsText(defTerm['definition']),
-	  pretty.processRefsAsText(defTerm['examples']))
+        persistent_id = eggnog.create_persistent_id(prod_mode, self)
 
       if not persistent_id:		# if that didn't work, bail
           print >>sys.stderr, "warning: aborting insert for id=%s -- no persistent_id" % defTerm['id']
@@ -457,6 +1166,14 @@ class SeaIceConnector:
       sql = "update si.terms set persistent_id = %s, concept_id = %s where id = %s;"
       data = (persistent_id, concept_id, id)
       cur.execute(sql, data)
+      self.invalidateTermPage(concept_id)
+      self.invalidateSearches()
+      self.invalidateRendered(concept_id)
+      self.renderTerms([id])
+
+      # bind metadata once the term is committed (see claimPidOps)
+      if rebind:
+        self.enqueuePidBind(id, eggnog.pid2ark(persistent_id))
 
       return (id, concept_id)
 
@@ -482,10 +1199,14 @@ class SeaIceConnector:
     """
 
     cur = self.con.cursor()
-    cur.execute("DELETE FROM SI.Terms WHERE id=%s RETURNING id", (id,))
+    cur.execute("DELETE FROM SI.Terms WHERE id=%s RETURNING id, concept_id", (id,))
     res = cur.fetchone()
-    # xxx catch exceptions?
-    eggnog.remove_persistent_id(prod_mode, eggnog.pid2ark(persistent_id))
+    if res: 
+      self.invalidateTermPage(res[1])
+      self.invalidateSearches()
+      self.invalidateRendered(res[1])
+    if res and persistent_id: 
+      self.enqueuePidPurge(eggnog.pid2ark(persistent_id))
 
     if res: return res[0]
     else:   return None
@@ -520,11 +1241,92 @@ class SeaIceConnector:
     cur.execute("""
         select id, owner_id, created, modified, term_string,
                definition, examples, up, down, consensus, class,
-               U_sum, D_sum, T_last, T_stable, tsv, concept_id, persistent_id
+               U_sum, D_sum, T_last, T_stable, tsv, concept_id, persistent_id,
+               definition_html, examples_html
             from SI.Terms where concept_id=%s;
         """, (concept_id,))
     return cur.fetchone()
 
+  def getTermPage(self, concept_id): 
+    """ Get the parts of a term's page that are the same for every viewer: 
+        the term, its comments, and their rendered HTML. Pages are kept in 
+        :data:`termPageCache` until the term, its comments or votes, or a 
+        term it references is changed. 
+
+    :param concept_id: Concept Id.
+    :type concept_id: str
+    :returns: Keys 'term' (see :func:`getTermByConceptId`), 'comments' (see 
+              :func:`getCommentHistory`), 'rendered_term' (see 
+              :func:`seaice.pretty.renderTerm`), and 'rendered_comments' 
+              (see :func:`seaice.pretty.renderComments`), or None if the 
+              term doesn't exist. 
+    :rtype: dict or None
+    """
+    page = termPageCache.get(concept_id)
+    if page is not None: 
+      return page
+
+    token = termPageCache.begin()
+    term = self.getTermByConceptId(concept_id)
+    if not term: 
+      return None
+    comments = list(self.getCommentHistory(term['id']))
+    strings = [ term['definition'], term['examples'] ] + \
+              [ c['comment_string'] for c in comments ]
+    # Only the text whose stored HTML is stale needs its references resolved. 
+    unrendered = []
+    if term['definition_html'] is None or term['examples_html'] is None: 
+      unrendered += [ term['definition'], term['examples'] ]
+    unrendered += [ c['comment_string'] for c in comments if c['comment_html'] is None ]
+    refs = pretty.resolveRefs(self, *unrendered)
+    page = { 'term' : term, 
+             'comments' : comments, 
+             'rendered_term' : pretty.renderTerm(self, term, refs), 
+             'rendered_comments' : pretty.renderComments(self, comments, refs) }
+    termPageCache.put(concept_id, page, token, pretty.getRefIds(*strings))
+    return page
+
+  def getTermsByConceptIds(self, concept_ids): 
+    """ Get several terms by Concept Id in one query. Only the columns 
+        needed to render a reference are returned. 
+
+    :param concept_ids: Concept Ids.
+    :type concept_ids: str iterable
+    :returns: Map from concept Id to term row. Ids not found are omitted. 
+    :rtype: dict
+    """ 
+    concept_ids = list(set(concept_ids))
+    if not concept_ids:
+      return {}
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("""
+        select id, concept_id, term_string, definition
+            from SI.Terms where concept_id = ANY(%s);
+        """, (concept_ids,))
+    return dict((row['concept_id'], row) for row in cur.fetchall())
+
+  def getTermsByIds(self, ids): 
+    """ Get several terms by ID in one query. All columns except ``tsv`` 
+        are returned. 
+
+    :param ids: Term IDs.
+    :type ids: int iterable
+    :returns: Map from term ID to term row. IDs not found are omitted. 
+    :rtype: dict
+    """ 
+    ids = list(set(ids))
+    if not ids:
+      return {}
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("""
+        select id, owner_id, created, modified, term_string,
+               definition, examples, up, down, consensus, class,
+               U_sum, D_sum, T_last, T_stable, concept_id, persistent_id,
+               term_string_text, definition_text, examples_text
+            from SI.Terms where id = ANY(%s);
+        """, (ids,))
+    return dict((row['id'], row) for row in cur.fetchall())
+
   def getTermString(self, id): 
     """ Get term string by ID.
 
@@ -577,25 +1379,85 @@ class SeaIceConnector:
     if res: return res[0]
     else:   return None
   
-  def getAllTerms(self, sortBy=None): 
-    """ Return an iterator over ``SI.Terms``. 
+  def getAllTerms(self, sortBy=None, order=None, limit=None, after=None, before=None): 
+    """ Return an iterator over ``SI.Terms``. The owner's name is joined
+        in as *owner_first_name* and *owner_last_name*. 
+
+        If *order* is given, sorting and slicing are done by the database: 
+        at most *limit* terms are returned, starting after the term *after* 
+        or ending before the term *before* (a keyset cursor). Either way the 
+        rows come back in *order*. The cost of a page doesn't depend on how 
+        far into the listing it is. If the cursor term has been removed, 
+        the first page is returned. 
 
     :param sortBy: Column by which sort the results in ascending order.
     :type sortBy: str
+    :param order: Named ordering, a key of :data:`termOrderings`. 
+    :type order: str
+    :param limit: Maximum number of terms to return. 
+    :type limit: int
+    :param after: ID of the last term of the previous page. 
+    :type after: int
+    :param before: ID of the first term of the next page. 
+    :type before: int
     :rtype: dict iterator
     """ 
     cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    if order:
+      (exprs, direction) = termOrderings[order]
+      if (after or before) and self.getTermString(after or before) is None: 
+        after = before = None # The cursor term was removed; start over. 
+      cursor = after or before
+      if before: # Walk backwards from the cursor, then restore the order. 
+        direction = 'ASC' if direction == 'DESC' else 'DESC'
+      sql = """SELECT t.id, t.owner_id, t.term_string, t.definition, t.examples, 
+                      t.modified, t.created, t.up, t.down, t.consensus, t.class,
+                      t.T_stable, t.T_last, t.concept_id, t.persistent_id,
+                      t.definition_text,
+                      u.first_name AS owner_first_name, 
+                      u.last_name AS owner_last_name
+                 FROM SI.Terms AS t
+                 LEFT JOIN SI.Users AS u ON u.id = t.owner_id"""
+      args = []
+      if cursor:
+        sql += """
+                WHERE (%s) %s (SELECT %s FROM SI.Terms WHERE id = %%s)""" % (
+          ', '.join(exprs + ['t.id']), 
+          '<' if direction == 'DESC' else '>', 
+          ', '.join(exprs + ['id']))
+        args.append(cursor)
+      sql += """
+                ORDER BY %s""" % ', '.join(
+          map(lambda expr: '%s %s' % (expr, direction), exprs + ['t.id']))
+      if limit:
+        sql += """
+                LIMIT %s"""
+        args.append(limit)
+      cur.execute(sql, args)
+      rows = cur.fetchall()
+      if before: 
+        rows.reverse()
+      for row in rows:
+        yield row
+      return
+
     if sortBy:
-      cur.execute("""SELECT id, owner_id, term_string, definition, examples, 
-                            modified, created, up, down, consensus, class,
-                            T_stable, T_last, concept_id, persistent_id
-                       FROM SI.Terms 
+      cur.execute("""SELECT t.id, t.owner_id, t.term_string, t.definition, t.examples, 
+                            t.modified, t.created, t.up, t.down, t.consensus, t.class,
+                            t.T_stable, t.T_last, t.concept_id, t.persistent_id,
+                            u.first_name AS owner_first_name, 
+                            u.last_name AS owner_last_name
+                       FROM SI.Terms AS t
+                       LEFT JOIN SI.Users AS u ON u.id = t.owner_id
                       ORDER BY %s""" % sortBy)
     else:
-      cur.execute("""SELECT id, owner_id, term_string, definition, examples, 
-                            modified, created, up, down, consensus, class,
-                            T_stable, T_last, concept_id, persistent_id
-                       FROM SI.Terms""")
+      cur.execute("""SELECT t.id, t.owner_id, t.term_string, t.definition, t.examples, 
+                            t.modified, t.created, t.up, t.down, t.consensus, t.class,
+                            t.T_stable, t.T_last, t.concept_id, t.persistent_id,
+                            u.first_name AS owner_first_name, 
+                            u.last_name AS owner_last_name
+                       FROM SI.Terms AS t
+                       LEFT JOIN SI.Users AS u ON u.id = t.owner_id""")
     for row in cur.fetchall():
       yield row
 
@@ -638,15 +1500,12 @@ class SeaIceConnector:
     :type term_string: str
     :rtype: n, term
     """
-    term_string = term_string.replace("'", "''")
     cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-    # xxx should just select 2 columns for now, right?
+    # Two rows are enough to tell whether the match is ambiguous. 
     cur.execute("""
-        select id, owner_id, created, modified, term_string,
-               definition, examples, up, down, consensus, class,
-               U_sum, D_sum, T_last, T_stable, tsv, concept_id
-            from SI.Terms where term_string like %s || '%%';
-        """, (term_string,))
+        select term_string, concept_id
+            from SI.Terms where term_string like %s || '%%' limit 2;
+        """, (escapeLike(term_string),))
     #        from SI.Terms where term_string like '%%' || %s || '%%';
     row1 = cur.fetchone()
     if not row1:			# no rows
@@ -658,6 +1517,62 @@ class SeaIceConnector:
     else:				# more than one row
       return 2, None
 
+  def getTermsByInitialTermStrings(self, term_strings): 
+    """ Search by several term strings in one query, see 
+        :func:`getTermByInitialTermString`. 
+
+    :param term_strings: The exact term strings (case sensitive). 
+    :type term_strings: str iterable
+    :returns: Map from term string to (n, term). 
+    :rtype: dict
+    """
+    term_strings = list(set(term_strings))
+    if not term_strings: 
+      return {}
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    # One subquery per string, so that each pattern is a constant that 
+    # the planner can match against the index. 
+    cur.execute(' UNION ALL '.join([ cur.mogrify("""
+        (select %s as i, term_string, concept_id
+            from SI.Terms where term_string like %s || '%%' limit 2)""", 
+        (i, escapeLike(term_string))) for (i, term_string) in enumerate(term_strings) ]))
+    rows = [ [] for term_string in term_strings ]
+    for row in cur.fetchall(): 
+      rows[row.pop('i')].append(row)
+    return dict((term_string, (len(rows[i]), rows[i][0] if len(rows[i]) == 1 else None))
+                for (i, term_string) in enumerate(term_strings))
+
+  def suggestTerms(self, string, limit=SUGGEST_LIMIT): 
+    """ Suggest terms whose term string contains *string*, ignoring case, 
+        for search-as-you-type. Term strings that start with *string* come 
+        first, then those most similar to it. Strings shorter than three 
+        characters are only matched as a prefix, since the trigram index 
+        can't narrow down shorter substrings. 
+
+    :param string: Partial term string. 
+    :type string: str or unicode
+    :param limit: Maximum number of suggestions. 
+    :type limit: int
+    :returns: Term strings and concept IDs. 
+    :rtype: dict list
+    """
+    if isinstance(string, str): 
+      string = string.decode('utf-8')
+    string = string.strip()
+    if not string: 
+      return []
+    prefix = escapeLike(string) + '%'
+    pattern = prefix if len(string) < 3 else '%' + prefix
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("""
+        SELECT term_string, concept_id
+          FROM SI.Terms
+         WHERE term_string ILIKE %s
+         ORDER BY term_string ILIKE %s DESC, similarity(term_string, %s) DESC, 
+                  term_string, id
+         LIMIT %s""", (pattern, prefix, string, limit))
+    return cur.fetchall()
+
   def getTermsByUser(self, user_id):
     """ Return an iterator over terms owned by a user. 
     
@@ -669,7 +1584,7 @@ class SeaIceConnector:
     cur.execute("""
         select id, owner_id, created, modified, term_string,
                definition, examples, up, down, consensus, class,
-               U_sum, D_sum, T_last, T_stable, tsv, concept_id
+               U_sum, D_sum, T_last, T_stable, tsv, concept_id, definition_text
             from SI.Terms where owner_id=%s
            order by term_string;
         """, (user_id,)) 
@@ -690,7 +1605,7 @@ class SeaIceConnector:
                term.term_string, term.definition, term.examples, term.up,
                term.down, term.consensus, term.class, term.U_sum, term.D_sum,
                term.T_last, term.T_stable, term.tsv, term.concept_id,
-               track.user_id, track.term_id, track.vote, track.star
+               term.definition_text, track.user_id, track.term_id, track.vote, track.star
             from SI.Terms as term, 
                  SI.Tracking as track
             where track.user_id=%s 
@@ -716,40 +1631,111 @@ class SeaIceConnector:
     for row in cur.fetchall():
       yield row[0]
 
-  def search(self, string): 
-    """ Search table by term_string, definition and examples. Rank 
-        results by relevance to query, consensus, and classificaiton.
+  def search(self, string, limit=None, offset=0, prefix=True): 
+    """ Search table by term_string, definition and examples. See 
+        :func:`searchPage`. 
 
     :param string: Search query.
     :type string: str
+    :param limit: Maximum number of results, or None for all of them. 
+    :type limit: int
+    :param offset: Number of results to skip. 
+    :type offset: int
+    :param prefix: Whether to match the words of the query as prefixes. 
+    :type prefix: bool
     :rtype: dict list
     """
-    try:
-      string = string.replace("'", "''")
-      string = ' & '.join(string.split(' '))
-      # |'s are also allowed, and paranthesis TODO
-      # xxx are we correctly insulating naive queriers?
-      cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-      cur.execute("""
-        SELECT id, owner_id, term_string, definition, examples, up, down,
-               created, modified, consensus, class, concept_id, persistent_id,
-               ts_rank_cd(tsv, query, 32 /* rank(rank+1) */ ) AS rank
-          FROM SI.Terms, to_tsquery('english', %s) query 
-          WHERE query @@ tsv 
-          ORDER BY rank DESC
-       """, (string,))
-  
-    except Exception as e:
-      print >>sys.stderr, e.pgerror
-      cur.execute("ROLLBACK;")	# else one error can wedge entire service
-      rows = []
-      return list(rows)
-    #  return None 
-    #  raise e
+    return self.searchPage(string, limit, offset, prefix)[0]
 
-    rows = sorted(cur.fetchall(), key=lambda row: orderOfClass[row['class']])
-    rows = sorted(rows, key=lambda row: row['consensus'], reverse=True)
-    return list(rows)
+  def searchPage(self, string, limit, offset=0, prefix=True): 
+    """ Search table by term_string, definition and examples, and return 
+        a page of the results with the total number of them. Unless 
+        *prefix* is unset, every word of the query is matched as a prefix 
+        (see :func:`getSearchQuery`). Results are ranked by 
+        relevance to the query, consensus, and classification (see 
+        :data:`searchScore`). 
+
+    :param string: Search query.
+    :type string: str
+    :param limit: Maximum number of results, or None for all of them. 
+    :type limit: int
+    :param offset: Number of results to skip. 
+    :type offset: int
+    :param prefix: Whether to match the words of the query as prefixes. 
+    :type prefix: bool
+    :returns: Results, best first, and the total number of results. 
+    :rtype: (dict list, int)
+    """
+    query = getSearchQuery(string, prefix)
+    if query is None: 
+      return ([], 0)
+    hits = searchCache.get(query)
+    if hits is None: 
+      generation = searchCache.begin()
+      hits = self.searchHits(query, SEARCH_CACHE_RESULTS)
+      searchCache.put(query, hits, generation)
+    (ranked, total) = hits
+    stop = total if limit is None else min(offset + limit, total)
+    if stop > len(ranked): # Past the cached results. 
+      ranked = self.searchHits(query, limit, offset)[0]
+    else: 
+      ranked = ranked[offset:stop]
+    return (self.getSearchResults(ranked), total)
+
+  def searchHits(self, query, limit, offset=0): 
+    """ Run a text search query and return the IDs and ranks of a page of 
+        the matching terms, best first (see :data:`searchScore`), with the 
+        total number of matching terms. 
+
+    :param query: Text search query, see :func:`getSearchQuery`. 
+    :type query: unicode
+    :param limit: Maximum number of results, or None for all of them. 
+    :type limit: int
+    :param offset: Number of results to skip. 
+    :type offset: int
+    :returns: (ID, rank) pairs, and the total number of results. 
+    :rtype: ((int, float) list, int)
+    """
+    cur = self.con.cursor()
+    cur.execute("""
+      SELECT t.id, %s AS rank, count(*) OVER () 
+        FROM to_tsquery('english', %%s) query, SI.Terms AS t
+       WHERE query @@ t.tsv 
+       ORDER BY rank DESC, t.id
+       LIMIT %%s OFFSET %%s""" % searchScore, (query, limit, offset))
+    rows = cur.fetchall()
+    if not rows and offset: # Past the last page; count the results. 
+      cur.execute("""SELECT count(*) 
+                       FROM to_tsquery('english', %s) query, SI.Terms AS t
+                      WHERE query @@ t.tsv""", (query,))
+      return ([], cur.fetchone()[0])
+    return ([ (id, rank) for (id, rank, total) in rows ], 
+            rows[0][2] if rows else 0)
+
+  def getSearchResults(self, hits): 
+    """ Get the terms found by a search, with the owner's name joined in as 
+        *owner_first_name* and *owner_last_name* and the rank as *rank*. 
+        Terms removed since the search are omitted. 
+
+    :param hits: (ID, rank) pairs, see :func:`searchHits`. 
+    :type hits: (int, float) list
+    :returns: Term rows in the order of *hits*. 
+    :rtype: dict list
+    """
+    if not hits: 
+      return []
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("""
+      SELECT t.id, t.owner_id, t.term_string, t.definition, t.examples, t.up, t.down,
+             t.created, t.modified, t.consensus, t.class, t.concept_id, t.persistent_id,
+             t.definition_text,
+             u.first_name AS owner_first_name, u.last_name AS owner_last_name,
+             h.rank
+        FROM unnest(%s::INTEGER[], %s::FLOAT8[]) WITH ORDINALITY AS h (id, rank, n)
+        JOIN SI.Terms AS t ON t.id = h.id
+        LEFT JOIN SI.Users AS u ON u.id = t.owner_id
+       ORDER BY h.n""", ([ id for (id, rank) in hits ], [ rank for (id, rank) in hits ]))
+    return cur.fetchall()
 
 
   def updateTerm(self, id, term, pid, prod_mode): 
@@ -767,18 +1753,279 @@ class SeaIceConnector:
     :type prod_mode:  boolean
     """ 
     cur = self.con.cursor()
-    cur.execute("UPDATE SI.Terms SET term_string=%s, definition=%s, examples=%s WHERE id=%s",
+    cur.execute("""UPDATE SI.Terms SET term_string=%s, definition=%s, examples=%s 
+                   WHERE id=%s RETURNING concept_id""",
         (term['term_string'], term['definition'], term['examples'], id))
+    res = cur.fetchone()
+    if res: 
+      self.invalidateTermPage(res[0])
+      self.invalidateSearches()
+      self.invalidateRendered(res[0])
+      self.renderTerms([id])
     if not pid:
       pid = self.getPID(id)
-    # update external binder for term
-    eggnog.bind_persistent_id(prod_mode, eggnog.pid2ark(pid),
-      # xxx drop self arg when terms all converted to new style
-      # yyy NL encoded, but CR not encoded, which is easy to mistake
-      #     (when printing) for missing or truncated bound data
-      pretty.processRefsAsText(term['term_string']),
-      pretty.processRefsAsText(term['definition']),
-      pretty.processRefsAsText(term['examples']))
+    # update external binder for term once the update is committed
+    self.enqueuePidBind(id, eggnog.pid2ark(pid))
+
+  def enqueuePidBind(self, term_id, ark): 
+    """ Queue binding a term's metadata to its persistent ID. The operation 
+        is carried out by :class:`seaice.background.PidOutboxWorker` after 
+        the transaction commits, with the term as it is at that time. 
+
+    :param term_id: Term ID. 
+    :type term_id: int
+    :param ark: ARK identifier (see :func:`seaice.eggnog.pid2ark`). 
+    :type ark: str
+    """
+    cur = self.con.cursor()
+    cur.execute("INSERT INTO SI.PidOutbox (op, ark, term_id) VALUES ('bind', %s, %s)", 
+                (ark, term_id))
+
+  def enqueuePidPurge(self, ark): 
+    """ Queue purging a persistent ID's metadata from the binder. See 
+        :func:`enqueuePidBind`. 
+
+    :param ark: ARK identifier (see :func:`seaice.eggnog.pid2ark`). 
+    :type ark: str
+    """
+    cur = self.con.cursor()
+    cur.execute("INSERT INTO SI.PidOutbox (op, ark) VALUES ('purge', %s)", (ark,))
+
+  def claimPidOps(self, limit): 
+    """ Claim persistent ID operations that are due, oldest first. They 
+        are hidden from other workers for :data:`PID_LEASE` seconds; each 
+        should be passed to :func:`completePidOps` or :func:`failPidOp` 
+        before then. Commits the claim. 
+
+    :param limit: Maximum number of operations. 
+    :type limit: int
+    :returns: Rows with keys 'id', 'op', 'ark', 'term_id', and 'attempts'. 
+    :rtype: dict list
+    """
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("""UPDATE SI.PidOutbox SET next_attempt = now() + %s * interval '1 second'
+                    WHERE id IN (SELECT id FROM SI.PidOutbox 
+                                  WHERE next_attempt <= now()
+                                  ORDER BY next_attempt, id
+                                  LIMIT %s
+                                    FOR UPDATE SKIP LOCKED)
+                RETURNING id, op, ark, term_id, attempts""", (PID_LEASE, limit))
+    ops = sorted(cur.fetchall(), key=lambda op: op['id'])
+    self.con.commit()
+    return ops
+
+  def completePidOps(self, ids): 
+    """ Remove persistent ID operations that were carried out. Commits. 
+
+    :param ids: Operation IDs. 
+    :type ids: int list
+    """
+    cur = self.con.cursor()
+    cur.execute("DELETE FROM SI.PidOutbox WHERE id = ANY(%s::INTEGER[])", (ids,))
+    self.con.commit()
+
+  def failPidOp(self, id, error): 
+    """ Schedule a failed persistent ID operation to be retried, with an 
+        exponential backoff (see :data:`PID_BACKOFF`). Commits. 
+
+    :param id: Operation ID. 
+    :type id: int
+    :param error: Why it failed. 
+    :type error: str
+    :returns: Number of attempts so far. 
+    :rtype: int
+    """
+    cur = self.con.cursor()
+    cur.execute("""UPDATE SI.PidOutbox 
+                      SET attempts = attempts + 1, last_error = %s, 
+                          next_attempt = now() + least(%s * 2 ^ attempts, %s) * interval '1 second'
+                    WHERE id = %s
+                RETURNING attempts""", (error, PID_BACKOFF, PID_BACKOFF_MAX, id))
+    res = cur.fetchone()
+    self.con.commit()
+    return res[0] if res else 0
+
+  def processPidOps(self, prod_mode, limit=PID_BATCH): 
+    """ Carry out persistent ID operations that are due (see 
+        :func:`claimPidOps`). The binds are sent to the binder in a single 
+        request (see :func:`seaice.eggnog.bindArkIdentifiers`). If the 
+        binder rejects some of them, only those fail; if it doesn't say 
+        which, they're tried one by one so that one bad term doesn't hold 
+        up the rest. If the binder can't be reached, they all fail. Binds 
+        of the same identifier are done once, and a bind whose term has 
+        been removed is dropped. Failures are retried later (see 
+        :func:`failPidOp`). 
+
+    :param prod_mode: Whether production mode is in effect.
+    :type prod_mode:  boolean
+    :param limit: Maximum number of operations. 
+    :type limit: int
+    :returns: Number of operations that were done and that failed. 
+    :rtype: (int, int)
+    """
+    done = []
+    failed = []
+    binds = {} # ARK --> bind operations
+    for op in self.claimPidOps(limit): 
+      if op['op'] == 'purge': 
+        try: 
+          eggnog.remove_persistent_id(prod_mode, op['ark'])
+          done.append(op)
+        except Exception, e: 
+          failed.append((op, e))
+      else: 
+        binds.setdefault(op['ark'], []).append(op)
+
+    terms = self.getTermsByIds([ ops[-1]['term_id'] for ops in binds.values() ])
+    self.con.commit()
+    batch = []
+    for (ark, ops) in binds.iteritems(): 
+      term = terms.get(ops[-1]['term_id'])
+      if term: 
+        # yyy NL encoded, but CR not encoded, which is easy to mistake
+        #     (when printing) for missing or truncated bound data
+        batch.append(((ark,) + tuple(
+          term[col + '_text'] if term[col + '_text'] is not None 
+            else pretty.processRefsAsText(term[col]) 
+              for col in ('term_string', 'definition', 'examples')), ops))
+      else: 
+        done += ops
+    retry = []
+    try: 
+      eggnog.bindArkIdentifiers(prod_mode, [ item for (item, ops) in batch ])
+      for (item, ops) in batch: 
+        done += ops
+    except Exception, e: 
+      # Fail the binds the binder named; if it didn't name any of them, 
+      # find the bad ones by binding one at a time. 
+      if not isinstance(e, eggnog.BinderError) or e.status != 200: 
+        for (item, ops) in batch: 
+          failed += [ (op, e) for op in ops ]
+      elif e.failed is None or not e.failed & set(binds): 
+        retry = batch
+      else: 
+        for (item, ops) in batch: 
+          if item[0] in e.failed: 
+            failed += [ (op, e) for op in ops ]
+          else: 
+            done += ops
+    for (item, ops) in retry: 
+      try: 
+        eggnog.bindArkIdentifiers(prod_mode, [item])
+        done += ops
+      except Exception, e: 
+        failed += [ (op, e) for op in ops ]
+
+    self.completePidOps([ op['id'] for op in done ])
+    for (op, e) in failed: 
+      attempts = self.failPidOp(op['id'], str(e))
+      print >>sys.stderr, "warning: %s of %s failed (attempt %d): %s" % (
+        op['op'], op['ark'], attempts, e)
+    return (len(done), len(failed))
+
+  def takeArkIdentifier(self, prod_mode): 
+    """ Take the oldest identifier from the reservoir of pre-minted ARK 
+        identifiers (see :class:`seaice.background.ArkReservoirRefiller`). 
+        If the transaction is rolled back, the identifier goes back. 
+
+    :param prod_mode: Whether production mode is in effect.
+    :type prod_mode:  boolean
+    :returns: ARK identifier, or None if the reservoir is empty. 
+    :rtype: str or None
+    """
+    cur = self.con.cursor()
+    cur.execute("""DELETE FROM SI.ArkReservoir 
+                    WHERE ark = (SELECT ark FROM SI.ArkReservoir 
+                                  WHERE prod = %s
+                                  ORDER BY created
+                                  LIMIT 1
+                                    FOR UPDATE SKIP LOCKED)
+                RETURNING ark""", (bool(prod_mode),))
+    res = cur.fetchone()
+    return res[0] if res else None
+
+  def getArkReservoirSize(self, prod_mode): 
+    """ Count the identifiers in the reservoir. 
+
+    :param prod_mode: Whether production mode is in effect.
+    :type prod_mode:  boolean
+    :rtype: int
+    """
+    cur = self.con.cursor()
+    cur.execute("SELECT count(*) FROM SI.ArkReservoir WHERE prod = %s", (bool(prod_mode),))
+    return cur.fetchone()[0]
+
+  def claimArkRefill(self, prod_mode, low, size): 
+    """ Claim the refill of the reservoir of pre-minted ARK identifiers, if 
+        it holds fewer than *low* of them. The claim is recorded in 
+        ``SI.Schedule`` and held by one process at a time, so that only 
+        one calls the minter; it should be given up with 
+        :func:`releaseArkRefill`, and lapses after :data:`ARK_REFILL_LEASE` 
+        seconds otherwise. The caller should commit right away. 
+
+    :param prod_mode: Whether production mode is in effect.
+    :type prod_mode:  boolean
+    :param low: Low watermark. 
+    :type low: int
+    :param size: Number of identifiers to refill to. 
+    :type size: int
+    :returns: Number of identifiers to mint, or 0 if the reservoir doesn't 
+              need refilling or another process is refilling it. 
+    :rtype: int
+    """
+    name = 'ark_refill_prod' if prod_mode else 'ark_refill'
+    cur = self.con.cursor()
+    cur.execute("""INSERT INTO SI.Schedule (name) VALUES (%s) 
+                   ON CONFLICT (name) DO NOTHING""", (name,))
+    cur.execute("""WITH reservoir AS (
+                     SELECT count(*) AS n FROM SI.ArkReservoir WHERE prod = %s)
+                   UPDATE SI.Schedule SET last_run = now()
+                     FROM reservoir AS r
+                    WHERE name = %s AND r.n < %s 
+                      AND (last_run IS NULL 
+                           OR last_run < now() - %s * interval '1 second')
+                RETURNING %s - r.n""", 
+      (bool(prod_mode), name, low, ARK_REFILL_LEASE, size))
+    res = cur.fetchone()
+    return res[0] if res else 0
+
+  def releaseArkRefill(self, prod_mode): 
+    """ Give up the claim of :func:`claimArkRefill`. 
+
+    :param prod_mode: Whether production mode is in effect.
+    :type prod_mode:  boolean
+    """
+    name = 'ark_refill_prod' if prod_mode else 'ark_refill'
+    cur = self.con.cursor()
+    cur.execute("UPDATE SI.Schedule SET last_run = NULL WHERE name = %s", (name,))
+
+  def addArkIdentifiers(self, prod_mode, arks): 
+    """ Put freshly minted identifiers in the reservoir. 
+
+    :param prod_mode: Whether production mode is in effect.
+    :type prod_mode:  boolean
+    :param arks: ARK identifiers. 
+    :type arks: str list
+    """
+    if arks: 
+      cur = self.con.cursor()
+      cur.execute("""INSERT INTO SI.ArkReservoir (ark, prod) VALUES %s 
+                     ON CONFLICT DO NOTHING""" % formatValues(cur, "(%s, %s)", 
+                  [ (ark, bool(prod_mode)) for ark in arks ]))
+
+  def getPidOutboxStats(self): 
+    """ Summarize the outbox of persistent ID operations. 
+
+    :returns: Keys 'pending', 'retrying' (failed at least once), and 
+              'oldest' (creation time of the oldest operation, or None). 
+    :rtype: dict
+    """
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("""SELECT count(*) AS pending, 
+                          count(*) FILTER (WHERE attempts > 0) AS retrying, 
+                          min(created) AS oldest
+                     FROM SI.PidOutbox""")
+    return cur.fetchone()
 
     ## User queries ##
 
@@ -817,6 +2064,8 @@ class SeaIceConnector:
                                          defUser['auth_id']))
       res = cur.fetchone()
       if res: 
+        userNameCache.invalidate(res[0])
+        self.dirtyUserIds.add(res[0])
         return res[0]
       else:
         return None
@@ -884,7 +2133,8 @@ class SeaIceConnector:
     return res
 
   def getUserNameById(self, id, full=False): 
-    """ Get username by ID. 
+    """ Get username by ID. Names are looked up in :data:`userNameCache` 
+        before querying the database. 
 
     :param id: User ID. 
     :type id: int
@@ -894,19 +2144,51 @@ class SeaIceConnector:
               Otherwise, just return the first name. 
     :rtype: str or None
     """
-    cur = self.con.cursor()
-    try:
-      cur.execute("SELECT first_name, last_name FROM SI.Users WHERE id=%s", (id,))
-      res = cur.fetchone()
-      if res and full: 
-        return res[0] + " " + res[1]
-      elif res and not full: 
-        return res[0]
-      else: 
-        return None
-    finally:
-      cur.close()
+    res = userNameCache.get(id)
+    if res is None:
+      cur = self.con.cursor()
+      try:
+        cur.execute("SELECT first_name, last_name FROM SI.Users WHERE id=%s", (id,))
+        res = cur.fetchone()
+      finally:
+        cur.close()
+      if res and id not in self.dirtyUserIds: 
+        userNameCache.put(id, res)
+    if res and full: 
+      return res[0] + " " + res[1]
+    elif res and not full: 
+      return res[0]
+    else: 
+      return None
   
+  def getUserNamesByIds(self, ids): 
+    """ Get the names of several users. Names are looked up in 
+        :data:`userNameCache` first; the rest are fetched in one query. 
+
+    :param ids: User IDs. 
+    :type ids: int iterable
+    :returns: Map from user ID to (first name, last name). IDs not found 
+              are omitted. 
+    :rtype: dict
+    """
+    names = {}
+    missing = []
+    for id in set(ids):
+      res = userNameCache.get(id)
+      if res is None: 
+        missing.append(id)
+      else:
+        names[id] = res
+    if missing: 
+      cur = self.con.cursor()
+      cur.execute("SELECT id, first_name, last_name FROM SI.Users WHERE id = ANY(%s)", 
+                  (missing,))
+      for (id, first, last) in cur.fetchall():
+        names[id] = (first, last)
+        if id not in self.dirtyUserIds:
+          userNameCache.put(id, (first, last))
+    return names
+
   def updateUser(self, id, first, last, enotify): 
     """ Update user's name. 
 
@@ -920,48 +2202,65 @@ class SeaIceConnector:
     cur = self.con.cursor()
     cur.execute("UPDATE SI.Users SET first_name=%s, last_name=%s, enotify='%s' WHERE id=%s",
       (first, last, enotify, id))
+    userNameCache.invalidate(id)
+    self.dirtyUserIds.add(id)
+    termPageCache.clear()
+    self.dirtyTermPages = True
 
-  def updateUserReputation(self, id, rep): 
+  def updateUserReputation(self, id, rep, commit=True): 
     """ Set reputation of user. This triggers an update of the consensus score
-        and term stability. Commit updates immediately. 
+        and term stability of every term the user has voted on, done in a 
+        single statement by the server (see ``SI.consensus`` and 
+        ``SI.stability``). The pages of those terms and the cached search 
+        results are invalidated. Commit updates immediately, unless 
+        *commit* is False. 
 
     :param id: User ID. 
     :type id: int
     :param rep: New reputation score. 
     :type rep: int
+    :param commit: Commit the transaction. 
+    :type commit: bool
     """
     cur = self.con.cursor()
-    cur.execute("SELECT now(), count(*) FROM SI.Users")
-    (T_now, t) = cur.fetchone() 
-    cur.execute("SELECT reputation FROM SI.Users WHERE id=%s", (id,)) 
-    p_rep = cur.fetchone()
-    if not p_rep:
+    cur.execute("""
+      WITH voter AS (
+        UPDATE SI.Users AS u SET reputation = %(rep)s
+          FROM SI.Users AS p
+         WHERE u.id = %(id)s AND p.id = u.id
+        RETURNING p.reputation AS p_rep), 
+      deltas AS (
+        SELECT v.term_id, 
+               CASE WHEN v.vote = 1 THEN %(rep)s - voter.p_rep ELSE 0 END AS dU,
+               CASE WHEN v.vote = -1 THEN %(rep)s - voter.p_rep ELSE 0 END AS dD
+          FROM SI.Tracking AS v, voter
+         WHERE v.user_id = %(id)s AND v.vote != 0),
+      terms AS (
+        UPDATE SI.Terms AS t
+           SET U_sum = t.U_sum + d.dU, 
+               D_sum = t.D_sum + d.dD, 
+               consensus = SI.consensus(t.up, t.down, c.value, 
+                                        t.U_sum + d.dU, t.D_sum + d.dD),
+               T_stable = SI.stability(SI.consensus(t.up, t.down, c.value, 
+                                                    t.U_sum + d.dU, t.D_sum + d.dD), 
+                                       t.consensus, now(), t.T_last, t.T_stable,
+                                       %(factor)s, %(error)s),
+               T_last = now()
+          FROM deltas AS d, SI.Counters AS c
+         WHERE t.id = d.term_id AND c.name = 'users'
+        RETURNING t.concept_id)
+      SELECT (SELECT count(*) FROM voter), (SELECT array_agg(concept_id) FROM terms)""", 
+      { 'id' : id, 'rep' : rep, 
+        'factor' : stabilityFactor, 'error' : stabilityError })
+    (found, concept_ids) = cur.fetchone()
+    for concept_id in concept_ids or []: 
+      self.invalidateTermPage(concept_id)
+    if concept_ids: 
+      self.invalidateSearches()
+    if commit: 
+      self.commit()
+    if not found: 
       return None
-    p_rep = p_rep[0]
-
-    cur.execute("""SELECT v.vote, t.id, t.up, t.down, t.U_sum, t.D_sum, 
-                          t.T_last, t.T_stable, t.consensus
-                   FROM SI.Tracking as v, 
-                        SI.Terms as t
-                   WHERE v.user_id = %s
-                     AND v.term_id = t.id
-                     AND v.vote != 0""" % (id,))
-    
-    for (vote, term_id, u, d, U_sum, D_sum, T_last, T_stable, p_S) in cur.fetchall():
-      
-      #: Compute new consensus score
-      if vote == 1:      U_sum += rep - p_rep
-      elif vote == -1:   D_sum += rep - p_rep 
-      S = calculateConsensus(u, d, t, float(U_sum), float(D_sum))
-
-      #: See if stability has changed  
-      T_stable = calculateStability(S, p_S, T_now, T_last, T_stable)
-      
-      cur.execute("""UPDATE SI.Terms SET consensus={1}, T_last='{2}', T_stable={3},
-                     U_sum={4}, D_sum={5} WHERE id={0}; COMMIT""".format(
-        term_id, S, str(T_now), repr(str(T_stable)) if T_stable else "NULL", U_sum, D_sum))
-
-    cur.execute("UPDATE SI.Users SET reputation=%d WHERE id=%d RETURNING id; COMMIT" % (rep, id))
     return id
 
 
@@ -988,15 +2287,19 @@ class SeaIceConnector:
 
     try:
       cur = self.con.cursor()
-      cur.execute("""INSERT INTO SI.Comments (id, owner_id, term_id, comment_string) 
+      cur.execute("""INSERT INTO SI.Comments AS c (id, owner_id, term_id, comment_string) 
                      VALUES (%s, %s, %s, %s)
-                     RETURNING id""", (defComment['id'],
+                     RETURNING id, (SELECT concept_id FROM SI.Terms WHERE id = c.term_id)""", 
+                                      (defComment['id'],
                                        defComment['owner_id'], 
                                        defComment['term_id'], 
                                        defComment['comment_string']))
       res = cur.fetchone()
           
-      if res: return res[0]
+      if res: 
+        self.invalidateTermPage(res[1])
+        self.renderComments([res[0]])
+        return res[0]
       else:   return None
 
    
@@ -1015,9 +2318,12 @@ class SeaIceConnector:
     :rtype: int or None
     """ 
     cur = self.con.cursor()
-    cur.execute("DELETE FROM SI.Comments WHERE id=%s RETURNING id", (id,))
+    cur.execute("""DELETE FROM SI.Comments AS c WHERE id=%s 
+                   RETURNING id, (SELECT concept_id FROM SI.Terms WHERE id = c.term_id)""", (id,))
     res = cur.fetchone()
-    if res: return res[0]
+    if res: 
+      self.invalidateTermPage(res[1])
+      return res[0]
     else:   return None
 
   def updateComment(self, id, comment):
@@ -1029,8 +2335,13 @@ class SeaIceConnector:
     :type id: dict 
     """
     cur = self.con.cursor()
-    cur.execute("UPDATE SI.Comments SET comment_string=%s WHERE id=%s", 
+    cur.execute("""UPDATE SI.Comments AS c SET comment_string=%s WHERE id=%s 
+                   RETURNING (SELECT concept_id FROM SI.Terms WHERE id = c.term_id)""", 
                  (comment['comment_string'], id))
+    res = cur.fetchone()
+    if res: 
+      self.invalidateTermPage(res[0])
+      self.renderComments([id])
 
   def getComment(self, id):
     """  Get comment by ID.
@@ -1047,7 +2358,8 @@ class SeaIceConnector:
     return cur.fetchone()
 
   def getCommentHistory(self, term_id):
-    """ Return a term's comment history, ordered by creation date.
+    """ Return a term's comment history, ordered by creation date. The 
+        owner's name is joined in as *owner_first_name* and *owner_last_name*. 
 
     :param term_id: Term ID. 
     :type term_id: int
@@ -1055,8 +2367,11 @@ class SeaIceConnector:
     """
     cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
     cur.execute("""
-        select id, owner_id, term_id, created, modified, comment_string
-            from SI.Comments where term_id=%s order by created;
+        select c.id, c.owner_id, c.term_id, c.created, c.modified, c.comment_string,
+               c.comment_html, u.first_name as owner_first_name, u.last_name as owner_last_name
+            from SI.Comments as c
+            left join SI.Users as u on u.id = c.owner_id
+           where c.term_id=%s order by c.created;
         """, (term_id,))
     for row in cur.fetchall():
       yield row
@@ -1186,8 +2501,7 @@ class SeaIceConnector:
     :type D: int --> int
     """
     cur = self.con.cursor()
-    cur.execute("SELECT COUNT(*) FROM SI.Users")
-    t = cur.fetchone()[0] # total users
+    t = self.getUserCount() # total users
     u = len(U) 
     d = len(D)
 
@@ -1215,47 +2529,50 @@ class SeaIceConnector:
     :rtype: float
     """
     cur = self.con.cursor()
-    
-    cur.execute("SELECT now(), count(*) FROM SI.Users")
-    (T_now, t) = cur.fetchone() 
-    cur.execute("SELECT reputation FROM SI.Users WHERE id=%s", (user_id,)) 
-    rep = cur.fetchone()[0]
-  
-    #: Get current state
-    cur.execute("""SELECT vote FROM SI.Tracking WHERE
-                   user_id=%s AND term_id=%s""", (user_id, term_id))
-    p_vote = cur.fetchone()
 
-    cur.execute("""SELECT up, down, U_sum, D_sum, t_last, t_stable, consensus FROM SI.Terms
-                   WHERE id=%s""", (term_id,))
-    (u, d, U_sum, D_sum, T_last, T_stable, p_S) = cur.fetchone()
-
-    #: Cast vote
-    if not p_vote:
-      cur.execute("""INSERT INTO SI.Tracking (user_id, term_id, vote)
-                     VALUES (%s, %s, %s)""", (user_id, term_id, vote))
-      p_vote = 0
-      
-    elif p_vote[0] != vote:
-      cur.execute("""UPDATE SI.Tracking SET vote=%s
-                     WHERE user_id=%s AND term_id=%s""", (vote, user_id, term_id))
-      p_vote = p_vote[0]
-
-    #: Calculate new consensus score
-    if p_vote == 1:    u -= 1; U_sum -= rep 
-    elif p_vote == -1: d -= 1; D_sum -= rep
-    if vote == 1:      u += 1; U_sum += rep
-    elif vote == -1:   d += 1; D_sum += rep
-    S = calculateConsensus(u, d, t, float(U_sum), float(D_sum))
-
-    #: Calculate stability
-    T_stable = calculateStability(S, p_S, T_now, T_last, T_stable)
-
-    #: Update term
-    cur.execute("""UPDATE SI.Terms SET consensus={1}, T_last='{2}', t_stable={3},
-                   up={4}, down={5}, U_sum={6}, D_sum={7} WHERE id={0}""".format(
-      term_id, S, str(T_now), repr(str(T_stable)) if T_stable else "NULL", u, d, U_sum, D_sum))
+    #: Lock the term row first. Concurrent votes on the term wait here, and 
+    #: then see each other's vote in SI.Tracking, so that two first votes of 
+    #: the same user aren't both counted as new. 
+    cur.execute("SELECT id FROM SI.Terms WHERE id=%s FOR UPDATE", (term_id,))
 
+    #: Cast vote, getting the previous one (0 if there wasn't one), and 
+    #: update the term's aggregates, consensus score, and stability in place 
+    #: (see ``SI.consensus`` and ``SI.stability``). 
+    cur.execute("""
+      WITH prev AS (
+        SELECT vote FROM SI.Tracking
+         WHERE user_id = %(user_id)s AND term_id = %(term_id)s), 
+      ins AS (
+        INSERT INTO SI.Tracking (user_id, term_id, vote)
+        VALUES (%(user_id)s, %(term_id)s, %(vote)s)
+        ON CONFLICT (user_id, term_id) 
+        DO UPDATE SET vote = EXCLUDED.vote), 
+      delta AS (
+        SELECT (%(vote)s = 1)::int - (p.vote = 1)::int AS dU, 
+               (%(vote)s = -1)::int - (p.vote = -1)::int AS dD
+          FROM (SELECT coalesce((SELECT vote FROM prev), 0) AS vote) AS p)
+      UPDATE SI.Terms AS t
+         SET up = t.up + d.dU, 
+             down = t.down + d.dD, 
+             U_sum = t.U_sum + d.dU * u.reputation, 
+             D_sum = t.D_sum + d.dD * u.reputation, 
+             consensus = SI.consensus(t.up + d.dU, t.down + d.dD, c.value, 
+                                      t.U_sum + d.dU * u.reputation, 
+                                      t.D_sum + d.dD * u.reputation), 
+             T_stable = SI.stability(SI.consensus(t.up + d.dU, t.down + d.dD, c.value, 
+                                                  t.U_sum + d.dU * u.reputation, 
+                                                  t.D_sum + d.dD * u.reputation), 
+                                     t.consensus, now(), t.T_last, t.T_stable, 
+                                     %(factor)s, %(error)s), 
+             T_last = now()
+        FROM delta AS d, SI.Users AS u, SI.Counters AS c
+       WHERE t.id = %(term_id)s AND u.id = %(user_id)s AND c.name = 'users'
+      RETURNING t.consensus, t.concept_id""", 
+      { 'user_id' : user_id, 'term_id' : term_id, 'vote' : vote, 
+        'factor' : stabilityFactor, 'error' : stabilityError })
+    (S, concept_id) = cur.fetchone()
+    self.invalidateTermPage(concept_id)
+    self.invalidateSearches()
     return S
 
 
@@ -1275,9 +2592,7 @@ class SeaIceConnector:
     cur.execute("SELECT owner_id, consensus, T_stable, T_last, modified, class FROM SI.Terms where id=%s", (term_id,))
     (owner_id, S, T_stable, T_last, T_modified, term_class) = cur.fetchone()
 
-    if ((T_stable and ((T_now - T_stable).seconds / float(stabilityFactor)) >= stabilityInterval) \
-        or ((T_now - T_last).seconds / float(stabilityFactor)) >= stabilityInterval) \
-        and ((T_now - T_modified).seconds / float(stabilityFactor)) >= stabilityInterval: 
+    if isClassifiable(T_now, T_stable, T_last, T_modified): 
       
       cur.execute('''SELECT count(*) 
                        FROM SI.Tracking 
@@ -1285,44 +2600,239 @@ class SeaIceConnector:
                         AND vote IN (-1, 1)''', (term_id,)) 
       (votes,) = cur.fetchone()
       
-      cur.execute("SELECT count(*) FROM SI.Users") 
-      (users,) = cur.fetchone()
-
-      if float(votes) / users < getBracket(users):
-        term_class = "vernacular"
-
-      elif S > stabilityConsensusIntervalHigh:
-        if term_class != 'canonical':
-          # Trigger a reputation gain
-          cur.execute('''SELECT reputation
-                           FROM SI.Users
-                          WHERE id=%s''', (owner_id,))
-          self.updateUserReputation(owner_id, cur.fetchone()[0] + reputationGain)
-        term_class = "canonical"
-      
-      elif S < stabilityConsensusIntervalLow: 
-        term_class = "deprecated"
+      p_class = term_class
+      term_class = calculateClass(S, votes, self.getUserCount())
 
-      else: term_class = "vernacular"
+      if term_class == 'canonical' and p_class != 'canonical':
+        # Trigger a reputation gain
+        cur.execute('''SELECT reputation
+                         FROM SI.Users
+                        WHERE id=%s''', (owner_id,))
+        self.updateUserReputation(owner_id, cur.fetchone()[0] + reputationGain)
 
     cur.execute("UPDATE SI.Terms SET class=%s WHERE id=%s", (term_class, term_id))
     return term_class 
 
   def checkTermConsistency(self, term_id):
     """ Check that a term's consensus score is consistent by scoring it the hard way.
-        Update if it wasn't. 
+        Update if it wasn't. The term row is locked until the end of the 
+        transaction, so that votes cast meanwhile aren't lost. 
 
     :rtype: bool
     """
     cur = self.con.cursor()
-    cur.execute("SELECT consensus FROM SI.Terms where id=%s" % (term_id,))
-    p_S = cur.fetchone()[0]
+    cur.execute("SELECT consensus, up, down FROM SI.Terms WHERE id=%s FOR UPDATE", (term_id,))
+    (p_S, p_u, p_d) = cur.fetchone()
     (U, V) = self.preScore(term_id)
     S = self.postScore(term_id, U, V) 
-    if int(p_S) != int(S):
+    if abs(p_S - S) > CONSISTENCY_TOLERANCE or (p_u, p_d) != (len(U), len(V)):
       return False
     return True
 
+  def getAllScores(self): 
+    """ Score all terms the hard way in one pass over ``SI.Tracking``. 
+        The result is the same as calling :func:`preScore` and 
+        :func:`postScore` for each term, but nothing is written. 
+
+    :returns: Map from term ID to (*u, d, U_sum, D_sum, S*). 
+    :rtype: dict
+    """
+    t = self.getUserCount()
+    cur = self.con.cursor()
+    cur.execute("""
+      SELECT t.id, 
+             count(v.vote) FILTER (WHERE v.vote = 1), 
+             count(v.vote) FILTER (WHERE v.vote = -1), 
+             coalesce(sum(v.reputation) FILTER (WHERE v.vote = 1), 0), 
+             coalesce(sum(v.reputation) FILTER (WHERE v.vote = -1), 0)
+        FROM SI.Terms AS t
+        LEFT JOIN (SELECT v.term_id, v.vote, u.reputation 
+                     FROM SI.Tracking AS v, SI.Users AS u
+                    WHERE v.user_id = u.id) AS v ON v.term_id = t.id
+       GROUP BY t.id""")
+    scores = {}
+    for (term_id, u, d, U_sum, D_sum) in cur.fetchall(): 
+      S = calculateConsensus(u, d, t, float(U_sum), float(D_sum))
+      scores[term_id] = (u, d, U_sum, D_sum, S)
+    return scores
+
+  def scoreAllTerms(self): 
+    """ Score all terms (see :func:`getAllScores`) and write the scores 
+        back with a single ``UPDATE``. The caller should commit. 
+
+    :returns: Map from term ID to (*u, d, U_sum, D_sum, S*). 
+    :rtype: dict
+    """
+    scores = self.getAllScores()
+    if scores: 
+      cur = self.con.cursor()
+      cur.execute("""
+        UPDATE SI.Terms AS t 
+           SET up = v.up, down = v.down, U_sum = v.U_sum, D_sum = v.D_sum, 
+               consensus = v.consensus
+          FROM (VALUES %s) AS v (id, up, down, U_sum, D_sum, consensus)
+         WHERE t.id = v.id""" % formatValues(cur, "(%s, %s, %s, %s, %s, %s::float)", 
+            [ (term_id,) + score for (term_id, score) in scores.iteritems() ]))
+    return scores
+
+  def classifyTerms(self, ids=None): 
+    """ Classify terms in one pass, as :func:`classifyTerm` does for one 
+        term at a time in order of ID, and write the classes back with a 
+        single ``UPDATE``. Owners of terms that become canonical gain 
+        reputation right away, as with :func:`classifyTerm`: this rescores 
+        the terms they voted on (see :func:`updateUserReputation`), so 
+        those that are yet to be classified are read again. The caller 
+        should commit. 
+
+    :param ids: Term IDs, or None for all terms. 
+    :type ids: int list
+    :returns: Map from term ID to class. 
+    :rtype: dict
+    """
+    users = self.getUserCount()
+    cur = self.con.cursor()
+    query = """
+      SELECT now(), t.id, t.owner_id, t.consensus, t.T_stable, t.T_last, 
+             t.modified, t.class, count(v.vote) FILTER (WHERE v.vote IN (-1, 1))
+        FROM SI.Terms AS t
+        LEFT JOIN SI.Tracking AS v ON v.term_id = t.id
+       WHERE (%(ids)s::INTEGER[] IS NULL OR t.id = ANY(%(ids)s::INTEGER[])) 
+         AND (%(voter)s::INTEGER IS NULL OR t.id IN (
+               SELECT term_id FROM SI.Tracking 
+                WHERE user_id = %(voter)s AND vote != 0))
+       GROUP BY t.id
+       ORDER BY t.id"""
+    cur.execute(query, { 'ids' : ids, 'voter' : None })
+    rows = cur.fetchall()
+    pending = dict((row[1], row) for row in rows)
+    classes = {}
+    changed = []
+    for term_id in [ row[1] for row in rows ]: 
+      (T_now, term_id, owner_id, S, T_stable, T_last, T_modified, 
+       term_class, votes) = pending.pop(term_id)
+      classes[term_id] = term_class
+      if isClassifiable(T_now, T_stable, T_last, T_modified): 
+        classes[term_id] = calculateClass(S, votes, users)
+        if classes[term_id] != term_class: 
+          changed.append((term_id, classes[term_id]))
+          if classes[term_id] == 'canonical': 
+            # Trigger a reputation gain
+            cur.execute("SELECT reputation FROM SI.Users WHERE id=%s", (owner_id,))
+            self.updateUserReputation(owner_id, cur.fetchone()[0] + reputationGain, 
+                                      commit=False)
+            if pending: 
+              cur.execute(query, { 'ids' : pending.keys(), 'voter' : owner_id })
+              for row in cur.fetchall(): 
+                pending[row[1]] = row
+    
+    if changed: 
+      cur.execute("""
+        UPDATE SI.Terms AS t SET class = v.class::SI.Class
+          FROM (VALUES %s) AS v (id, class)
+         WHERE t.id = v.id""" % formatValues(cur, "(%s, %s)", changed))
+    return classes
+
+  def classifyDueTerms(self, batch=CLASSIFY_BATCH): 
+    """ Classify the terms that have become classifiable since the last 
+        call, i.e. whose ``T_stable`` (or ``T_last``) and ``modified`` have 
+        both been :data:`stabilityInterval` in the past since then. They 
+        are found with an index range scan and classified in batches of 
+        at most *batch* terms (see :func:`classifyTerms`), one transaction 
+        per batch. The time of the last call is kept in ``SI.Schedule``. 
+
+    :param batch: Maximum number of terms per transaction. 
+    :type batch: int
+    :returns: Number of terms classified. 
+    :rtype: int
+    """
+    cur = self.con.cursor()
+    cur.execute("""INSERT INTO SI.Schedule (name) VALUES ('classify') 
+                   ON CONFLICT (name) DO NOTHING""")
+    cur.execute("SELECT now(), last_run FROM SI.Schedule WHERE name = 'classify'")
+    (T_now, T_last_run) = cur.fetchone()
+    self.con.commit()
+
+    interval = datetime.timedelta(seconds=stabilityInterval * stabilityFactor)
+    since = T_last_run - interval if T_last_run else None
+    until = T_now - interval
+    after = (since, 0)
+    count = 0
+    while True: 
+      cur.execute("""
+        SELECT greatest(coalesce(T_stable, T_last), modified), id FROM SI.Terms 
+         WHERE greatest(coalesce(T_stable, T_last), modified) <= %s 
+           AND (%s::TIMESTAMPTZ IS NULL 
+                OR (greatest(coalesce(T_stable, T_last), modified), id) > (%s::TIMESTAMPTZ, %s))
+         ORDER BY greatest(coalesce(T_stable, T_last), modified), id
+         LIMIT %s""", (until, after[0], after[0], after[1], batch))
+      rows = cur.fetchall()
+      if rows: 
+        self.classifyTerms([ id for (due, id) in rows ])
+        count += len(rows)
+        after = rows[-1]
+      if len(rows) < batch: 
+        cur.execute("UPDATE SI.Schedule SET last_run = %s WHERE name = 'classify'", (T_now,))
+      self.con.commit()
+      if len(rows) < batch: 
+        return count
+
+  def checkScoreParity(self): 
+    """ Check that :func:`getAllScores` agrees exactly with scoring each 
+        term by :func:`preScore` and :func:`calculateConsensus`, as 
+        :func:`postScore` does. Nothing is written. 
+
+    :returns: IDs of terms whose scores differ. 
+    :rtype: int list
+    """
+    t = self.getUserCount()
+    mismatched = []
+    for (term_id, batch) in sorted(self.getAllScores().iteritems()): 
+      (U, D) = self.preScore(term_id)
+      U_sum = sum(U.values())
+      D_sum = sum(D.values())
+      S = calculateConsensus(len(U), len(D), t, float(U_sum), float(D_sum))
+      if batch != (len(U), len(D), U_sum, D_sum, S): 
+        mismatched.append(term_id)
+    return mismatched
+
+  def sampleTermIds(self, count): 
+    """ Pick terms at random, e.g. for checking consistency. 
+
+    :param count: Number of terms. 
+    :type count: int
+    :rtype: int list
+    """
+    cur = self.con.cursor()
+    cur.execute("SELECT id FROM SI.Terms ORDER BY random() LIMIT %s", (count,))
+    return [ row[0] for row in cur.fetchall() ]
+
+  def getUserCount(self): 
+    """ Get the number of users. This reads a counter maintained by 
+        triggers on ``SI.Users`` rather than counting rows. 
+
+    :rtype: int
+    """
+    cur = self.con.cursor()
+    cur.execute("SELECT value FROM SI.Counters WHERE name = 'users'")
+    return cur.fetchone()[0]
+
+  def checkUserCount(self): 
+    """ Check the user counter against the number of rows in ``SI.Users``. 
+        Correct it if it's off. 
+
+    :returns: The counter and the actual number of users. 
+    :rtype: (int, int)
+    """
+    cur = self.con.cursor()
+    cur.execute("LOCK TABLE SI.Users IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute("SELECT count(*) FROM SI.Users")
+    t = cur.fetchone()[0]
+    cur.execute("""UPDATE SI.Counters AS c SET value = %s
+                     FROM SI.Counters AS p
+                    WHERE c.name = 'users' AND p.name = c.name
+                RETURNING p.value""", (t,))
+    return (cur.fetchone()[0], t)
+
     ## Notification queries ##
 
   def getUserNotifications(self, user_id):
@@ -1338,6 +2848,27 @@ class SeaIceConnector:
     for row in cur.fetchall():
       yield row
 
+  def getUserNotificationsPage(self, user_id, limit, offset=0):
+    """ Return a page of a user's notifications, most recent first. 
+
+    :param user_id: User ID. 
+    :type user_id: int
+    :param limit: Number of notifications. 
+    :type limit: int
+    :param offset: Number of notifications to skip. 
+    :type offset: int
+    :rtype: dict iterator
+    """
+    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.execute("""SELECT id, user_id, class, T, term_id, 
+                          from_user_id, term_string, enotified
+                     FROM SI_Notify.Notify
+                    WHERE user_id = %s
+                    ORDER BY T DESC, id DESC
+                    LIMIT %s OFFSET %s""", (user_id, limit, offset))
+    for row in cur.fetchall():
+      yield row
+
   def getAllNotifications(self):
     """ Return an iterator over ``SI_Notify.Notify``. 
 
@@ -1352,10 +2883,12 @@ class SeaIceConnector:
       yield row
   
   def insertNotification(self, user_id, notif):
-    """ Insert a notification. 
+    """ Insert a notification. Its primary key is assigned to *notif.id*. 
 
     :param notif: Notification. 
     :type notif: seaice.notify.BaseNotification
+    :returns: Primary key of the notification. 
+    :rtype: int
     """
     cur = self.con.cursor()
 
@@ -1363,32 +2896,53 @@ class SeaIceConnector:
     if isinstance(notif, notify.Comment):
       cur.execute("""INSERT INTO SI_Notify.Notify( class, user_id, term_id, from_user_id, 
                                                    T, term_string ) 
-                     VALUES( 'Comment', %s, %s, %s, %s, %s ); """, (
+                     VALUES( 'Comment', %s, %s, %s, %s, %s ) RETURNING id; """, (
                 user_id, notif.term_id, notif.user_id, 
                 repr(str(notif.T_notify)), notif.comment_string))
 
     elif isinstance(notif, notify.TermUpdate):
       cur.execute("""INSERT INTO SI_Notify.Notify( class, user_id, term_id, from_user_id, T ) 
-                     VALUES( 'TermUpdate', %s, %s, %s, %s ); """, (
+                     VALUES( 'TermUpdate', %s, %s, %s, %s ) RETURNING id; """, (
                 user_id, notif.term_id, notif.user_id, repr(str(notif.T_notify))))
 
     elif isinstance(notif, notify.TermRemoved):
       notif.term_string = notif.term_string.replace("'", "''")
       cur.execute("""INSERT INTO SI_Notify.Notify( class, user_id, term_string, from_user_id, T ) 
-                     VALUES( 'TermRemoved', %s, %s, %s, %s ); """, (
+                     VALUES( 'TermRemoved', %s, %s, %s, %s ) RETURNING id; """, (
                 user_id, notif.term_string, notif.user_id, repr(str(notif.T_notify)))) 
 
     else:
       cur.execute("""INSERT INTO SI_Notify.Notify( class, user_id, term_id, T )   
-                     VALUES( 'Base', %s, %s, %s ); """, (
+                     VALUES( 'Base', %s, %s, %s ) RETURNING id; """, (
                 user_id, notif.term_id, repr(str(notif.T_notify))))
+    notif.id = cur.fetchone()[0]
+    return notif.id
   
+  def removeNotificationById(self, user_id, id):
+    """ Remove a notification by its primary key. 
+
+    :param user_id: User ID, so that users can only remove their own. 
+    :type user_id: int
+    :param id: Primary key of the notification. 
+    :type id: int
+    :returns: Primary key of the removed notification. 
+    :rtype: int or None
+    """
+    cur = self.con.cursor()
+    cur.execute("""DELETE FROM SI_Notify.Notify 
+                    WHERE id=%s AND user_id=%s RETURNING id""", (id, user_id))
+    res = cur.fetchone()
+    if res: return res[0]
+    else:   return None
+
   def removeNotification(self, user_id, notif):
     """ Remove a notification.
 
     :param notif: Notification. 
     :type notif: seaice.notify.BaseNotification
     """
+    if notif.id is not None:
+      return self.removeNotificationById(user_id, notif.id)
     cur = self.con.cursor()
     print "Lonestar!"
     if isinstance(notif, notify.Comment):
@@ -1419,14 +2973,18 @@ class SeaIceConnector:
   
 
 
-  def Export(self, table, outf=None):
+  def Export(self, table, outf=None, lines=False):
     """ Export database in JSON format to *outf*. If no file name 
-        provided, dump to standard out. 
+        provided, dump to standard out. Rows are streamed from a 
+        server-side cursor, :data:`EXPORT_ITERSIZE` at a time, so memory 
+        use doesn't depend on the size of the table. 
 
     :param table: Name of table.
     :type table: str
     :param outf: Filename to output table to.
     :type outf: str
+    :param lines: Write JSON Lines (one row per line) instead of an array. 
+    :type lines: bool
     """
     if table not in ['Users', 'Terms', 'Comments', 'Tracking']:
       print >>sys.stderr, "error (export): table '%s' is not defined in the db schema" % table
@@ -1437,10 +2995,15 @@ class SeaIceConnector:
     else:
       fd = sys.stdout
 
-    cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT * FROM SI.%s" % table)
-    rows = cur.fetchall()
-    pretty.printAsJSObject(rows, fd)
+    cur = self.con.cursor('export', cursor_factory = psycopg2.extras.RealDictCursor)
+    cur.itersize = EXPORT_ITERSIZE
+    try:
+      cur.execute("SELECT * FROM SI.%s" % table)
+      pretty.printAsJSObjectStream(cur, fd, lines)
+    finally:
+      cur.close()
+    if outf: 
+      fd.close()
 
   def Truncate(self, table):
     """ Truncate database table.
@@ -1455,8 +3018,26 @@ class SeaIceConnector:
     cur = self.con.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
     cur.execute("TRUNCATE SI.%s" % table)
 
+  def syncIdSequence(self, table): 
+    """ Move a table's ID sequence past the highest assigned ID. Rows 
+        inserted with explicit IDs (e.g. by :func:`Import`) don't advance 
+        the sequence, and :class:`seaice.IdPool.IdPool` would otherwise 
+        have to skip each of them. The sequence never moves backwards. 
+
+    :param table: Name of table. 
+    :type table: str
+    """
+    assert table in ['Users', 'Terms', 'Comments']
+    cur = self.con.cursor()
+    cur.execute("""SELECT setval('SI.%s_id_seq', 
+                                 greatest(max(id), (SELECT last_value FROM SI.%s_id_seq))) 
+                     FROM SI.%s""" % (table, table, table))
+
   def Import(self, table, prod_mode, inf=None, rebind=False, remint=False): 
-    """ Import database from JSON formated *inf*.
+    """ Import database from JSON formated *inf*, either an array or JSON 
+        Lines. The file is read incrementally and rows are inserted 
+        :data:`IMPORT_BATCH` at a time. Terms are loaded first; persistent 
+        IDs are minted and bound afterwards (see :func:`bindPersistentIds`).
 
     :param table: Name of table. 
     :type table: str
@@ -1474,14 +3055,213 @@ class SeaIceConnector:
     else:
       fd = sys.stdin
 
-    for row in json.loads(fd.read()):
-      if table == "Users":
-        self.insertUser(row)
-      elif table == "Terms":
-        self.insertTerm(row, prod_mode, rebind=rebind, remint=remint)
-      elif table == "Comments":
-        self.insertComment(row)
-      elif table == "Tracking":
-        self.insertTracking(row)
+    insertBatch = { 'Users' : self.insertUserBatch, 
+                    'Terms' : self.insertTermBatch, 
+                    'Comments' : self.insertCommentBatch, 
+                    'Tracking' : self.insertTrackingBatch }[table]
+    pending = [] #: Terms that need a persistent ID to be minted or bound
+
+    def load(batch): 
+      inserted = insertBatch(batch)
+      self.commit()
+      if table == 'Terms': 
+        pending.extend([ id for (id, persistent_id) in inserted
+                            if not persistent_id or rebind or remint ])
+
+    batch = []
+    for row in readJSONRows(fd):
+      batch.append(row)
+      if len(batch) == IMPORT_BATCH: 
+        load(batch)
+        batch = []
+    if batch: 
+      load(batch)
+    if inf: 
+      fd.close()
+    if table != 'Tracking': 
+      self.syncIdSequence(table)
+
+    #: Persistent IDs are minted and bound once the rows are loaded. 
+    if pending: 
+      self.bindPersistentIds(pending, prod_mode, rebind=rebind, remint=remint)
+
+  def insertUserBatch(self, users): 
+    """ Insert users with one statement, as :func:`insertUser` does for 
+        one. Users whose ID or email address is taken are skipped. 
+
+    :param users: Default values are used for any omitted columns.
+    :type users: dict list
+    :returns: IDs of the inserted users. 
+    :rtype: int list
+    """
+    rows = []
+    for user in users: 
+      defUser = { 
+        "id" : None,
+        "email" : "nil", 
+        "last_name" : "nil", 
+        "first_name" : "nil", 
+        "reputation" : 1, 
+        "authority" : "nil",
+        "auth_id" : "nil"
+      }
+      defUser.update(user)
+      rows.append((defUser['id'], defUser['email'], defUser['last_name'], 
+                   defUser['first_name'], defUser['reputation'], 
+                   defUser['authority'], defUser['auth_id']))
+
+    cur = self.con.cursor()
+    cur.execute("""INSERT INTO SI.Users (id, email, last_name, first_name, reputation, authority, auth_id)
+                   VALUES %s
+                   ON CONFLICT DO NOTHING
+                   RETURNING id""" % formatValues(cur, 
+      "(coalesce(%s, nextval('SI.Users_id_seq')), %s, %s, %s, %s, %s, %s)", rows))
+    ids = [ row[0] for row in cur.fetchall() ]
+    for id in ids: 
+      userNameCache.invalidate(id)
+      self.dirtyUserIds.add(id)
+    if len(ids) < len(rows): 
+      print >>sys.stderr, "warning: skipped %d duplicate users" % (len(rows) - len(ids))
+    return ids
+
+  def insertTermBatch(self, terms): 
+    """ Insert terms with one statement, as :func:`insertTerm` does for one, 
+        but without minting or binding persistent IDs (see 
+        :func:`bindPersistentIds`). Terms whose ID, concept ID, or persistent 
+        ID is taken are skipped. 
+
+    :param terms: Term rows. Default values will be used for omitted columns.
+    :type terms: dict list
+    :returns: (ID, persistent ID) of each inserted term. 
+    :rtype: (int, str) list
+    """
+    rows = []
+    for term in terms: 
+      defTerm = { 
+        "id" : None,
+        "term_string" : "nil", 
+        "definition" : "nil", 
+        "examples" : "nil", 
+        "down" : 0, 
+        "up" : 0, 
+        "created" : None, 
+        "modified" : None,
+        "owner_id" : None,
+        "persistent_id" : None,
+        "concept_id" : None,
+      }
+      defTerm.update(term)
+      if defTerm['persistent_id']: 
+        m = concept_id_regex.search(defTerm['persistent_id'])
+        defTerm['concept_id'] = m.group(1) if m else None
+      rows.append((defTerm['id'], defTerm['term_string'], defTerm['definition'],
+                   defTerm['examples'], defTerm['up'], defTerm['down'],
+                   defTerm['created'], defTerm['modified'], defTerm['owner_id'],
+                   defTerm['persistent_id'] or None, defTerm['concept_id']))
+
+    cur = self.con.cursor()
+    cur.execute("""INSERT INTO SI.Terms (id, term_string, definition, examples, up, down, 
+                                         created, modified, owner_id, persistent_id, concept_id)
+                   VALUES %s
+                   ON CONFLICT DO NOTHING
+                   RETURNING id, persistent_id""" % formatValues(cur, 
+      """(coalesce(%s, nextval('SI.Terms_id_seq')), %s, %s, %s, %s, %s, 
+          coalesce(%s::timestamptz, now()), coalesce(%s::timestamptz, now()), %s, %s, %s)""", 
+      rows))
+    terms = cur.fetchall()
+    if len(terms) < len(rows): 
+      print >>sys.stderr, "warning: skipped %d duplicate terms" % (len(rows) - len(terms))
+    return terms
+
+  def bindPersistentIds(self, ids, prod_mode, rebind=False, remint=False): 
+    """ Mint persistent IDs for terms that don't have one (or for all of 
+        them if *remint* is set) and queue binding their metadata if minted 
+        or if *rebind* is set (see :func:`enqueuePidBind`). Each term is 
+        committed as soon as it's done, so that the work isn't lost if the 
+        minter fails part way. 
+
+    :param ids: Term IDs. 
+    :type ids: int list
+    :param prod_mode: Whether production mode is in effect.
+    :type prod_mode:  boolean
+    :returns: Number of terms updated. 
+    :rtype: int
+    """
+    count = 0
+    for i in range(0, len(ids), IMPORT_BATCH): 
+      for term in self.getTermsByIds(ids[i:i+IMPORT_BATCH]).values(): 
+        persistent_id = term['persistent_id']
+        if not persistent_id or remint: 
+          persistent_id = eggnog.create_persistent_id(prod_mode, self)
+          if not persistent_id: 
+            print >>sys.stderr, "warning: no persistent_id for id=%s" % term['id']
+            continue
+
+        m = concept_id_regex.search(persistent_id)
+        if not m: 
+          print >>sys.stderr, "warning: bad persistent_id=%s for id=%s" % (persistent_id, term['id'])
+          continue
+
+        cur = self.con.cursor()
+        cur.execute("UPDATE SI.Terms SET persistent_id = %s, concept_id = %s WHERE id = %s", 
+                    (persistent_id, m.group(1), term['id']))
+        self.invalidateRendered(m.group(1))
+        self.enqueuePidBind(term['id'], eggnog.pid2ark(persistent_id))
+        self.commit()
+        count += 1
+    return count
+
+  def insertCommentBatch(self, comments): 
+    """ Insert comments with one statement, as :func:`insertComment` does 
+        for one. Comments whose ID is taken are skipped. 
+
+    :param comments: Comment rows. Default values will be used for ommitted columns. 
+    :type comments: dict list
+    :returns: IDs of the inserted comments. 
+    :rtype: int list
+    """
+    rows = []
+    for comment in comments: 
+      defComment = { 
+        "id" : None,
+        "owner_id" : None, 
+        "term_id" : None, 
+        "comment_string" : "nil"
+      }
+      defComment.update(comment)
+      rows.append((defComment['id'], defComment['owner_id'], 
+                   defComment['term_id'], defComment['comment_string']))
+
+    cur = self.con.cursor()
+    cur.execute("""INSERT INTO SI.Comments (id, owner_id, term_id, comment_string) 
+                   VALUES %s
+                   ON CONFLICT DO NOTHING
+                   RETURNING id""" % formatValues(cur, 
+      "(coalesce(%s, nextval('SI.Comments_id_seq')), %s, %s, %s)", rows))
+    ids = [ row[0] for row in cur.fetchall() ]
+    if len(ids) < len(rows): 
+      print >>sys.stderr, "warning: skipped %d duplicate comments" % (len(rows) - len(ids))
+    return ids
+
+  def insertTrackingBatch(self, trackings): 
+    """ Insert tracking rows with one statement, skipping (term_id, user_id) 
+        pairs that exist. 
+
+    :param trackings: Dictionaries with keys 'user_id', 'term_id', and 'vote'. 
+    :type trackings: dict list
+    :returns: (term_id, user_id) of each inserted row. 
+    :rtype: (int, int) list
+    """
+    rows = [ (tracking['user_id'], tracking['term_id'], tracking.get('vote', 0)) 
+                for tracking in trackings ]
+    cur = self.con.cursor()
+    cur.execute("""INSERT INTO SI.Tracking (user_id, term_id, vote) 
+                   VALUES %s
+                   ON CONFLICT DO NOTHING
+                   RETURNING term_id, user_id""" % formatValues(cur, "(%s, %s, %s)", rows))
+    inserted = cur.fetchall()
+    if len(inserted) < len(rows): 
+      print >>sys.stderr, "warning: skipped %d duplicate tracking rows" % (len(rows) - len(inserted))
+    return inserted
   
 
@@ -29,7 +29,8 @@ from IdPool import *
 import notify
 import user
 
-#: The number of DB connections that will be instantiated. 
+#: The maximum number of DB connections that will be instantiated. 
+#: Connections are opened as they are needed. 
 MAX_CONNECTIONS = 18
 
 class SeaIceFlask (Flask): 
@@ -63,31 +64,24 @@ class SeaIceFlask (Flask):
     # Id pools.
     db_con = self.dbPool.getScoped()
     
-    self.userIdPool = IdPool(db_con, "Users") #: Pool for user surrogate IDs. 
-    self.termIdPool = IdPool(db_con, "Terms") #: Pool for term surrogate IDs. 
-    self.commentIdPool = IdPool(db_con, "Comments") #: Pool for comment surrogate IDs.
+    # IDs are reserved from the table sequences, so that several processes 
+    # (e.g. gunicorn workers) can serve the same database. 
+    self.userIdPool = IdPool(db_con, "Users", self.dbPool) #: Pool for user surrogate IDs. 
+    self.termIdPool = IdPool(db_con, "Terms", self.dbPool) #: Pool for term surrogate IDs. 
+    self.commentIdPool = IdPool(db_con, "Comments", self.dbPool) #: Pool for comment surrogate IDs.
      
-    #: Live User data structures. This includes storage of notifications. 
+    #: Notifications of users, loaded from the DB as they are needed. 
+    self.notificationStore = notify.NotificationStore()
+
+    #: Live User data structures. 
     self.SeaIceUsers = {}
     for row in db_con.getAllUsers():
       self.SeaIceUsers[row['id']] = user.User(row['id'], 
-                                    row['first_name'].decode('utf-8'))
-
-    # Load notifcations 
-    for (user_id, notif_class, T_notify, 
-         term_id, from_user_id, term_string,
-         enotified) in db_con.getAllNotifications():
+                                    row['first_name'].decode('utf-8'),
+                                    self.notificationStore)
+      userNameCache.put(row['id'], (row['first_name'], row['last_name']))
 
-      if notif_class == 'Base': 
-        notif = notify.BaseNotification(term_id, T_notify)
-      elif notif_class == 'Comment': 
-        notif = notify.Comment(term_id, from_user_id, term_string, T_notify)
-      elif notif_class == 'TermUpdate': 
-        notif = notify.TermUpdate(term_id, from_user_id, T_notify)
-      elif notif_class == 'TermRemoved': 
-        notif = notify.TermRemoved(from_user_id, term_string, T_notify) 
-        
-      self.SeaIceUsers[user_id].notify(notif)
+    db_con.release()
       
     
 
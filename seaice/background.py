@@ -0,0 +1,263 @@
+# background.py - periodic maintenance tasks that run in a daemon thread 
+# of the web frontend, each with a connector from the pool. 
+#
+# Copyright (c) 2013, Christopher Patton, all rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * The names of contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import sys, traceback
+from threading import Thread, Event
+import eggnog
+
+#: Default time (in seconds) between runs of the consistency sweeper. 
+SWEEP_INTERVAL = 300
+
+#: Default number of terms the consistency sweeper checks per run. 
+SWEEP_SAMPLE = 50
+
+#: Default time (in seconds) between runs of the persistent ID worker. 
+PID_INTERVAL = 5
+
+#: Default time (in seconds) between checks of the ARK reservoir. 
+ARK_INTERVAL = 30
+
+#: The ARK reservoir is refilled when it holds fewer identifiers than this. 
+ARK_LOW_WATERMARK = 20
+
+#: Number of identifiers the ARK reservoir is refilled to. 
+ARK_RESERVOIR_SIZE = 100
+
+#: Default time (in seconds) between runs of the HTML renderer. 
+RENDER_INTERVAL = 10
+
+class PeriodicTask (Thread): 
+  """ A daemon thread that calls :func:`runOnce` every *interval* seconds 
+      with a scoped connector from *dbPool*, committing afterwards. Errors 
+      are reported and rolled back; they don't stop the task. Subclasses 
+      implement :func:`runOnce`, which returns True if there's more work 
+      to do right away; it's then called again with a fresh connector, 
+      without waiting. Those that mustn't hold a connector for all of a 
+      run override :func:`step` instead. 
+
+  :param dbPool: Pool of DB connectors. 
+  :type dbPool: seaice.ConnectorPool.SeaIceConnectorPool
+  :param interval: Time (in seconds) between runs. 
+  :type interval: int
+  """
+
+  def __init__(self, dbPool, interval): 
+    Thread.__init__(self, name=self.__class__.__name__)
+    self.daemon = True
+    self.dbPool = dbPool
+    self.interval = interval
+    self.runs = 0   #: Number of completed runs. 
+    self.errors = 0 #: Number of runs that raised an exception. 
+    self.stopped = Event()
+
+  def runOnce(self, db_con): 
+    """ Do one round of work. Overridden by subclasses. 
+
+    :param db_con: Connector, committed by the caller on return. 
+    :type db_con: seaice.ConnectorPool.ScopedSeaIceConnector
+    :returns: Whether to run again without waiting. 
+    :rtype: bool
+    """
+    raise NotImplementedError
+
+  def withConnector(self, work): 
+    """ Call *work* with a scoped connector and commit, or roll back if 
+        it raises. 
+
+    :param work: Function of the connector. 
+    :type work: function
+    :returns: What *work* returns. 
+    """
+    with self.dbPool.getScoped(owner=self.name) as db_con: 
+      try:
+        res = work(db_con)
+        db_con.commit()
+      except: 
+        db_con.con.rollback()
+        raise
+    return res
+
+  def step(self): 
+    """ Do one run: call :func:`runOnce` with a connector. 
+
+    :returns: Whether to run again without waiting. 
+    :rtype: bool
+    """
+    return self.withConnector(self.runOnce)
+
+  def run(self): 
+    more = False
+    while not self.stopped.wait(0 if more else self.interval): 
+      more = False
+      try: 
+        more = self.step()
+        self.runs += 1
+      except Exception, e: 
+        self.errors += 1
+        print >>sys.stderr, "warning: %s failed: %s" % (self.name, e)
+        traceback.print_exc()
+
+  def stop(self): 
+    """ Stop the task after the current run. """ 
+    self.stopped.set()
+
+
+class ConsistencySweeper (PeriodicTask): 
+  """ Check the scores maintained incrementally by 
+      :func:`seaice.SeaIceConnector.SeaIceConnector.castVote` against 
+      scores computed the hard way (see 
+      :func:`seaice.SeaIceConnector.SeaIceConnector.checkTermConsistency`) 
+      for a random sample of terms, as well as the user counter. Drift is 
+      reported and corrected. 
+
+  :param dbPool: Pool of DB connectors. 
+  :type dbPool: seaice.ConnectorPool.SeaIceConnectorPool
+  :param interval: Time (in seconds) between runs. 
+  :type interval: int
+  :param sample: Number of terms to check per run. 
+  :type sample: int
+  """
+
+  def __init__(self, dbPool, interval=SWEEP_INTERVAL, sample=SWEEP_SAMPLE): 
+    PeriodicTask.__init__(self, dbPool, interval)
+    self.sample = sample
+    self.checked = 0 #: Number of terms checked. 
+    self.drifted = 0 #: Number of terms whose score had drifted. 
+
+  def runOnce(self, db_con): 
+    (recorded, actual) = db_con.checkUserCount()
+    if recorded != actual: 
+      print >>sys.stderr, "warning: corrected user count (%d, should be %d)" % (
+        recorded, actual)
+    db_con.commit()
+
+    for term_id in db_con.sampleTermIds(self.sample): 
+      if not db_con.checkTermConsistency(term_id): 
+        self.drifted += 1
+        print >>sys.stderr, "warning: corrected inconsistent consensus score for term %d" % term_id
+      #: Commit each term by itself so that rows aren't locked for long. 
+      db_con.commit()
+      self.checked += 1
+
+
+class PidOutboxWorker (PeriodicTask): 
+  """ Carry out the persistent ID operations (binds and purges) queued in 
+      ``SI.PidOutbox`` by term inserts, updates, and removals (see 
+      :func:`seaice.SeaIceConnector.SeaIceConnector.processPidOps`). This 
+      keeps calls to the minter's binder out of requests. Like 
+      :class:`HtmlRenderer`, each batch gets its own connector, so that a 
+      long queue doesn't hold one for long. 
+
+  :param dbPool: Pool of DB connectors. 
+  :type dbPool: seaice.ConnectorPool.SeaIceConnectorPool
+  :param prod_mode: Whether production mode is in effect.
+  :type prod_mode:  boolean
+  :param interval: Time (in seconds) between runs. 
+  :type interval: int
+  """
+
+  def __init__(self, dbPool, prod_mode, interval=PID_INTERVAL): 
+    PeriodicTask.__init__(self, dbPool, interval)
+    self.prod_mode = prod_mode
+    self.done = 0   #: Number of operations carried out. 
+    self.failed = 0 #: Number of attempts that failed. 
+
+  def runOnce(self, db_con): 
+    (done, failed) = db_con.processPidOps(self.prod_mode)
+    self.done += done
+    self.failed += failed
+    return done + failed > 0
+
+
+class ArkReservoirRefiller (PeriodicTask): 
+  """ Keep a reservoir of pre-minted ARK identifiers in ``SI.ArkReservoir``, 
+      from which new terms take their persistent IDs (see 
+      :func:`seaice.eggnog.create_persistent_id`), so that creating a term 
+      doesn't wait on the minter. When the reservoir holds fewer than 
+      *low* identifiers, it's refilled to *size* with a single request. 
+      No connector is held while waiting on the minter, and only one 
+      process refills at a time (see 
+      :func:`seaice.SeaIceConnector.SeaIceConnector.claimArkRefill`). 
+
+  :param dbPool: Pool of DB connectors. 
+  :type dbPool: seaice.ConnectorPool.SeaIceConnectorPool
+  :param prod_mode: Whether production mode is in effect.
+  :type prod_mode:  boolean
+  :param interval: Time (in seconds) between checks. 
+  :type interval: int
+  :param low: Low watermark. 
+  :type low: int
+  :param size: Number of identifiers to refill to. 
+  :type size: int
+  """
+
+  def __init__(self, dbPool, prod_mode, interval=ARK_INTERVAL, 
+                     low=ARK_LOW_WATERMARK, size=ARK_RESERVOIR_SIZE): 
+    PeriodicTask.__init__(self, dbPool, interval)
+    self.prod_mode = prod_mode
+    self.low = low
+    self.size = size
+    self.minted = 0 #: Number of identifiers minted. 
+
+  def step(self): 
+    count = self.withConnector(lambda db_con: 
+      db_con.claimArkRefill(self.prod_mode, self.low, self.size))
+    if count: 
+      arks = []
+      def store(db_con): 
+        db_con.addArkIdentifiers(self.prod_mode, arks)
+        db_con.releaseArkRefill(self.prod_mode)
+      try: 
+        arks = eggnog.mintArkIdentifiers(self.prod_mode, count)
+      finally: 
+        self.withConnector(store)
+      self.minted += len(arks)
+    return False
+
+
+class HtmlRenderer (PeriodicTask): 
+  """ Render the HTML of terms and comments that don't have it stored, 
+      i.e. those that were imported or that reference a term that has 
+      changed since (see 
+      :func:`seaice.SeaIceConnector.SeaIceConnector.renderStale`). Each 
+      batch is committed with its own connector, so that draining a large 
+      backlog (e.g. after the rendered columns were added) doesn't hold 
+      one for long. 
+
+  :param dbPool: Pool of DB connectors. 
+  :type dbPool: seaice.ConnectorPool.SeaIceConnectorPool
+  :param interval: Time (in seconds) between runs. 
+  :type interval: int
+  """
+
+  def __init__(self, dbPool, interval=RENDER_INTERVAL): 
+    PeriodicTask.__init__(self, dbPool, interval)
+    self.rendered = 0 #: Number of terms and comments rendered. 
+
+  def runOnce(self, db_con): 
+    count = db_con.renderStale()
+    self.rendered += count
+    return count > 0
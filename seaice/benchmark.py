@@ -0,0 +1,234 @@
+# benchmark.py - timing of expensive database operations against synthetic 
+# data. The data is created in the database under test and removed when 
+# the benchmark finishes; use a development database. 
+#
+# Copyright (c) 2013, Christopher Patton, all rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * The names of contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import time
+import pretty
+
+#: Numbers of votes cast by the synthetic users in :func:`benchmarkReputation`.
+REPUTATION_VOTES = [10, 1000, 100000]
+
+def createVoter(db_con, votes): 
+  """ Create a synthetic user who owns *votes* synthetic terms and has 
+      voted each of them up. The data is committed. 
+
+  :param db_con: Connection to database. 
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param votes: Number of votes. 
+  :type votes: int
+  :returns: ID of the user. 
+  :rtype: int
+  """
+  cur = db_con.con.cursor()
+  cur.execute("""INSERT INTO SI.Users (authority, auth_id, email, last_name, first_name)
+                 VALUES ('benchmark', 'benchmark', 'benchmark-' || md5(random()::text), 
+                         'Benchmark', 'Benchmark')
+                 RETURNING id""")
+  user_id = cur.fetchone()[0]
+  cur.execute("""INSERT INTO SI.Terms (owner_id, term_string, definition, examples, up, U_sum)
+                 SELECT %s, 'benchmark ' || i, '', '', 1, 1
+                   FROM generate_series(1, %s) AS i""", (user_id, votes))
+  cur.execute("""INSERT INTO SI.Tracking (user_id, term_id, vote)
+                 SELECT owner_id, id, 1 FROM SI.Terms WHERE owner_id = %s""", (user_id,))
+  db_con.commit()
+  return user_id
+
+def removeVoter(db_con, user_id): 
+  """ Remove a user created by :func:`createVoter` along with the terms. 
+
+  :param db_con: Connection to database. 
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param user_id: User ID. 
+  :type user_id: int
+  """
+  cur = db_con.con.cursor()
+  cur.execute("DELETE FROM SI.Terms WHERE owner_id = %s", (user_id,))
+  cur.execute("DELETE FROM SI.Users WHERE id = %s", (user_id,))
+  db_con.commit()
+
+def benchmarkReputation(db_con, votes=REPUTATION_VOTES, runs=3): 
+  """ Time :func:`seaice.SeaIceConnector.SeaIceConnector.updateUserReputation`
+      for users who have cast the given numbers of votes. Each change of 
+      reputation touches every term the user voted on. 
+
+  :param db_con: Connection to database. 
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param votes: Numbers of votes. 
+  :type votes: int list
+  :param runs: Number of times each update is timed; the best is reported. 
+  :type runs: int
+  :returns: Pairs (number of votes, seconds). 
+  :rtype: list
+  """
+  results = []
+  for n in votes: 
+    user_id = createVoter(db_con, n)
+    try: 
+      best = None
+      for i in range(runs): 
+        T_start = time.time()
+        db_con.updateUserReputation(user_id, 2 + i)
+        T = time.time() - T_start
+        if best is None or T < best: 
+          best = T
+      results.append((n, best))
+    finally: 
+      removeVoter(db_con, user_id)
+  return results
+
+def checkScopedWrites(pool): 
+  """ Make the writes of a request through a scoped connector from *pool* 
+      (see :func:`seaice.ConnectorPool.SeaIceConnectorPool.getScoped`) and 
+      commit them: a synthetic user renames themselves, comments on one of 
+      their terms and votes on it. The data is removed afterwards. 
+
+  :param pool: Pool of DB connectors. 
+  :type pool: seaice.ConnectorPool.SeaIceConnectorPool
+  :returns: Pairs (step, error) of the steps that failed. 
+  :rtype: list
+  """
+  failed = []
+  with pool.getScoped(owner='checkScopedWrites') as db_con: 
+    user_id = createVoter(db_con, 1)
+    try: 
+      term = list(db_con.getTermsByUser(user_id))[0]
+      comment = { 'owner_id' : user_id, 'term_id' : term['id'], 
+                  'comment_string' : 'benchmark' }
+      steps = [ 
+        ('updateUser', lambda: db_con.updateUser(user_id, 'Benchmark', 'Benchmark', False)),
+        ('insertComment', lambda: comment.update(id=db_con.insertComment(comment))), 
+        ('updateComment', lambda: db_con.updateComment(comment['id'], comment)), 
+        ('removeComment', lambda: db_con.removeComment(comment['id'])), 
+        ('castVote', lambda: db_con.castVote(user_id, term['id'], -1)), 
+        ('invalidateTermPage', lambda: db_con.invalidateTermPage('benchmark')), 
+        ('commit', lambda: db_con.commit()) ]
+      for (step, run) in steps: 
+        try: 
+          run()
+        except Exception, e: 
+          failed.append((step, str(e)))
+          db_con.con.rollback()
+    finally: 
+      removeVoter(db_con, user_id)
+  return failed
+
+#: Numbers of references in the synthetic forms of :func:`benchmarkRefsNorm`.
+REFS_NORM_REFS = [3, 30, 300]
+
+def refs_norm_two_pass(db_con, string, force=False): 
+  """ The former :func:`seaice.pretty.refs_norm`, kept as the baseline of 
+      :func:`benchmarkRefsNorm`. Simple references are promoted in one 
+      substitution pass and curly references normalized in another, 
+      looking each one up by itself. 
+  """
+  string = pretty.token_ref_regex.sub(lambda m: pretty.token_ref_norm(m), string)
+  return pretty.ref_regex.sub(lambda m: pretty.ref_norm(db_con, m, force), string)
+
+def sampleRefs(refs): 
+  """ Make *refs* synthetic references, of every kind, each with a word in 
+      front. Some are tokens inside a curly reference, e.g. 
+      ``#{t: benchmark &benchmark1}``, which :func:`refs_norm_two_pass` 
+      promoted but :func:`seaice.pretty.refs_norm` leaves as written. 
+
+  :param refs: Number of references. 
+  :type refs: int
+  :rtype: str list
+  """
+  kinds = [ '&benchmark%d', '#benchmark%d', '#{t: benchmark term %d}', 
+            '#{t: benchmark %d | h0}', '#{k: http://example.org/?a=%d }', 
+            '#{t: benchmark &benchmark%d}', '#{t: benchmark term | #benchmark%d}' ]
+  words = [ 'Some', 'words', 'around', 'the', 'references.' ]
+  return [ '%s %s' % (words[i % len(words)], kinds[i % len(kinds)] % i) 
+           for i in range(refs) ]
+
+def sampleForm(refs): 
+  """ Make the fields of a synthetic term form, whose definition and 
+      examples have the references of :func:`sampleRefs` between them. 
+
+  :param refs: Number of references. 
+  :type refs: int
+  :returns: Term string, definition, and examples. 
+  :rtype: str list
+  """
+  text = sampleRefs(refs)
+  return [ 'benchmark term', ' '.join(text[::2]), ' '.join(text[1::2]) ]
+
+class LookupCounter: 
+  """ Wraps a connector for :func:`benchmarkRefsNorm`, counting the queries 
+      made to look up references. 
+  """
+
+  def __init__(self, db_con): 
+    self.db_con = db_con
+    self.queries = 0
+
+  def getTermByInitialTermString(self, term_string): 
+    self.queries += 1
+    return self.db_con.getTermByInitialTermString(term_string)
+
+  def getTermsByInitialTermStrings(self, term_strings): 
+    self.queries += 1
+    return self.db_con.getTermsByInitialTermStrings(term_strings)
+
+def benchmarkRefsNorm(db_con, refs=REFS_NORM_REFS, runs=3): 
+  """ Time normalizing the references of a submitted term form by 
+      :func:`seaice.pretty.refs_norm_all` against the former, field by 
+      field normalization (see :func:`refs_norm_two_pass`). Each reference 
+      is also normalized by itself with both, and those whose results 
+      differ are counted; these should be just the tokens inside curly 
+      references (see :func:`sampleRefs`). Nothing is written to the 
+      database. 
+
+  :param db_con: Connection to database. 
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param refs: Numbers of references per form. 
+  :type refs: int list
+  :param runs: Number of times each form is normalized; the best is reported. 
+  :type runs: int
+  :returns: Tuples (number of references, seconds and queries of the 
+            former normalization, seconds and queries of the current one, 
+            number of references normalized differently). 
+  :rtype: list
+  """
+  results = []
+  for n in refs: 
+    fields = sampleForm(n)
+    best = [None, None]
+    for i in range(runs): 
+      for (j, normalize) in enumerate([
+          lambda con: [ refs_norm_two_pass(con, field) for field in fields ], 
+          lambda con: pretty.refs_norm_all(con, fields) ]): 
+        counter = LookupCounter(db_con)
+        T_start = time.time()
+        normalized = normalize(counter)
+        T = time.time() - T_start
+        if best[j] is None or T < best[j][0]: 
+          best[j] = (T, counter.queries, normalized)
+    differ = len(filter(lambda ref: 
+      refs_norm_two_pass(db_con, ref) != pretty.refs_norm(db_con, ref), sampleRefs(n)))
+    results.append((n, best[0][0], best[0][1], best[1][0], best[1][1], differ))
+  return results
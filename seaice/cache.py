@@ -0,0 +1,285 @@
+# cache.py - bounded, thread-safe in-process caches for SeaIce. These are
+# used to avoid querying the database for data that rarely changes, e.g.
+# user names. Each cache keeps hit and miss counters.
+#
+# Copyright (c) 2013, Christopher Patton, all rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * The names of contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+class LRUCache:
+  """
+    A thread-safe map with a bounded number of entries. When the cache
+    is full, the least recently used entry is evicted. ``None`` can't be
+    stored, since :func:`get` returns it on a miss.
+
+  :param size: Maximum number of entries.
+  :type size: int
+  """
+
+  def __init__(self, size=1024):
+    self.size = size
+    self.entries = OrderedDict()
+    self.hits = 0   #: Number of lookups that were found in the cache.
+    self.misses = 0 #: Number of lookups that weren't.
+    self.L_cache = Lock()
+
+  def get(self, key):
+    """ Look up *key*, marking it as recently used.
+
+    :returns: The cached value, or None if there isn't one.
+    """
+    self.L_cache.acquire()
+    try:
+      value = self.entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+        return None
+      self.entries[key] = value
+      self.hits += 1
+      return value
+    finally:
+      self.L_cache.release()
+
+  def put(self, key, value):
+    """ Insert or replace an entry, evicting the least recently used
+        entry if the cache is full.
+    """
+    self.L_cache.acquire()
+    try:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+    finally:
+      self.L_cache.release()
+
+  def invalidate(self, key):
+    """ Remove an entry if it's present. """
+    self.L_cache.acquire()
+    self.entries.pop(key, None)
+    self.L_cache.release()
+
+  def clear(self):
+    """ Remove all entries. The counters are kept. """
+    self.L_cache.acquire()
+    self.entries.clear()
+    self.L_cache.release()
+
+  def stats(self):
+    """ Return the cache counters.
+
+    :returns: Keys 'hits', 'misses', 'hit_rate', 'size', and 'max_size'.
+    :rtype: dict
+    """
+    self.L_cache.acquire()
+    try:
+      lookups = self.hits + self.misses
+      return { 'hits' : self.hits,
+               'misses' : self.misses,
+               'hit_rate' : float(self.hits) / lookups if lookups else 0.0,
+               'size' : len(self.entries),
+               'max_size' : self.size }
+    finally:
+      self.L_cache.release()
+
+class FragmentCache:
+  """
+    A :class:`LRUCache` of rendered page fragments that knows what each
+    fragment was rendered from. A fragment is stored together with the
+    keys it depends on besides its own; invalidating any of them drops
+    the fragment. Fragments also expire after *ttl* seconds, which bounds
+    how long changes made by other processes go unnoticed.
+
+    Rendering races with invalidation: a fragment rendered from data read
+    before a change may be stored after the change was invalidated. To
+    prevent this, get a token from :func:`begin` before reading the data
+    and pass it to :func:`put`, which drops the fragment if one of its
+    keys was invalidated in the meantime.
+
+  :param size: Maximum number of fragments.
+  :type size: int
+  :param ttl: Time (in seconds) after which a fragment expires.
+  :type ttl: int
+  """
+
+  def __init__(self, size=1024, ttl=300):
+    self.ttl = ttl
+    self.fragments = LRUCache(size) #: Key --> (T_rendered, fragment)
+    self.clock = 0        #: Incremented on every invalidation.
+    self.invalidated = {} #: Key --> clock when it was last invalidated.
+    self.cleared = 0      #: Clock when the cache was last cleared.
+    self.dependents = {}  #: Key --> keys of fragments that depend on it.
+    self.L_fragments = Lock()
+
+  def get(self, key):
+    """ Look up the fragment stored under *key*.
+
+    :returns: The fragment, or None if there isn't one or it expired.
+    """
+    entry = self.fragments.get(key)
+    if entry is None or time.time() - entry[0] > self.ttl:
+      return None
+    return entry[1]
+
+  def begin(self):
+    """ Get a token to pass to :func:`put` for a fragment about to be
+        rendered.
+    """
+    self.L_fragments.acquire()
+    try:
+      return self.clock
+    finally:
+      self.L_fragments.release()
+
+  def put(self, key, fragment, token, depends=()):
+    """ Store a fragment, unless *key* or one of *depends* was invalidated
+        since *token* was taken.
+
+    :param token: Result of :func:`begin` before rendering the fragment.
+    :type token: int
+    :param depends: Keys of the other entries the fragment depends on.
+    :returns: Whether the fragment was stored.
+    :rtype: bool
+    """
+    self.L_fragments.acquire()
+    try:
+      if token < self.cleared:
+        return False
+      for k in [key] + list(depends):
+        if self.invalidated.get(k, -1) >= token:
+          return False
+      for k in depends:
+        self.dependents.setdefault(k, set()).add(key)
+      self.fragments.put(key, (time.time(), fragment))
+      return True
+    finally:
+      self.L_fragments.release()
+
+  def invalidate(self, key):
+    """ Drop the fragment stored under *key* and those that depend on it. """
+    self.L_fragments.acquire()
+    try:
+      self.invalidated[key] = self.clock
+      self.clock += 1
+      self.fragments.invalidate(key)
+      for k in self.dependents.pop(key, ()):
+        self.fragments.invalidate(k)
+    finally:
+      self.L_fragments.release()
+
+  def clear(self):
+    """ Drop all fragments. The counters are kept. """
+    self.L_fragments.acquire()
+    try:
+      self.cleared = self.clock = self.clock + 1
+      self.invalidated.clear()
+      self.dependents.clear()
+      self.fragments.clear()
+    finally:
+      self.L_fragments.release()
+
+  def stats(self):
+    """ Return the cache counters, see :func:`LRUCache.stats`. """
+    return self.fragments.stats()
+
+class GenerationCache:
+  """
+    A :class:`LRUCache` of results that depend on too much data to track
+    what each was computed from, e.g. search results. Instead, any change
+    to the data bumps a generation counter, which drops every entry.
+    Entries also expire after *ttl* seconds, which bounds how long changes
+    made by other processes go unnoticed.
+
+    As with :class:`FragmentCache`, get the generation with :func:`begin`
+    before computing a value and pass it to :func:`put`, so that a value
+    computed from data that changed in the meantime isn't stored.
+
+  :param size: Maximum number of entries.
+  :type size: int
+  :param ttl: Time (in seconds) after which an entry expires.
+  :type ttl: int
+  """
+
+  def __init__(self, size=1024, ttl=300):
+    self.ttl = ttl
+    self.entries = LRUCache(size) #: Key --> (T_stored, value)
+    self.generation = 0 #: Incremented on every change to the data.
+    self.L_generation = Lock()
+
+  def get(self, key):
+    """ Look up *key*.
+
+    :returns: The cached value, or None if there isn't one or it expired.
+    """
+    entry = self.entries.get(key)
+    if entry is None or time.time() - entry[0] > self.ttl:
+      return None
+    return entry[1]
+
+  def begin(self):
+    """ Get the generation to pass to :func:`put` for a value about to be
+        computed.
+    """
+    self.L_generation.acquire()
+    try:
+      return self.generation
+    finally:
+      self.L_generation.release()
+
+  def put(self, key, value, generation):
+    """ Store a value, unless the generation was bumped since it was
+        computed.
+
+    :param generation: Result of :func:`begin` before computing the value.
+    :type generation: int
+    :returns: Whether the value was stored.
+    :rtype: bool
+    """
+    self.L_generation.acquire()
+    try:
+      if generation != self.generation:
+        return False
+      self.entries.put(key, (time.time(), value))
+      return True
+    finally:
+      self.L_generation.release()
+
+  def bump(self):
+    """ Start a new generation, dropping all entries. """
+    self.L_generation.acquire()
+    try:
+      self.generation += 1
+      self.entries.clear()
+    finally:
+      self.L_generation.release()
+
+  def stats(self):
+    """ Return the cache counters, see :func:`LRUCache.stats`, and the
+        generation as 'generation'.
+    """
+    stats = self.entries.stats()
+    stats['generation'] = self.generation
+    return stats
@@ -8,6 +8,11 @@ import ssl
 import auth
 import sys
 import time
+import base64
+import httplib
+import socket
+import threading
+import urlparse
 
 REALM = "yamz"
 USERNAME = "yamz"
@@ -32,6 +37,25 @@ if not PASSWORD and CONFIG.has_option(deploy, 'minter_password'):
 
 TARGET_URL_TEMPLATE = "http://yamz.net/term/concept=%s"
 
+# The minter and binder can be pointed elsewhere, e.g. at a local stub
+# server for testing.
+MINTER_URL = os.environ.get('EGGNOG_MINTER_URL')
+BINDER_URL = os.environ.get('EGGNOG_BINDER_URL')
+
+# Time (in seconds) to wait on the minter or binder before giving up.
+MINDER_TIMEOUT = 30
+
+class BinderError (Exception):
+  """ Raised when the binder doesn't acknowledge an operation. Callers that
+      queue operations (see SeaIceConnector.processPidOps) retry them. If
+      the binder named the identifiers whose commands failed, they're in
+      *failed*; otherwise it's None and any of them may have failed.
+      *status* is the binder's HTTP status. """
+  def __init__(self, message, failed=None, status=200):
+    Exception.__init__(self, message)
+    self.failed = failed
+    self.status = status
+
 _opener = None
 _minter = None
 _binder = None
@@ -52,6 +76,8 @@ def minderOpener (prod_mode):
     else:
       _minter = TEST_MINTER_URL
       _binder = TEST_BINDER_URL
+    _minter = MINTER_URL or _minter
+    _binder = BINDER_URL or _binder
   if not _opener:
     m = urllib2.HTTPPasswordMgr()
     m.add_password(REALM, _minter, USERNAME, PASSWORD)
@@ -65,21 +91,28 @@ def minderOpener (prod_mode):
 
 def mintArkIdentifier (prod_mode):
   # Returns an ARK identifier as a string (e.g., "ark:/99152/h4232").
+  return mintArkIdentifiers(prod_mode, 1)[0]
+
+def mintArkIdentifiers (prod_mode, count):
+  # Returns a list of count ARK identifiers, minted in one request.
   global _opener, _minter
   if not _opener: 
     _opener = minderOpener(prod_mode)
   c = None
   try:
-    c = _opener.open(_minter + "?mint%201")
+    c = _opener.open(_minter + "?mint%%20%d" % count, timeout=MINDER_TIMEOUT)
     r = c.readlines()
     # xxx catch assert exceptions
-    assert len(r) == 3 and r[0].startswith("s:") and r[1] == "nog-status: 0\n"
-    arkId = r[0][3:].strip()
-    assert re.match("99152/[a-z]+\d+$", arkId)
-    arkId = "ark:/" + arkId
+    assert len(r) == count + 2 and r[count] == "nog-status: 0\n"
+    arkIds = []
+    for line in r[:count]:
+      assert line.startswith("s:")
+      arkId = line[3:].strip()
+      assert re.match("99152/[a-z]+\d+$", arkId)
+      arkIds.append("ark:/" + arkId)
   finally:
     if c: c.close()
-  return arkId
+  return arkIds
  
 # encode quotes and non-visible ascii
 enc_pat = re.compile("""[%'"]|[^!-~]""")
@@ -89,51 +122,113 @@ def _encode (s):		# ^HH encodes chars (for egg :hx)
   return enc_pat.sub(lambda c: "^%02X" % ord(c.group(0)), s.encode("UTF-8"))
   # s.encode('UTF-8', 'ignore'))
 
-# XXX redo encoding to use more robust (less prone to shell quotes) @ technique
-def bindArkIdentifier (arkId, prod_mode, who, what, peek):
-  # Returns the identifier passed in as a string.
-  global _opener, _binder
+def _bindLines (arkId, who, what, peek, when):
+  # Returns the egg commands that set a term's metadata.
+  concept_id = arkId.split('/')[-1]		# xxx why concept_id here?
+  op = ':hx ' + arkId + '.set'	# all our bind operations start this way
+  d = ("%s _t " + TARGET_URL_TEMPLATE + "\n") % (op, concept_id)
+  d += "%s how %s\n" % (op, "term")		# metadata/resource type
+  d += "%s who %s\n" % (op, _encode(who))	# term label/string
+  d += "%s what %s\n" % (op, _encode(what))	# definition
+  d += "%s when %s\n" % (op, _encode(when))	# created
+  d += "%s peek %s\n" % (op, _encode(peek))	# examples
+  return d
+
+_connection = None
+_connectionLock = threading.Lock()
+
+# Identifiers in the binder's error lines, e.g. "ark:/99152/h4232" in
+# "error: ark:/99152/h4232.set: ...".
+ark_regex = re.compile("ark:/[\w/]+")
+
+def _binderConnection ():
+  # Returns a keep-alive connection to the binder, opening it if need be.
+  global _connection
+  if not _connection:
+    url = urlparse.urlsplit(_binder)
+    if url.scheme == 'https':
+      ctxt = ssl.create_default_context()
+      ctxt.check_hostname = False
+      ctxt.verify_mode = ssl.CERT_NONE
+      _connection = httplib.HTTPSConnection(url.netloc, context=ctxt,
+                                            timeout=MINDER_TIMEOUT)
+    else:
+      _connection = httplib.HTTPConnection(url.netloc, timeout=MINDER_TIMEOUT)
+  return _connection
+
+def submitBinderCommands (prod_mode, d):
+  # Sends a batch of egg commands (one per line) to the binder in one
+  # request over a kept-alive connection, reconnecting once if the server
+  # has dropped it. Raises BinderError unless every command succeeded,
+  # with the identifiers named in the error lines as its failed set if
+  # every error line names one.
+  global _opener, _connection
   if not _opener: 
     _opener = minderOpener(prod_mode)
-  # compute our own, since caller often only knows the string 'now()'
-  when = time.strftime("%Y.%m.%d_%H:%M:%S", time.gmtime())	# TEMPER-style
-  c = None
+  url = urlparse.urlsplit(_binder)
+  headers = {
+    "Content-Type" : "text/plain",
+    "Authorization" : "Basic " + base64.b64encode(
+                        "%s:%s" % (USERNAME, PASSWORD or '')),
+  }
+  _connectionLock.acquire()
   try:
-    concept_id = arkId.split('/')[-1]		# xxx why concept_id here?
-    op = ':hx ' + arkId + '.set'	# all our bind operations start this way
-    d = ("%s _t " + TARGET_URL_TEMPLATE + "\n") % (op, concept_id)
-    d += "%s how %s\n" % (op, "term")		# metadata/resource type
-    d += "%s who %s\n" % (op, _encode(who))	# term label/string
-    d += "%s what %s\n" % (op, _encode(what))	# definition
-    d += "%s when %s\n" % (op, _encode(when))	# created
-    d += "%s peek %s\n" % (op, _encode(peek))	# examples
-
-    c = _opener.open(_binder + "?-", d)
-    r = c.readlines()
-    if len(r) != 2 or r[0] != "egg-status: 0\n":
-      print >>sys.stderr, "error: bad binder return (%s), input=%s" % (
-        r[0], d)
-
+    for attempt in (1, 2):
+      try:
+        c = _binderConnection()
+        c.request("POST", url.path + "?-", d, headers)
+        resp = c.getresponse()
+        r = resp.read().splitlines()
+        break
+      except (httplib.HTTPException, socket.error):
+        if _connection: _connection.close()
+        _connection = None
+        if attempt == 2: raise
   finally:
-    if c: c.close()
+    _connectionLock.release()
+
+  if resp.status != 200:
+    raise BinderError("binder returned HTTP %d" % resp.status,
+                      status=resp.status)
+  # The binder answers with one status line for the batch, and a line
+  # for each command that failed.
+  r = [ line for line in r if line.strip() ]
+  if r == ["egg-status: 0"]:
+    return
+  errors = [ line for line in r if not line.startswith("egg-status:") ]
+  failed = set()
+  for line in errors:
+    arkIds = ark_regex.findall(line)
+    if not arkIds:		# can't tell which command failed
+      failed = None
+      break
+    failed.update(arkIds)
+  if not errors:
+    failed = None
+  raise BinderError("bad binder return (%s)" % '; '.join(r), failed)
+
+# XXX redo encoding to use more robust (less prone to shell quotes) @ technique
+def bindArkIdentifier (arkId, prod_mode, who, what, peek):
+  # Returns the identifier passed in as a string.
+  bindArkIdentifiers(prod_mode, [(arkId, who, what, peek)])
   return arkId
 
+def bindArkIdentifiers (prod_mode, terms):
+  # Binds the metadata of many identifiers in one request. terms is a list
+  # of tuples (arkId, who, what, peek). Raises BinderError if any of them
+  # failed; unless its failed set says which, the caller can retry them
+  # one by one.
+  # compute our own, since caller often only knows the string 'now()'
+  when = time.strftime("%Y.%m.%d_%H:%M:%S", time.gmtime())	# TEMPER-style
+  d = ''.join(_bindLines(arkId, who, what, peek, when)
+                for (arkId, who, what, peek) in terms)
+  if d:
+    submitBinderCommands(prod_mode, d)
+  return [ arkId for (arkId, who, what, peek) in terms ]
+
 def removeArkIdentifier (arkId, prod_mode):
   # Returns the identifier passed in as a string.
-  global _opener, _binder
-  if not _opener: 
-    _opener = minderOpener(prod_mode)
-  c = None
-  try:
-    d = ':hx ' + arkId + ".purge\n"
-    c = _opener.open(_binder + "?-", d)
-    r = c.readlines()
-    if len(r) != 2 or r[0] != "egg-status: 0\n":
-      print >>sys.stderr, "error: purge: bad binder return (%s), input=%s" % (
-        r[0], d)
-
-  finally:
-    if c: c.close()
+  submitBinderCommands(prod_mode, ':hx ' + arkId + ".purge\n")
   return arkId
 
 _resolver_base = 'http://n2t.net/'
@@ -145,8 +240,13 @@ def ark2pid (ark):
 def pid2ark (pid):
   return pid[_resolver_base_len:]	# remove URL base
 
-def create_persistent_id (prod_mode):
-  arkId = mintArkIdentifier(prod_mode)
+def create_persistent_id (prod_mode, db_con=None):
+  # Take a pre-minted identifier from the reservoir in the database, if a
+  # connector is given (see SeaIceConnector.takeArkIdentifier); mint one
+  # if the reservoir is empty.
+  arkId = db_con.takeArkIdentifier(prod_mode) if db_con else None
+  if not arkId:
+    arkId = mintArkIdentifier(prod_mode)
   return ark2pid(arkId)
 
 def bind_persistent_id (prod_mode, arkId, who, what, peek):
@@ -24,6 +24,19 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import pretty
+import cache
+import time
+from threading import Lock
+
+#: Number of notifications loaded per page. 
+NOTIFY_PAGE_SIZE = 50
+
+#: Number of users whose notifications are kept in memory. 
+NOTIFY_CACHE_SIZE = 256
+
+#: Time (in seconds) after which a user's notifications are reloaded, since 
+#: other processes may have added some in the meantime. 
+NOTIFY_CACHE_TTL = 60
 
 class BaseNotification: 
   """ Base class for notifications in the SeaIce web interface Each sub class 
@@ -41,6 +54,7 @@ class BaseNotification:
   def __init__(self, term_id, T_notify): 
     self.term_id = term_id
     self.T_notify = T_notify
+    self.id = None #: Primary key in ``SI_Notify.Notify``, once stored. 
 
   def __str__(self):
     return 'Id=%d at %s' % (self.term_id, self.T_notify)
@@ -198,3 +212,153 @@ class TermRemoved(BaseNotification):
               pretty.printPrettyDate(self.T_notify), user, self.term_string)
 
 
+class NotificationBatch:
+  """ Data needed to render a batch of notifications, fetched with one query
+      for the terms and one for the user names. It answers the lookups that 
+      the notifications make of a DB connector (:func:`getTerm` and 
+      :func:`getUserNameById`), so it can be passed to 
+      :func:`BaseNotification.getAsHTML` and friends in place of one. 
+
+      :param db_con: Connection to database. 
+      :type db_con: seaice.SeaIceConnector.SeaIceConnector
+      :param notifications: Notifications to be rendered. 
+      :type notifications: seaice.notify.BaseNotification list
+  """
+
+  def __init__(self, db_con, notifications):
+    self.terms = db_con.getTermsByIds(
+      [ notif.term_id for notif in notifications if notif.term_id is not None ])
+    self.users = db_con.getUserNamesByIds(
+      [ notif.user_id for notif in notifications if getattr(notif, 'user_id', None) is not None ])
+
+  def getTerm(self, id): 
+    return self.terms.get(id)
+
+  def getUserNameById(self, id, full=False): 
+    res = self.users.get(id)
+    if res and full: 
+      return res[0] + " " + res[1]
+    elif res and not full: 
+      return res[0]
+    else: 
+      return None
+
+
+def getNotificationsAsHTML(db_con, notifications): 
+  """ Render notifications as HTML with two queries in all. Notifications 
+      whose term or user no longer exists are left out. 
+
+  :param db_con: Connection to database. 
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param notifications: Notifications. 
+  :type notifications: seaice.notify.BaseNotification list
+  :returns: Pairs (notification, HTML-formatted string). 
+  :rtype: list
+  """
+  batch = NotificationBatch(db_con, notifications)
+  result = []
+  for notif in notifications: 
+    html = notif.getAsHTML(batch)
+    if html: 
+      result.append((notif, html))
+  return result
+
+def getNotificationsAsPlaintext(db_con, notifications): 
+  """ Render notifications as plain text with two queries in all. 
+      Notifications whose term or user no longer exists are left out. 
+
+  :param db_con: Connection to database. 
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param notifications: Notifications. 
+  :type notifications: seaice.notify.BaseNotification list
+  :returns: Pairs (notification, string). 
+  :rtype: list
+  """
+  batch = NotificationBatch(db_con, notifications)
+  result = []
+  for notif in notifications: 
+    text = notif.getAsPlaintext(batch)
+    if text: 
+      result.append((notif, text))
+  return result
+
+
+def getNotificationFromRow(row):
+  """ Make a notification object from a row of ``SI_Notify.Notify``. 
+
+  :param row: Table row. 
+  :type row: dict
+  :rtype: seaice.notify.BaseNotification
+  """
+  if row['class'] == 'Comment': 
+    notif = Comment(row['term_id'], row['from_user_id'], row['term_string'], row['t'])
+  elif row['class'] == 'TermUpdate': 
+    notif = TermUpdate(row['term_id'], row['from_user_id'], row['t'])
+  elif row['class'] == 'TermRemoved': 
+    notif = TermRemoved(row['from_user_id'], row['term_string'], row['t']) 
+  else:
+    notif = BaseNotification(row['term_id'], row['t'])
+  notif.id = row['id']
+  return notif
+
+
+class NotificationStore:
+  """ Notifications of users, loaded from the database on demand a page at 
+      a time. The first page of the most recently active users is kept in 
+      memory for a short while. This method is thread-safe. 
+
+    :param size: Number of users whose notifications are kept. 
+    :type size: int
+    :param limit: Number of notifications per page. 
+    :type limit: int
+  """
+
+  def __init__(self, size=NOTIFY_CACHE_SIZE, limit=NOTIFY_PAGE_SIZE): 
+    self.limit = limit
+    self.pages = cache.LRUCache(size) #: User ID --> (T_loaded, notifications)
+    self.L_store = Lock()
+
+  def get(self, user_id, db_con, offset=0): 
+    """ Get a page of a user's notifications, most recent first. 
+
+    :param user_id: User ID. 
+    :type user_id: int
+    :param db_con: DB connection.
+    :type db_con: seaice.SeaIceConnector.SeaIceConnector
+    :param offset: Number of notifications to skip. 
+    :type offset: int
+    :rtype: seaice.notify.BaseNotification list
+    """
+    if offset > 0: 
+      return map(getNotificationFromRow, 
+                 db_con.getUserNotificationsPage(user_id, self.limit, offset))
+    page = self.pages.get(user_id)
+    if page is None or time.time() - page[0] > NOTIFY_CACHE_TTL: 
+      page = (time.time(), map(getNotificationFromRow, 
+                               db_con.getUserNotificationsPage(user_id, self.limit)))
+      self.pages.put(user_id, page)
+    self.L_store.acquire()
+    notifications = list(page[1])
+    self.L_store.release()
+    return notifications
+
+  def add(self, user_id, notif): 
+    """ Add a new notification to the user's first page, if it's loaded. """
+    page = self.pages.get(user_id)
+    if page: 
+      self.L_store.acquire()
+      page[1].insert(0, notif)
+      del page[1][self.limit:]
+      self.L_store.release()
+
+  def remove(self, user_id, id): 
+    """ Remove a notification from the user's first page, if it's loaded. 
+
+    :param id: Primary key of the notification. 
+    :type id: int
+    """
+    page = self.pages.get(user_id)
+    if page: 
+      self.L_store.acquire()
+      page[1][:] = filter(lambda notif: notif.id != id, page[1])
+      self.L_store.release()
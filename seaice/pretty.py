@@ -129,6 +129,13 @@ token_ref_regex = re.compile("(?<!#\{g: )([#&]+)([\w.-]+)")
 ref_regex = re.compile("#\{\s*(([gstkm])\s*:+)?\s*([^}|]*?)(\s*\|+\s*([^}]*?))?\s*\}")
 # subexpr start positions:    01                  2        3         4
 
+# A curly reference or a "#ref"/"&ref" token, whichever comes first, so that 
+# refs_norm can normalize a string in one pass. A token inside a curly 
+# reference is part of it. 
+ref_token_regex = re.compile(ref_regex.pattern + '|' + token_ref_regex.pattern)
+# subexpr start positions: as in ref_regex, then the token's sigil at 5 
+# and the token at 6. 
+
 #_xtag_regex = re.compile('#(([a-zA-Z][a-zA-Z0-9_\-\.]*)_term)')	# hack!
 #tag_regex = re.compile("#([a-zA-Z][a-zA-Z0-9_\-\.]*[a-zA-Z0-9])")
 #_xterm_tag_regex = re.compile('#\{\s*([a-zA-Z0-9]+)\s*:\s*(relate. to[^\{\}]*)\}')	# hack!
@@ -145,6 +152,10 @@ ixuniq = 'xq'
 ixqlen = len(ixuniq)
 tagstart = '#{g: '		# note: final space is important
 
+# Parts of a tag's term string, stripped by innerAnchor for display. 
+gtag_start_regex = re.compile('^#{g:\s*(%s)?' % ixuniq)
+gtag_end_regex = re.compile('\s*\|.*')
+
 def token_ref_norm(m):
   """ Promote "&ref" to "#{t: ref} and promote "#ref" to "#{g: ref}".
 
@@ -189,12 +200,90 @@ def refs_norm(db_con, string, force=False):
   :param string: The input string. 
   :returns: Modified plain text string.
   """
+  return refs_norm_all(db_con, [string], force)[0]
 
-  string = token_ref_regex.sub(lambda m: token_ref_norm(m), string)
-  # now convert each curly "#{reference}
-  string = ref_regex.sub(lambda m: ref_norm(db_con, m, force), string)
-  return string
-    
+def refs_norm_all(db_con, strings, force=False): 
+  """ Resolve references in several text entries, e.g. the fields of a 
+      form, like :func:`refs_norm`. Each string is scanned once, and the 
+      references that need looking up are resolved with one query. A 
+      "#ref" or "&ref" inside a curly reference, e.g. "#{t: a &b}" or 
+      "#{t: foo | #bar}", is part of it and isn't promoted. 
+
+  :param db_con: DB connection.
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param strings: The input strings. 
+  :type strings: str list
+  :param force: flag to force humstring lookup
+  :type force: boolean
+  :returns: Modified plain text strings. 
+  :rtype: str list
+  """
+  tokens = map(refs_tokens, strings)
+  lookups = set()
+  for parts in tokens: 
+    for part in parts: 
+      if isinstance(part, tuple): 
+        key = ref_lookup(part[0], part[1], part[2], force)
+        if key is not None: 
+          lookups.add(key)
+  found = db_con.getTermsByInitialTermStrings(lookups) if lookups else {}
+
+  results = []
+  for parts in tokens: 
+    for (i, part) in enumerate(parts): 
+      if isinstance(part, tuple): 
+        key = ref_lookup(part[0], part[1], part[2], force)
+        parts[i] = ref_norm_parts(part[0], part[1], part[2], force, 
+                                  found.get(key, (0, None)))
+    results.append(''.join(parts))
+  return results
+
+def refs_tokens(string): 
+  """ Split a text entry into plain text and references in one pass. A 
+      simple "#ref" is a reference to the tag ixuniq+ref and a simple 
+      "&ref" one to the term ref (see :func:`token_ref_norm`), unless it's 
+      inside a curly reference. 
+
+  :param string: The input string. 
+  :returns: Plain text strings and references as (reftype, humstring, 
+            IDstring) tuples, in order. 
+  :rtype: list
+  """
+  parts = []
+  start = 0
+  for m in ref_token_regex.finditer(string): 
+    parts.append(string[start:m.start()])
+    start = m.end()
+    rp = m.groups()
+    sigil = rp[5]
+    if sigil is None: 
+      parts.append((rp[1], rp[2], rp[4]))
+    elif sigil == '#': 
+      parts.append(('g', ixuniq + rp[6], None))
+    elif sigil == '&': 
+      parts.append(('t', rp[6], None))
+    else:
+      parts.append(m.group(0))	# return untouched if doubled
+  parts.append(string[start:])
+  return parts
+
+def ref_lookup(reftype, humstring, IDstring, force=False): 
+  """ Get the term string prefix that a reference is looked up by in order 
+      to normalize it (see :func:`ref_norm`). 
+
+  :returns: The prefix, or None if the reference isn't looked up. 
+  :rtype: str or None
+  """
+  if not reftype:
+    reftype = 't'
+  if reftype == 'k' or (not humstring and not IDstring): 
+    return None
+  if IDstring and not force:
+    return None
+  if humstring.startswith('---'):
+    return None
+  prefix = tagstart if reftype == 'g' else ''
+  return prefix + humstring
 
 # looks a lot like printRefAsHTML, but is about how we _store_ things
 def ref_norm(db_con, m, force=False): 
@@ -224,6 +313,17 @@ def ref_norm(db_con, m, force=False):
   (rp) = m.groups()	# rp = ref parts, the part between #{ and }
                         # we want subexpressions 1, 2, and 4
   reftype, humstring, IDstring = rp[1], rp[2], rp[4]
+  key = ref_lookup(reftype, humstring, IDstring, force)
+  found = db_con.getTermByInitialTermString(key) if key is not None else None
+  return ref_norm_parts(reftype, humstring, IDstring, force, found)
+
+def ref_norm_parts(reftype, humstring, IDstring, force=False, found=None): 
+  """ Output a normalized reference given its parts, see :func:`ref_norm`. 
+
+  :param found: Result of looking up the reference by :func:`ref_lookup`, 
+                see :func:`seaice.SeaIceConnector.SeaIceConnector.getTermByInitialTermString`. 
+  :type found: (int, dict)
+  """
   if not reftype:
     reftype = 't'		# apply default reftype
   if not humstring and not IDstring:	# when both are empty
@@ -247,9 +347,8 @@ def ref_norm(db_con, m, force=False):
   if humstring.startswith('---'):		# reserved magic string
     return '#{%s: %s}' % (reftype, humstring)
 
-  # If we get here, we're going to do the lookup.
-  prefix = tagstart if reftype == 'g' else ''
-  n, term = db_con.getTermByInitialTermString(prefix + humstring)
+  # If we get here, the lookup was done.
+  n, term = found
   if n == 1:
     term_string, concept_id = term['term_string'], term['concept_id']
     if reftype == 'g':
@@ -265,7 +364,8 @@ def ref_norm(db_con, m, force=False):
 
   ## Processing tags in text areas. ##
 
-def innerAnchor (db_con, term_string, concept_id, definition, tagAsTerm):
+def innerAnchor (db_con, term_string, concept_id, definition, tagAsTerm,
+                 definition_text=None):
   """ Input ...
   
   A DB connector is required to resolve the concept_id to a definition.
@@ -280,11 +380,16 @@ def innerAnchor (db_con, term_string, concept_id, definition, tagAsTerm):
 
   :param db_con: DB connection.
   :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param definition_text: The definition as plain text, if it's stored 
+                          (see :func:`processRefsAsText`). 
+  :type definition_text: str
   """
 
   if definition != None:
+    if definition_text is None:
+      definition_text = processRefsAsText(definition, tagAsTerm=True)
     attribs = 'href="/term=%s" title="%s"' % (concept_id,
-      processRefsAsText(definition, tagAsTerm=True).replace('"', '&quot;'))
+      definition_text.replace('"', '&quot;'))
   else:
     attribs = 'href="#" title="Click to get a reference link to this term."'
     attribs += ' id="copyLink"'
@@ -296,13 +401,50 @@ def innerAnchor (db_con, term_string, concept_id, definition, tagAsTerm):
     return attribs + '>' + term_string
 
   # yyy compile these regex's? -- maybe not since execution is rare
-  t = re.sub('^#{g:\s*(%s)?' % ixuniq, '', term_string)
-  t = '#' + re.sub('\s*\|.*', '', t)
+  t = gtag_start_regex.sub('', term_string)
+  t = '#' + gtag_end_regex.sub('', t)
   if definition == None:
     attribs += ''' onclick="CopyToClipboard('%s');"''' % term_string
   return attribs + '>' + t
 
-def printRefAsHTML(db_con, reftype, humstring, IDstring, tagAsTerm): 
+def getRefIds(*strings):
+  """ Collect the concept IDs referenced in DB text entries. External 
+      links ("k") and EndRefs ("---") are skipped since they don't 
+      reference a term. 
+
+  :param strings: The input strings. 
+  :returns: Concept IDs. 
+  :rtype: str set
+  """
+  ids = set()
+  for string in strings:
+    if not string:
+      continue
+    for m in ref_regex.finditer(string):
+      (rp) = m.groups()
+      reftype, humstring, IDstring = rp[1], rp[2], rp[4]
+      if reftype == 'k' or not IDstring:
+        continue
+      if humstring and humstring.startswith('---'):
+        continue
+      ids.add(IDstring)
+  return ids
+
+def resolveRefs(db_con, *strings):
+  """ Resolve all references in a set of DB text entries with one query. 
+      The result can be passed as *refs* to :func:`processTagsAsHTML` 
+      (and the printers that call it) for every string on a page, e.g. 
+      the term definition, examples, and comments. 
+
+  :param db_con: DB connection.
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param strings: The input strings. 
+  :returns: Map from concept ID to term row. 
+  :rtype: dict
+  """
+  return db_con.getTermsByConceptIds(getRefIds(*strings))
+
+def printRefAsHTML(db_con, reftype, humstring, IDstring, tagAsTerm, refs=None): 
   """ Input reftype, human readable string, machine readable string,
       and output the reference as HTML.
   
@@ -319,6 +461,9 @@ def printRefAsHTML(db_con, reftype, humstring, IDstring, tagAsTerm):
 
   :param db_con: DB connection.
   :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param refs: Terms already resolved by :func:`resolveRefs`. If None, 
+               the term is looked up by itself. 
+  :type refs: dict
   """
 
   if not reftype:
@@ -345,7 +490,10 @@ def printRefAsHTML(db_con, reftype, humstring, IDstring, tagAsTerm):
   # If we get here, reftype is not k, and IDstring (concept_id)
   # is expected to reference a term in the dictionary.
   # 
-  term = db_con.getTermByConceptId(IDstring)
+  if refs is not None:
+    term = refs.get(IDstring)
+  else:
+    term = db_con.getTermByConceptId(IDstring)
   term_def = "Def: " + (term['definition'] if term else "(undefined)")
   # yyy can we improve poor search for '#tag' query?
   if reftype == 'g':
@@ -414,28 +562,33 @@ def printRefAsText(m, tagAsTerm):
   return humstring
 
 
-def processTagsAsHTML(db_con, string, tagAsTerm = False): 
+def processTagsAsHTML(db_con, string, tagAsTerm = False, refs = None): 
   """  Process tags in DB text entries into HTML. 
 
   :param db_con: DB connection.
   :type db_con: seaice.SeaIceConnector.SeaIceConnector
   :param string: The input string. 
+  :param refs: Terms already resolved by :func:`resolveRefs`. If None, 
+               the references in *string* are resolved in one query. 
+  :type refs: dict
   :returns: HTML-formatted string.
   """
 
+  if refs is None:
+    refs = resolveRefs(db_con, string)
   # preserve user-defined newlines by converting to line breaks on output
   # replace tags afterwards (because replacement may add newlines)
   string = string.replace("\n", "\n<br>")
-  string = ref_regex.sub(lambda m: printRefReAsHTML(db_con, m, tagAsTerm), string)
+  string = ref_regex.sub(lambda m: printRefReAsHTML(db_con, m, tagAsTerm, refs), string)
   string = string.replace("##", "#")	# escape mechanism
   string = string.replace("&&", "&")
   return string
 
-def printRefReAsHTML(db_con, m, tagAsTerm):
+def printRefReAsHTML(db_con, m, tagAsTerm, refs=None):
   (rp) = m.groups()	# rp = ref parts, the part between #{ and }
                         # we want subexpressions 1, 2, and 4
   reftype, humstring, IDstring = rp[1], rp[2], rp[4]
-  return printRefAsHTML(db_con, reftype, humstring, IDstring, tagAsTerm)
+  return printRefAsHTML(db_con, reftype, humstring, IDstring, tagAsTerm, refs)
 
 def processRefsAsText(string, tagAsTerm = False): 
   """  Render references in DB text entries into plain text. 
@@ -497,6 +650,32 @@ def printAsJSObject(rows, fd = sys.stdout):
         row[col] = str(value)
   print >>fd, json.dumps(rows, sort_keys=True, indent=2, separators=(',', ': '))
 
+def printAsJSObjectStream(rows, fd = sys.stdout, lines=False): 
+  """ Print table rows one at a time, either as the elements of a JSON 
+      array, formatted exactly as by :func:`printAsJSObject`, or as JSON 
+      Lines (one object per line). Only one row is held at a time, so 
+      *rows* can be a server-side cursor. 
+
+  :param rows: Table rows. 
+  :type rows: dict iterator
+  :param fd: File descriptor to which to output the result (default is sys.stdout). 
+  :type fd: file
+  :param lines: Print JSON Lines instead of an array. 
+  :type lines: bool
+  """
+  first = True
+  for row in rows:
+    row = dict((col, str(value) if type(value) == datetime.datetime else value)
+                  for (col, value) in row.iteritems())
+    if lines: 
+      fd.write(json.dumps(row, sort_keys=True) + '\n')
+      continue
+    obj = json.dumps(row, sort_keys=True, indent=2, separators=(',', ': '))
+    fd.write(('[\n  ' if first else ',\n  ') + obj.replace('\n', '\n  '))
+    first = False
+  if not lines: 
+    print >>fd, '[]' if first else '\n]'
+
 def getPrettyParagraph(db_con, text, leftMargin=8, width=60): 
   """ Format some text into a nice paragraph for displaying in the terminal. 
       Output the result directly to sys.stdout. 
@@ -567,6 +746,28 @@ def printTermsPretty(db_con, rows):
     print getPrettyTerm(db_con, row) 
 
 
+def getOwnerName(db_con, row, full=False):
+  """ Get the name of the owner of a term or comment row. Rows produced by 
+      the joined queries (e.g. :func:`seaice.SeaIceConnector.SeaIceConnector.getAllTerms`) 
+      carry the name with them; otherwise fall back to a query. 
+
+  :param db_con: DB connection.
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param row: Table row with at least the key 'owner_id'. 
+  :type row: dict
+  :param full: Get full name
+  :type full: bool
+  :rtype: str or None
+  """
+  if 'owner_first_name' not in row:
+    return db_con.getUserNameById(row['owner_id'], full)
+  if row['owner_first_name'] is None:
+    return None
+  if full: 
+    return row['owner_first_name'] + " " + row['owner_last_name']
+  return row['owner_first_name']
+
+
 def printTermsAsLinks(db_con, rows):
   """ Print terms as a link list (pun intended). 
 
@@ -577,11 +778,42 @@ def printTermsAsLinks(db_con, rows):
   string = ""
   for row in rows: 
     #string += '<li><a href="/term=%s">%s</a></li>' % (row['concept_id'], row['term_string'])
-    string += '<li><a %s</a></li>' % innerAnchor(db_con, row['term_string'], row['concept_id'], row['definition'], tagAsTerm=True)
+    string += '<li><a %s</a></li>' % innerAnchor(db_con, row['term_string'], row['concept_id'], row['definition'], tagAsTerm=True,
+                                                  definition_text=row.get('definition_text'))
   return string
 
 
-def printTermAsHTML(db_con, row, user_id=0):
+def renderTerm(db_con, row, refs=None): 
+  """ Render the parts of the term page that are the same for every viewer 
+      and expensive to produce: the term anchor, the owner's name, and the 
+      definition and examples with their references resolved. The result 
+      can be cached and passed to :func:`printTermAsHTML`. The HTML stored 
+      with the term is used if it's there (see 
+      :func:`seaice.SeaIceConnector.SeaIceConnector.renderTerms`). 
+
+  :param db_con: DB connection.
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param row: Term row. 
+  :type row: dict
+  :param refs: Terms referenced on the page, see :func:`resolveRefs`. 
+  :type refs: dict
+  :returns: Keys 'anchor', 'owner', 'definition', and 'examples'. 
+  :rtype: dict
+  """
+  definition = row.get('definition_html')
+  examples = row.get('examples_html')
+  if definition is None or examples is None:
+    if refs is None:
+      refs = resolveRefs(db_con, row['definition'], row['examples'])
+    definition = processTagsAsHTML(db_con, row['definition'], refs=refs)
+    examples = processTagsAsHTML(db_con, row['examples'], refs=refs)
+  return { 'anchor' : innerAnchor(db_con, row['term_string'], row['concept_id'],
+                                  None, tagAsTerm=True),
+           'owner' : db_con.getUserNameById(row['owner_id'], full=True),
+           'definition' : definition,
+           'examples' : examples }
+
+def printTermAsHTML(db_con, row, user_id=0, refs=None, rendered=None):
   """ Format a term for the term page, e.g. `this <http://seaice.herokuapp.com/term=1001>`_.
 
     This is the main page where you can look at a term. It includes a term definition, 
@@ -594,10 +826,20 @@ def printTermAsHTML(db_con, row, user_id=0):
   :param user_id: Surrogate ID of user requesting the page. Defaults to 0 if session is 
                   unauthenticated. 
   :type user_id: int 
+  :param refs: Terms referenced on the page, see :func:`resolveRefs`. 
+  :type refs: dict
+  :param rendered: Output of :func:`renderTerm` for the row, if it's at hand. 
+  :type rendered: dict
   :returns: HTML-formatted string.
   """
 
-  vote = db_con.getVote(0 if not user_id else user_id, row['id'])
+  if rendered is None:
+    rendered = renderTerm(db_con, row, refs)
+  if user_id:
+    vote = db_con.getVote(user_id, row['id'])
+    good = db_con.checkTracking(user_id, row['id'])
+  else: # Anonymous viewers haven't voted or starred anything. 
+    vote, good = None, False
   string = '<script>' + js_confirmRemoveTerm + js_termAction + js_copyToClipboard + '</script>'
 
   # Voting
@@ -619,18 +861,15 @@ def printTermAsHTML(db_con, row, user_id=0):
   string += '     <img src="/static/img/%s.png"></a><br>' % ('down_set' if vote == -1 else 'down')
   
   
-  good = db_con.checkTracking(0 if not user_id else user_id, row['id'])
   string += '    <br><a id="star" title="Track this term" href="#star"' + \
             '     onclick="return TermAction({1}, \'{0}\');">[{2}]</a><br> '.format(
              ("unstar" if good else "star"), row['id'], 'unwatch' if good else 'watch')
   string += "  </td></tr>\n"
 
-  iAnchor = innerAnchor(db_con, row['term_string'], row['concept_id'],
-                 None, tagAsTerm=True)
   # Name/Class
   string += "  <tr>"
   string += "    <td valign=top width=8%><i>Term:</i></td>"
-  string += "    <td valign=top width=25%><font size=\"3\"><strong><a {0}</a></strong></font><td>".format(iAnchor)
+  string += "    <td valign=top width=25%><font size=\"3\"><strong><a {0}</a></strong></font><td>".format(rendered['anchor'])
   string += "    <td valign=top width=5% rowspan=2>"
   string += "      <nobr><i>Class:&nbsp;&nbsp;</i></nobr><br>"
   string += "    </td>\n"
@@ -652,7 +891,7 @@ def printTermAsHTML(db_con, row, user_id=0):
   string += "    <td valign=top width=20% rowspan=3>"
   string += "      <nobr><i>Created %s</i></nobr><br>" % printPrettyDate(row['created'])
   string += "      <nobr><i>Last modified %s</i></nobr><br>" % printPrettyDate(row['modified'])
-  string += "      <nobr><i>Contributed by</i> %s</nobr><br>"% db_con.getUserNameById(row['owner_id'], full=True)
+  string += "      <nobr><i>Contributed by</i> %s</nobr><br>"% rendered['owner']
   if persistent_id != '':
       string += "      <br>"
       string += '      <nobr><i>Permalink:</i><br>&nbsp;&nbsp;' + permalink + '</nobr><br>'
@@ -671,11 +910,11 @@ def printTermAsHTML(db_con, row, user_id=0):
   # Definition/Examples
   string += "  <tr>"
   string += "    <td valign=top><i>Definition:</i></td>"
-  string += "    <td colspan=4 valign=top style='padding-right:36px'><font size=\"3\"> %s</font></td>" % processTagsAsHTML(db_con, row['definition'])
+  string += "    <td colspan=4 valign=top style='padding-right:36px'><font size=\"3\"> %s</font></td>" % rendered['definition']
   string += "  </tr>"
   string += "  <tr>"
   string += "    <td valign=top><i>Examples:</i></td>"
-  string += "    <td colspan=4 valign=top style='padding-right:36px'><font size=\"3\"> %s</font></td>" % processTagsAsHTML(db_con, row['examples'])
+  string += "    <td colspan=4 valign=top style='padding-right:36px'><font size=\"3\"> %s</font></td>" % rendered['examples']
   string += "  </tr>"
   string += "</table>"
   return string
@@ -694,6 +933,9 @@ def printTermsAsHTML(db_con, rows, user_id=0):
   :returns: HTML-formatted string.
   """
   
+  rows = list(rows)
+  refs = resolveRefs(db_con, *[ row['definition'] for row in rows ] + 
+                              [ row['examples'] for row in rows ])
   string = '<script>' + js_confirmRemoveTerm + '</script><table>'
   for row in rows:
     string += "  <tr>"
@@ -710,13 +952,13 @@ def printTermsAsHTML(db_con, rows, user_id=0):
     string += "    <td valign=top rowspan=2>"
     string += "      <nobr><i>Created %s</i></nobr><br>" % printPrettyDate(row['created'])
     string += "      <nobr><i>Last modified %s</i></nobr><br>" % printPrettyDate(row['modified'])
-    string += "      <nobr><i>Contributed by</i> %s</nobr><br>" % db_con.getUserNameById(row['owner_id'], full=True)
+    string += "      <nobr><i>Contributed by</i> %s</nobr><br>" % getOwnerName(db_con, row, full=True)
     string += "    </td>"
     string += "  </tr>"
     string += "  <tr>"
     string += "    <td valign=top>"
-    string += "     <i>Definition:</i>&nbsp;<font size=\"3\"> %s</font>&nbsp;" % processTagsAsHTML(db_con, row['definition'])
-    string += "     <i>Examples:</i>&nbsp;<font size=\"3\"> %s</font></td>" % processTagsAsHTML(db_con, row['examples'])
+    string += "     <i>Definition:</i>&nbsp;<font size=\"3\"> %s</font>&nbsp;" % processTagsAsHTML(db_con, row['definition'], refs=refs)
+    string += "     <i>Examples:</i>&nbsp;<font size=\"3\"> %s</font></td>" % processTagsAsHTML(db_con, row['examples'], refs=refs)
     string += "  </tr>"
     string += "  <tr height=16><td></td></tr>"
   string += "</table>"
@@ -754,7 +996,8 @@ def printTermsAsBriefHTML(db_con, rows, user_id=0):
                   <td>Last modified</td></tr>'''
   for row in rows:
     iAnchor = innerAnchor(db_con, row['term_string'], row['concept_id'],
-                 row['definition'], tagAsTerm=True)
+                 row['definition'], tagAsTerm=True,
+                 definition_text=row.get('definition_text'))
     #string += '''<tr><td><a title="Def: {8}" href=/term={5}>{0}</a></td><td>{1}</td><td>{2}</td>
     string += "<tr><td><a %s</a></td>" % iAnchor
     string += '''<td>{0}</td><td>{1}</td>
@@ -765,14 +1008,37 @@ def printTermsAsBriefHTML(db_con, rows, user_id=0):
           row['up'] - row['down'],
           summarizeConsensus(row['consensus']),
           row['class'], 
-          db_con.getUserNameById(row['owner_id'], full=True),
+          getOwnerName(db_con, row, full=True),
           #row['concept_id'],
           colorOf[row['class']],
           printPrettyDate(row['modified']))
   string += "</table>"
   return string
 
-def printCommentsAsHTML(db_con, rows, user_id=0): 
+def renderComments(db_con, rows, refs=None): 
+  """ Render the parts of comments that are the same for every viewer, 
+      see :func:`renderTerm`. The HTML stored with a comment is used if 
+      it's there. 
+
+  :param db_con: DB connection.
+  :type db_con: seaice.SeaIceConnector.SeaIceConnector
+  :param row: Comment rows. 
+  :type row: dict iterator
+  :param refs: Terms referenced on the page, see :func:`resolveRefs`. 
+  :type refs: dict
+  :returns: The comment text as HTML and the owner's name of each row. 
+  :rtype: (str, str) list
+  """
+  rows = list(rows)
+  unrendered = [ row['comment_string'] for row in rows 
+                   if row.get('comment_html') is None ]
+  if refs is None and unrendered:
+    refs = resolveRefs(db_con, *unrendered)
+  return [ (row['comment_html'] if row.get('comment_html') is not None 
+              else processTagsAsHTML(db_con, row['comment_string'], refs=refs), 
+            getOwnerName(db_con, row)) for row in rows ]
+
+def printCommentsAsHTML(db_con, rows, user_id=0, refs=None, rendered=None): 
   """ Format comments for display on the term page. 
 
   :param db_con: DB connection.
@@ -782,20 +1048,27 @@ def printCommentsAsHTML(db_con, rows, user_id=0):
   :param user_id: Surrogate ID of user requesting the page. Defaults to 0 if session is 
                   unauthenticated. 
   :type user_id: int 
+  :param refs: Terms referenced on the page, see :func:`resolveRefs`. 
+  :type refs: dict
+  :param rendered: Output of :func:`renderComments` for the rows, if it's at hand. 
+  :type rendered: (str, str) list
   :returns: HTML-formatted string.
   """
 
+  rows = list(rows)
+  if rendered is None:
+    rendered = renderComments(db_con, rows, refs)
   string = '<script>' + js_confirmRemoveComment + '</script><table>'
-  for row in rows:
+  for (row, (html, owner)) in zip(rows, rendered):
     string += "<tr>"
-    string += "  <td align=left valign=top width=70%>{0}".format(processTagsAsHTML(db_con, row['comment_string']))
+    string += "  <td align=left valign=top width=70%>{0}".format(html)
     if user_id == row['owner_id']:
       string += " <nobr><a href=\"/comment=%d/edit\">[edit]</a>" % row['id']
       string += """ <a id="removeComment" title="Click to remove this comment" href="#"
                     onclick="return ConfirmRemoveComment(%s);">[remove]</a></nobr>""" % row['id']
     string += "  </td>"
     string += "  <td align=right valign=top><font color=\"#B8B8B8\"><i>Submitted {0}<br>by {1}</i></font></td>".format(
-      printPrettyDate(row['created']), db_con.getUserNameById(row['owner_id']))
+      printPrettyDate(row['created']), owner)
     string += "</tr>" 
     string += "</tr><tr height=16><td></td></tr>"
   string += "</table>"
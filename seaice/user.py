@@ -26,6 +26,8 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from threading import Lock
+import copy
+import notify as seaice_notify
 
 ##
 # class BaseUser 
@@ -84,11 +86,20 @@ class AnonymousUser(BaseUser):
 #
     
 class User(BaseUser):
-  """ Handler for authenticated sessions. """
+  """ Handler for authenticated sessions. 
 
-  def __init__(self, id, name): 
+    If *store* is given, notifications are kept in the database and loaded 
+    through the store as they are needed. Otherwise they are kept in 
+    memory by the instance. 
+
+  :param store: Notification store. 
+  :type store: seaice.notify.NotificationStore
+  """
+
+  def __init__(self, id, name, store=None): 
     BaseUser.__init__(self, id, name)
     self.notifications = [] 
+    self.store = store
     self.L_notify = Lock()
 
   def notify(self, notif, db_con=None):
@@ -106,32 +117,53 @@ class User(BaseUser):
     :type db_con: seaice.SeaIceConnector.SeaIceConnector
     """
     if db_con: 
+      notif = copy.copy(notif) # The same notification may go to several users. 
       db_con.insertNotification(int(self.id), notif)
+    if self.store:
+      self.store.add(self.id, notif)
+      return
     self.L_notify.acquire()
     self.notifications.append(notif)
     self.L_notify.release()
 
-  def remove(self, i, db_con=None):
-    """ Remove notification at index *i* from the list.
+  def remove(self, id, db_con=None):
+    """ Remove notification by its primary key. 
 
       If *db_con* is specified, then remove notification from the database. 
-      This method is thread-safe. **NOTE:** If the order of notifications 
-      changed sometime between this point and the last time the HTML page was 
-      generated, the wrong notification will be removed. 
+      This method is thread-safe. 
 
-    :param i: Index of notification. 
-    :type i: int
+    :param id: Primary key of notification. 
+    :type id: int
     :param db_con: DB connection.
     :type db_con: seaice.SeaIceConnector.SeaIceConnector
     """
     if db_con: 
-      db_con.removeNotification(int(self.id), self.notifications[i])
+      db_con.removeNotificationById(int(self.id), id)
       db_con.commit()
+    if self.store:
+      self.store.remove(self.id, id)
+      return
     self.L_notify.acquire()
-    self.notifications.remove(self.notifications[i])
+    self.notifications = filter(lambda notif: notif.id != id, self.notifications)
     self.L_notify.release()
+
+  def getNotifications(self, db_con, offset=0):
+    """ Get a page of notifications, most recent first. 
+
+    :param db_con: DB connection.
+    :type db_con: seaice.SeaIceConnector.SeaIceConnector
+    :param offset: Number of notifications to skip (only with a store). 
+    :type offset: int
+    :rtype: seaice.notify.BaseNotification list
+    """
+    if self.store:
+      return self.store.get(self.id, db_con, offset)
+    self.L_notify.acquire()
+    notifications = list(reversed(self.notifications))
+    self.L_notify.release()
+    return notifications
     
-  def getNotificationsAsHTML(self, db_con):
+  def getNotificationsAsHTML(self, db_con, offset=0):
     """ Get notifications as HTML. 
       
       Create a link next each one which, when clicked, calls 
@@ -139,17 +171,19 @@ class User(BaseUser):
     
     :param db_con: DB connection.
     :type db_con: seaice.SeaIceConnector.SeaIceConnector
+    :param offset: Number of notifications to skip. 
+    :type offset: int
     :returns: HTML-formatted string.
     """
-    self.L_notify.acquire()
     result = ''
-    for i in reversed(range(len(self.notifications))):
-      notify = self.notifications[i].getAsHTML(db_con)
-      if notify:
-        result += '''<p><a href="/user=%d/notif=%d/remove" 
-                         title="Click to remove this notification">[x]</a>
-                         &nbsp;&nbsp;%s</p>''' % (self.id, i, notify)
-    self.L_notify.release()
+    notifications = self.getNotifications(db_con, offset)
+    for (notif, html) in seaice_notify.getNotificationsAsHTML(db_con, notifications):
+      result += '''<p><a href="/user=%d/notif=%s/remove" 
+                       title="Click to remove this notification">[x]</a>
+                       &nbsp;&nbsp;%s</p>''' % (self.id, notif.id, html)
+    if self.store and len(notifications) == self.store.limit: 
+      result += '<p><a href="/?notif_offset=%d">Older notifications</a></p>' % (
+                  offset + self.store.limit)
     return result
 
   def getNotificationsAsPlaintext(self, db_con):
@@ -159,11 +193,8 @@ class User(BaseUser):
     :type db_con: seaice.SeaIceConnector.SeaIceConnector
     :returns: Plaintext string.
     """
-    self.L_notify.acquire()
     result = ''
-    for i in reversed(range(len(self.notifications))):
-      notify = self.notifications[i].getAsPlaintext(db_con)
-      if notify:
-        result += notify + '\n\n'
-    self.L_notify.release()
+    for (notif, text) in seaice_notify.getNotificationsAsPlaintext(db_con, 
+                                            self.getNotifications(db_con)):
+      result += text + '\n\n'
     return result.strip()